@@ -1,7 +1,7 @@
 from numpy.testing._private.utils import print_assert_equal
 import torch
 
-from retinanet.dataloader import collater, AspectRatioBasedSampler
+from retinanet.dataloader import collater, AspectRatioBasedSampler, prepare_img_batch
 from retinanet.losses import IL_Loss
 def fast_zero_grad(model):
     for param in model.parameters():
@@ -14,7 +14,11 @@ def training_iteration(il_loss:IL_Loss, data, is_replay=False):
     """
     # with torch.cuda.amp.autocast():
     with torch.cuda.device(0):
-        losses = il_loss.forward(data['img'].float().cuda(), data['annot'].cuda(), is_replay=is_replay)
+        img_batch, annots = prepare_img_batch(data['img']), data['annot'].cuda()
+        batch_augmenter = il_loss.il_trainer.batch_augmenter
+        if batch_augmenter != None:
+            img_batch, annots = batch_augmenter(img_batch, annots, data['shape'])
+        losses = il_loss.forward(img_batch, annots, is_replay=is_replay)
 
         loss = torch.tensor(0).float().cuda()
         loss_info = {}
@@ -95,7 +99,7 @@ class A_GEM(object):
         #         fast_zero_grad(self.model)
 
         #         with torch.cuda.amp.autocast():
-        #             cls_loss, reg_loss = self.model.cal_simple_focal_loss(data['img'].float().cuda(), data['annot'].cuda(), self.params)
+        #             cls_loss, reg_loss = self.model.cal_simple_focal_loss(prepare_img_batch(data['img']), data['annot'].cuda(), self.params)
                                 
         #             cls_loss = cls_loss.mean()
         #             reg_loss = reg_loss.mean()
@@ -3,10 +3,9 @@ import torch.nn as nn
 import torch.optim
 from torch.optim.lr_scheduler import StepLR
 import copy
-from torch.utils.data.dataloader import DataLoader
-from torchvision import transforms
 
-from retinanet.dataloader import AspectRatioBasedSampler, Bic_dataset, Resizer, Augmenter, Normalizer, collater
+from retinanet.dataloader import Bic_dataset, get_transform, get_resize_backend, prepare_img_batch, create_dataloader
+from retinanet.prefetcher import prefetch
 from retinanet.losses import IL_Loss
 
 class BiasLayer(nn.Module):
@@ -81,13 +80,13 @@ class Bic_Trainer(object):
     def _init_dataset(self):
         self.image_ids
         self.dataset_bic = Bic_dataset(self.il_trainer.params, 
-                                        transforms.Compose([Normalizer(), Augmenter(), Resizer()]),
+                                        get_transform(augment=not self.il_trainer.params['batch_augment'], uint8=self.il_trainer.params['uint8_collate'],
+                                                      resize_backend=get_resize_backend(self.il_trainer.params)),
                                         self.image_ids,
                                         self.seen_ids)
 
-        # sampler = AspectRatioBasedSampler(self.dataset_bic, batch_size = self.il_trainer.params['batch_size'], drop_last=False)
-        sampler = AspectRatioBasedSampler(self.dataset_bic, batch_size = 4, drop_last=False)
-        self.dataloader_bic = DataLoader(self.dataset_bic, num_workers=2, collate_fn=collater, batch_sampler=sampler)
+        # self.dataloader_bic = create_dataloader(self.il_trainer.params, self.dataset_bic, self.il_trainer.params['batch_size'])
+        self.dataloader_bic = create_dataloader(self.il_trainer.params, self.dataset_bic, 4)
 
     def update_tools(self):
         if self.optim != None:
@@ -193,10 +192,13 @@ class Bic_Trainer(object):
         mean_loss = 0.0
         with torch.cuda.device(0):
             self.optim.zero_grad()
-            for iter_num, data in enumerate(self.dataloader_bic):
+            for iter_num, data in enumerate(prefetch(self.il_trainer.params, self.dataloader_bic)):
                 loss_info = {}
                 
-                losses = self.il_loss.forward(data['img'].float().cuda(), data['annot'].cuda(), is_replay=is_replay, is_bic=True)
+                img_batch, annots = prepare_img_batch(data['img']), data['annot'].cuda()
+                if self.il_trainer.batch_augmenter != None:
+                    img_batch, annots = self.il_trainer.batch_augmenter(img_batch, annots, data['shape'])
+                losses = self.il_loss.forward(img_batch, annots, is_replay=is_replay, is_bic=True)
                 loss = torch.tensor(0).float().cuda()
                 for key, value in losses.items():
                     if value != None:
@@ -8,7 +8,7 @@ import pickle
 import os
 from torch.utils import data
 from torchvision import transforms
-from retinanet.dataloader import IL_dataset, Normalizer, Resizer, Augmenter
+from retinanet.dataloader import IL_dataset, get_transform, get_resize_backend
 
 THRESOLD = 0.25
 
@@ -60,7 +60,7 @@ class Herd_sampler(object):
 
 
         dataset = IL_dataset(self.il_trainer.params,
-                            transform=transforms.Compose([Normalizer(), Resizer()]),
+                            transform=get_transform(resize_backend=get_resize_backend(self.il_trainer.params)),
                             start_state=self.il_trainer.cur_state - 1)
         cur_dataset = self.il_trainer.dataset_train
         self.il_trainer.dataset_train = dataset
@@ -181,14 +181,14 @@ class Herd_sampler(object):
         all_classes = set(self.il_trainer.params.states[-1]['knowing_class']['id'])
         cur_knowing_classes = set(self.il_trainer.params.states[self.il_trainer.cur_state - 1]['knowing_class']['id'])
         future_cat_ids = list(all_classes - cur_knowing_classes)
-        future_img_ids = dataset.coco.get_imgs_by_cats(future_cat_ids)
+        is_future_img = dataset.coco.contains_cats(dataset.image_ids, future_cat_ids)
 
         scores = {cat_id:dict() for cat_id in classified_imgs.keys()}
 
         for idx in range(len(dataset)):
             img_id = dataset.image_ids[idx]
             # if image isn't assigned a class or contains the foreground for future class, then ignore
-            if not reverse_classified_imgs.get(img_id) or img_id in future_img_ids:
+            if not reverse_classified_imgs.get(img_id) or is_future_img[idx]:
                 continue
 
             data = dataset[idx]
@@ -219,7 +219,7 @@ class Herd_sampler(object):
             img_area = img_info['width'] * img_info['height']
 
             #calculate the area of the foreground
-            annots = self.il_trainer.dataset_train.load_annotations(idx)
+            annots, _ = self.il_trainer.dataset_train.load_annotations(idx)
             annots = annots[annots[:,-1] != -1]
             labels = annots[:,-1].astype('int') # get lables for annotations 
             
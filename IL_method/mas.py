@@ -4,6 +4,8 @@ from matplotlib.pyplot import fill
 import torch
 import torch.nn as nn
 from preprocessing.debug import debug_print, DEBUG_FLAG
+from retinanet.dataloader import prepare_img_batch
+from retinanet.matcher import Anchor_matcher
 
 FILE_NAME = "mas_importance.pickle"
 
@@ -12,56 +14,22 @@ def fast_zero_grad(model):
     for param in model.parameters():
         param.grad = None
 
-def calc_iou(a, b):
-    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
-
-    iw = torch.min(torch.unsqueeze(a[:, 2], dim=1), b[:, 2]) - torch.max(torch.unsqueeze(a[:, 0], 1), b[:, 0])
-    ih = torch.min(torch.unsqueeze(a[:, 3], dim=1), b[:, 3]) - torch.max(torch.unsqueeze(a[:, 1], 1), b[:, 1])
-
-    iw = torch.clamp(iw, min=0)
-    ih = torch.clamp(ih, min=0)
-
-    ua = torch.unsqueeze((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]), dim=1) + area - iw * ih
-
-    ua = torch.clamp(ua, min=1e-8)
-
-    intersection = iw * ih
-
-    IoU = intersection / ua
-
-    return IoU
-
-
 class Output_norm(nn.Module):
+    def __init__(self):
+        super(Output_norm, self).__init__()
+        self.matcher = Anchor_matcher()
+
     def forward(self, classifications, regressions, anchors, annotations):
         batch_size = classifications.shape[0]
         result = dict()
 
-        result['regression'] = torch.tensor(0).float().cuda()
-        # result['classification'] = torch.tensor(0).float().cuda()
-        for j in range(batch_size):
-            classification = classifications[j, :, :]
-            regression = regressions[j, :, :]
-            bbox_annotation = annotations[j, :, :]
-            bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
-            
-            IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4]) # shape=(num_anchors, num_annotations)
-            IoU_max, IoU_argmax = torch.max(IoU, dim=1) # shape=(num_anchors x 1)
-            
-            positive_indices = torch.ge(IoU_max, 0.5) 
-
-            # compute the loss for regression
-            if positive_indices.sum() > 0:
-                regression = regression[positive_indices, :]
-                result['regression'] += torch.mean(regression.abs())
-                
-                
-                # result['classification'] += torch.sum(torch.pow(classification, 2))
-        
-        result['regression'] /= batch_size
-        # result['classification'] /= batch_size
-        #torch.sum(classifications.pow_(2),dim=1)
-        
+        positive_indices = self.matcher(anchors, annotations).positive # shape = (batch_size, num_anchors)
+
+        # the mean of abs regression on the positive anchors of each image, the image without positive anchor is skipped
+        num_values = positive_indices.sum(dim=1) * regressions.shape[2]
+        regression = (regressions.abs().sum(dim=2) * positive_indices).sum(dim=1)
+        regression = torch.where(num_values > 0, regression / torch.clamp(num_values, min=1), torch.zeros_like(regression))
+        result['regression'] = regression.sum() / batch_size
 
         result['classification'] = torch.sum(torch.pow(classifications, 2)) / (batch_size * classifications.shape[2])
         return result
@@ -105,7 +73,7 @@ class MAS(object):
             with torch.cuda.device(0):
                 fast_zero_grad(self.model)
                 try:
-                    classifications, regressions, anchors=  self.model(data['img'].float().cuda(),
+                    classifications, regressions, anchors=  self.model(prepare_img_batch(data['img']),
                                                                 return_feat=False, 
                                                                 return_anchor=True, 
                                                                 enable_act=True)
@@ -3,11 +3,10 @@ import pickle
 from preprocessing.params import create_dir
 from retinanet.dataloader import IL_dataset
 import torchvision
-from torchvision import transforms
 import torch
 
-from retinanet.dataloader import Resizer,  Normalizer
-from retinanet.losses import calc_iou
+from retinanet.dataloader import get_transform, get_resize_backend
+from retinanet.matcher import calc_iou
 
 DEFAULT_SCORE_THRESOLD = 0.7
 DEFAULT_IOU_THRESOLD = 0.35
@@ -23,7 +22,7 @@ class Labeler():
 
     def get_persuado_label(self, state:int):
         dataset = IL_dataset(self.params,
-                            transform=transforms.Compose([Normalizer(), Resizer()]),
+                            transform=get_transform(resize_backend=get_resize_backend(self.params)),
                             start_state=state)
 
         path = os.path.join(self.params['ckp_path'], 'state{}'.format(state))
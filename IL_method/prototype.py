@@ -5,45 +5,28 @@ import torch.nn as nn
 import os
 import pickle
 
-from torch.utils.data.dataloader import DataLoader
 
-from torchvision import transforms
 
 # my package
-from retinanet.losses import calc_iou
-from retinanet.dataloader import IL_dataset, Resizer, Augmenter, Normalizer, collater, AspectRatioBasedSampler
+from retinanet.matcher import Anchor_matcher
+from retinanet.dataloader import IL_dataset, AspectRatioBasedSampler, get_transform, get_resize_backend, prepare_img_batch, create_dataloader
 from preprocessing.params import create_dir
 
 class ProtoTyper(object):
     def __init__(self, il_trainer, thresold = 0.5):
         self.il_trainer = il_trainer
         self.thresold = thresold
+        self.matcher = Anchor_matcher(positive_thresold=thresold)
         self.num_anchors = self.il_trainer.model.classificationModel.num_anchors
         self.prototype_features = None
 
     def _get_positive(self, anchors, annotations):
-
+        assignment = self.matcher(anchors, annotations)
         batch_size = annotations.shape[0]
-        
-        positive_indices = []
-        targets = []
-        
-        for j in range(batch_size):
-            bbox_annotation = annotations[j, :, :]
-            bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
-            IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4]) # shape=(num_anchors, num_annotations)
-            IoU_max, IoU_argmax = torch.max(IoU, dim=1) # shape=(num_anchors x 1)
-            
-            pos_indices = torch.ge(IoU_max, self.thresold).view(-1, self.num_anchors)
-            target = bbox_annotation[IoU_argmax, 4].view(-1, self.num_anchors)
-            
-            #store the postive anchor and its class
-            positive_indices.append(pos_indices.unsqueeze(dim=0))
-            targets.append(target.long().unsqueeze(dim=0))
-        
-        positive_indices = torch.cat(positive_indices)
-        targets = torch.cat(targets)
 
+        #the postive anchors and their classes
+        positive_indices = assignment.positive.view(batch_size, -1, self.num_anchors)
+        targets = assignment.labels.view(batch_size, -1, self.num_anchors)
         return positive_indices, targets
 
     def _cal_features(self, feature_temp_path:str, state:int):
@@ -54,19 +37,18 @@ class ProtoTyper(object):
 
     
         dataset = IL_dataset(self.il_trainer.params,
-                    transform=transforms.Compose([Normalizer(), Resizer()]),
+                    transform=get_transform(uint8=self.il_trainer.params['uint8_collate'], resize_backend=get_resize_backend(self.il_trainer.params)),
                     start_state=state)
 
         # create the dataloader for cal the features
-        sampler = AspectRatioBasedSampler(dataset, batch_size = self.il_trainer.params['batch_size'], drop_last=False, shuffle=False)
-        dataloader = DataLoader(dataset, num_workers=2, collate_fn=collater, batch_sampler=sampler)
+        dataloader = create_dataloader(self.il_trainer.params, dataset, self.il_trainer.params['batch_size'], shuffle=False)
         model = self.il_trainer.model
         num_classes = model.classificationModel.num_classes
 
-        batch_size = self.il_trainer.params['batch_size']
+        iter_num = 0
         for idx, data in enumerate(dataloader):
             with torch.no_grad():
-                img_batch = data['img'].float().cuda()
+                img_batch = prepare_img_batch(data['img'])
                 annot = data['annot'].cuda()
                 
                 # get features from the classification head
@@ -74,13 +56,11 @@ class ProtoTyper(object):
                 positive_indices, targets = self._get_positive(anchors, annot)
 
                   
-                for batch_id in range(batch_size):
+                for batch_id in range(features.shape[0]):
                     # init data for each img
                     count = torch.zeros(num_classes, self.num_anchors, 1).cuda()
                     prototype_features = torch.zeros(num_classes, self.num_anchors, 256 * self.num_anchors).cuda()
                     
-                    iter_num = idx * batch_size + batch_id
-                    
                     # get each img's data in minibatch
                     feature = features[batch_id,...]
                     pos = positive_indices[batch_id,...]
@@ -100,6 +80,7 @@ class ProtoTyper(object):
                     # store the features and positive anchors's number
                     with open(os.path.join(feature_temp_path, 'f_{}.pickle'.format(iter_num)), 'wb') as f:
                         pickle.dump((prototype_features.cpu(), count.cpu()), f)
+                    iter_num += 1
 
         del dataloader
         del dataset
@@ -191,9 +172,10 @@ class ProtoTyper(object):
 
 
         dataset = IL_dataset(self.il_trainer.params,
-                            transform=transforms.Compose([Normalizer(), Resizer()]),
+                            transform=get_transform(resize_backend=get_resize_backend(self.il_trainer.params)),
                             start_state=state)
-        sampler = AspectRatioBasedSampler(dataset, batch_size = self.il_trainer.params['batch_size'], drop_last=False, shuffle=False)
+        # the same groups as the dataloader in _cal_features
+        sampler = AspectRatioBasedSampler(dataset, batch_size = self.il_trainer.params['batch_size'], drop_last=False, shuffle=False, batch_pixels=self.il_trainer.params['batch_pixels'])
         # mapping index to real image id
         img_ids = []
         for group in sampler.groups:
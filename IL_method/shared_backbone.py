@@ -0,0 +1,80 @@
+import torch
+import torch.nn as nn
+
+BACKBONE_LAYERS = ['conv1', 'bn1', 'layer1', 'layer2', 'layer3', 'layer4']
+FPN_LAYERS = ['fpn']
+
+def is_frozen_copy(student, teacher, layer_names:list):
+    """whether the layers of student are frozen and have the same parameters and buffers as the teacher
+    """
+    for name in layer_names:
+        student_layer = getattr(student, name, None)
+        teacher_layer = getattr(teacher, name, None)
+        if student_layer == None or teacher_layer == None:
+            return False
+        if any(p.requires_grad for p in student_layer.parameters()):
+            return False
+        # BatchNorm in training mode normalizes by the batch statistics, unlike the teacher in eval mode
+        if any(m.training for m in student_layer.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)):
+            return False
+
+        student_state, teacher_state = student_layer.state_dict(), teacher_layer.state_dict()
+        if student_state.keys() != teacher_state.keys():
+            return False
+        for key, value in student_state.items():
+            other = teacher_state[key]
+            if value.shape != other.shape or value.dtype != other.dtype or not torch.equal(value, other.to(value.device)):
+                return False
+    return True
+
+def get_shared_level(student, teacher):
+    """
+        Return:
+            'fpn' if the backbone and FPN of student are frozen copies of the teacher,
+            'backbone' if only the backbone is, otherwise None
+    """
+    if not is_frozen_copy(student, teacher, BACKBONE_LAYERS):
+        return None
+    if is_frozen_copy(student, teacher, FPN_LAYERS):
+        return 'fpn'
+    return 'backbone'
+
+def get_layers_version(model, layer_names:list):
+    """the sum of the versions of parameters and buffers, which is increased by any in-place update, e.g. optimizer step
+    """
+    version = 0
+    for name in layer_names:
+        layer = getattr(model, name)
+        version += sum(p._version for p in layer.parameters())
+        version += sum(b._version for b in layer.buffers())
+    return version
+
+class Shared_backbone(object):
+    """Check whether the teacher can reuse the frozen activations of student, e.g. in warm-up stages
+
+        The weights are compared when the student, the teacher or the warm stage is changed,
+        and the versions of the compared tensors are checked before each use, so any update triggers the comparison again.
+    """
+    def __init__(self):
+        self.key = None
+        self.level = None
+        self.version = None
+
+    def get_level(self, student, teacher, warm_stage:int):
+        """
+            Return:
+                'fpn', 'backbone' or None, see get_shared_level()
+        """
+        key = (id(student), id(teacher), warm_stage)
+        if key == self.key and self.version == self._version(student, teacher):
+            return self.level
+
+        self.key = key
+        self.level = get_shared_level(student, teacher)
+        self.version = self._version(student, teacher)
+        return self.level
+
+    @staticmethod
+    def _version(student, teacher):
+        layer_names = BACKBONE_LAYERS + FPN_LAYERS
+        return (get_layers_version(student, layer_names), get_layers_version(teacher, layer_names))
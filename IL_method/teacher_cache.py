@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import torch
+
+FG_THRESHOLD = 0.05 # the score threshold of teacher foreground, the same as distillation loss
+BG_LOGIT = -100.0 # the logit of the anchors which aren't stored, its score is far below FG_THRESHOLD
+DEFAULT_MAX_MB = 2048 # the default memory limit of the records
+
+class Teacher_cache(object):
+    """Cache the outputs of the frozen previous model for distillation
+
+        The teacher outputs of an image only depend on the image, the flip, the resize scale and the padded batch shape,
+        so the key is (img_id, flip, scale, rows, cols). Only the anchors whose max score > FG_THRESHOLD are stored,
+        which are all anchors used by the distillation losses, with their logits and regression outputs.
+        The FPN features aren't stored, they are still computed by the teacher for the feature loss.
+        The records are kept in host memory up to max_bytes, and the least recently used records are evicted.
+    """
+    def __init__(self, max_mb=DEFAULT_MAX_MB):
+        """
+            Args:
+                max_mb: the memory limit of the records in MB, default = 2048
+        """
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.records = OrderedDict()
+        self.num_bytes = 0
+        self.state = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def clear(self):
+        self.records = OrderedDict()
+        self.num_bytes = 0
+
+    def set_state(self, state:int):
+        """the teacher is changed in a new state, so clear the records of the previous state
+        """
+        if self.state != state:
+            self.clear()
+            self.state = state
+
+    def get(self, keys:list, device):
+        """
+            Return:
+                (classification, regression), the dense logits and regression outputs of the batch,
+                None if any image of the batch isn't cached
+        """
+        if any(key not in self.records for key in keys):
+            self.misses += len(keys)
+            return None
+        self.hits += len(keys)
+
+        records = []
+        for key in keys:
+            self.records.move_to_end(key)
+            records.append(self.records[key])
+        batch_size = len(records)
+        num_anchors = records[0]['num_anchors']
+        num_classes = records[0]['logits'].shape[1]
+        classification = torch.full((batch_size, num_anchors, num_classes), BG_LOGIT, device=device)
+        regression = torch.zeros((batch_size, num_anchors, 4), device=device)
+        for j, record in enumerate(records):
+            index = record['index'].to(device)
+            classification[j, index] = record['logits'].to(device)
+            regression[j, index] = record['regression'].to(device)
+        return classification, regression
+
+    def put(self, keys:list, classification, regression):
+        """store the teacher outputs of the batch, and evict the least recently used records if the memory limit is exceeded
+            Args:
+                classification: (batch_size, num_anchors, num_classes) the logits
+                regression: (batch_size, num_anchors, 4)
+        """
+        fg_mask = (torch.sigmoid(classification) > FG_THRESHOLD).any(dim=2)
+        for j, key in enumerate(keys):
+            index = fg_mask[j].nonzero()[:, 0]
+            record = {'index': index.cpu(),
+                      'logits': classification[j, index].cpu(),
+                      'regression': regression[j, index].cpu(),
+                      'num_anchors': classification.shape[1]}
+            record['bytes'] = sum(record[name].numel() * record[name].element_size() for name in ('index', 'logits', 'regression'))
+            if key in self.records:
+                self.num_bytes -= self.records.pop(key)['bytes']
+            self.records[key] = record
+            self.num_bytes += record['bytes']
+
+        while self.num_bytes > self.max_bytes and len(self.records) != 0:
+            _, record = self.records.popitem(last=False)
+            self.num_bytes -= record['bytes']
@@ -0,0 +1,120 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from retinanet.dataloader import prepare_img_batch
+
+DEFAULT_DEPTH = 1 # the number of batches whose teacher outputs are computed ahead
+
+class Teacher_outputs(object):
+    """The pending outputs of previous model for a batch, which are computed on a side stream or in a thread
+    """
+    def __init__(self, outputs=None, event=None, future=None):
+        self.outputs = outputs
+        self.event = event
+        self.future = future
+
+    def get(self):
+        """wait for the teacher, and return (prev_classification, prev_regression, prev_features)
+        """
+        if self.future != None:
+            self.outputs = self.future.result()
+            self.future = None
+        if self.event != None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_event(self.event)
+            prev_classification, prev_regression, prev_features = self.outputs
+            # the tensors allocated on the side stream are used by the current stream
+            for tensor in [prev_classification, prev_regression] + list(prev_features):
+                tensor.record_stream(current_stream)
+            self.event = None
+        return self.outputs
+
+class Teacher_pipeline(object):
+    """Wrap the batches, and run the previous model on the next batches while the current batch is trained
+
+        The yielded batch has 'teacher', the Teacher_outputs of the batch, and its 'img' and 'annot' are on the device.
+        The batch augmenter is applied here before the teacher, so 'augmented' is True.
+        On GPU, the teacher runs on a side stream, on CPU, it runs in a thread.
+    """
+    def __init__(self, batches, prev_model, batch_augmenter=None, depth=DEFAULT_DEPTH):
+        """
+            Args:
+                batches: the DataLoader or Batch_prefetcher
+                prev_model: the frozen previous model
+                batch_augmenter: the Batch_augmenter of training, default = None
+                depth: the number of batches computed ahead, default = 1
+        """
+        self.batches = batches
+        self.prev_model = prev_model
+        self.batch_augmenter = batch_augmenter
+        self.depth = depth
+        self.device = next(prev_model.parameters()).device
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            stream = torch.cuda.Stream(self.device)
+            run = lambda img_batch: self._run_stream(img_batch, stream)
+            return self._iter(run)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        run = lambda img_batch: Teacher_outputs(future=executor.submit(self._forward, img_batch))
+        return self._iter(run, executor)
+
+    def _iter(self, run, executor=None):
+        iterator = iter(self.batches)
+        pending = deque()
+        def launch():
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return False
+            data = dict(data)
+            img_batch, annots = prepare_img_batch(data['img'], self.device), data['annot'].to(self.device)
+            if self.batch_augmenter != None:
+                img_batch, annots = self.batch_augmenter(img_batch, annots, data['shape'])
+            data['img'], data['annot'], data['augmented'] = img_batch, annots, True
+            data['teacher'] = run(img_batch)
+            pending.append(data)
+            return True
+
+        try:
+            while len(pending) < max(1, self.depth) and launch():
+                pass
+            while len(pending) != 0:
+                data = pending.popleft()
+                # the teacher of the next batch is queued before the current batch is trained
+                launch()
+                yield data
+        finally:
+            if executor != None:
+                executor.shutdown(wait=True)
+
+    def _forward(self, img_batch):
+        with torch.no_grad():
+            return self.prev_model(img_batch, return_feat=True, return_anchor=False, enable_act=False)
+
+    def _run_stream(self, img_batch, stream):
+        # the batch is prepared on the current stream
+        stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(stream):
+            outputs = self._forward(img_batch)
+            event = torch.cuda.Event()
+            event.record(stream)
+        img_batch.record_stream(stream)
+        return Teacher_outputs(outputs, event=event)
+
+def teacher_pipeline(il_trainer, batches, warm_classifier=False):
+    """wrap the training batches by Teacher_pipeline if params['teacher_pipeline'] and the distillation loss is computed
+        Args:
+            il_trainer: IL_Trainer
+            batches: the DataLoader or Batch_prefetcher of training dataset
+            warm_classifier: whether the classifier is in warm up stage, which doesn't compute distillation loss
+    """
+    params = il_trainer.params
+    if not params['teacher_pipeline'] or not params['distill'] or il_trainer.cur_state == 0 or warm_classifier:
+        return batches
+    return Teacher_pipeline(batches, il_trainer.prev_model, il_trainer.batch_augmenter)
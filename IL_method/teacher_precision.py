@@ -0,0 +1,128 @@
+import copy
+import torch
+import torch.nn as nn
+
+from retinanet.dataloader import prepare_img_batch
+
+TEACHER_PRECISIONS = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+FG_THRESHOLD = 0.05 # the score threshold of teacher foreground in distillation loss
+
+def fold_batchnorm(model:nn.Module):
+    """fold the frozen BatchNorm layers into the previous convolutions, and replace them by nn.Identity
+        The pairs are (convN, bnN) in the same module and (conv, bn) next to each other in nn.Sequential, like ResNet
+    """
+    def fold(conv:nn.Conv2d, bn:nn.BatchNorm2d):
+        scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias.data if conv.bias != None else torch.zeros_like(bn.running_mean)
+        conv.weight.data = conv.weight.data * scale.view(-1, 1, 1, 1)
+        conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias.data)
+
+    num_folded = 0
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            children = list(module.named_children())
+            for (_, conv), (name, bn) in zip(children[:-1], children[1:]):
+                if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                    fold(conv, bn)
+                    setattr(module, name, nn.Identity())
+                    num_folded += 1
+            continue
+        for name, bn in list(module.named_children()):
+            if not isinstance(bn, nn.BatchNorm2d) or not name.startswith('bn'):
+                continue
+            conv = getattr(module, 'conv' + name[2:], None)
+            if isinstance(conv, nn.Conv2d):
+                fold(conv, bn)
+                setattr(module, name, nn.Identity())
+                num_folded += 1
+    return num_folded
+
+class Low_precision_teacher(nn.Module):
+    """The frozen previous model for inference in reduced precision, BatchNorm is folded into convolutions
+        The inputs are cast to the precision, and the outputs are cast back to float32,
+        so it can replace the previous model in distillation
+    """
+    def __init__(self, model:nn.Module, precision='fp16'):
+        super(Low_precision_teacher, self).__init__()
+        if precision not in TEACHER_PRECISIONS:
+            raise ValueError("Unknown teacher precision:{}, must be one of {}".format(precision, list(TEACHER_PRECISIONS.keys())))
+        self.precision = precision
+        self.dtype = TEACHER_PRECISIONS[precision]
+        model.eval()
+        fold_batchnorm(model)
+        self.model = model.to(self.dtype)
+        for p in self.model.parameters():
+            p.requires_grad = False
+
+    def __getattr__(self, name):
+        # the other attributes of the previous model, e.g. classificationModel
+        try:
+            return super(Low_precision_teacher, self).__getattr__(name)
+        except AttributeError:
+            if name == 'model':
+                raise
+            return getattr(self.model, name)
+
+    def forward(self, img_batch, return_feat=False, return_anchor=True, enable_act=True):
+        result = self.model(img_batch.to(self.dtype), return_feat=return_feat, return_anchor=False, enable_act=enable_act)
+        result = [result[0].float(), result[1].float()] + ([[feature.float() for feature in result[2]]] if return_feat else [])
+        # anchors are float32 and only depend on the shape
+        if return_anchor:
+            result.append(self.model.anchors(img_batch))
+        return tuple(result)
+
+    def forward_feature(self, img_batch):
+        return [feature.float() for feature in self.model.forward_feature(img_batch.to(self.dtype))]
+
+def measure_teacher_error(model:nn.Module, teacher:nn.Module, batches, num_batches:int):
+    """compare the outputs of the float32 model and the low precision teacher on some batches
+        Return:
+            a dict of the max absolute errors of 'logits', 'scores', 'regression', the max relative error of 'features',
+            and 'fg_flip', the ratio of anchors whose teacher foreground (score > 0.05) is changed
+    """
+    device = next(model.parameters()).device
+    errors = {'logits': 0.0, 'scores': 0.0, 'regression': 0.0, 'features': 0.0, 'fg_flip': 0.0}
+    num_anchors = 0
+    num_flips = 0
+    with torch.no_grad():
+        for idx, data in enumerate(batches):
+            if idx >= num_batches:
+                break
+            img_batch = prepare_img_batch(data['img'], device)
+            classification, regression, features = model(img_batch, return_feat=True, return_anchor=False, enable_act=False)
+            low_classification, low_regression, low_features = teacher(img_batch, return_feat=True, return_anchor=False, enable_act=False)
+
+            errors['logits'] = max(errors['logits'], float((classification - low_classification).abs().max()))
+            scores, low_scores = torch.sigmoid(classification), torch.sigmoid(low_classification)
+            errors['scores'] = max(errors['scores'], float((scores - low_scores).abs().max()))
+            errors['regression'] = max(errors['regression'], float((regression - low_regression).abs().max()))
+            for feature, low_feature in zip(features, low_features):
+                relative = (feature - low_feature).abs().max() / feature.abs().max().clamp(min=1e-12)
+                errors['features'] = max(errors['features'], float(relative))
+
+            fg_mask = (scores > FG_THRESHOLD).any(dim=2)
+            low_fg_mask = (low_scores > FG_THRESHOLD).any(dim=2)
+            num_flips += int((fg_mask != low_fg_mask).sum())
+            num_anchors += fg_mask.numel()
+    errors['fg_flip'] = num_flips / max(num_anchors, 1)
+    return errors
+
+def create_teacher(model:nn.Module, precision:str, batches=None, num_calibration_batches=0):
+    """convert the previous model to the teacher of the precision, and print the measured error on some batches
+        Args:
+            model: the float32 previous model, it is converted in place
+            precision: 'fp32', 'fp16' or 'bf16', the model is returned without change for 'fp32'
+            batches: the batches for measuring the error, e.g. the DataLoader of training
+            num_calibration_batches: the number of batches for measuring the error, 0 means not measure
+    """
+    if precision == 'fp32':
+        return model
+    reference = copy.deepcopy(model) if batches != None and num_calibration_batches > 0 else None
+    teacher = Low_precision_teacher(model, precision)
+    if reference != None:
+        reference.eval()
+        errors = measure_teacher_error(reference, teacher, batches, num_calibration_batches)
+        del reference
+        print('Teacher in {}: max error of logits {:.2e}, scores {:.2e}, regression {:.2e}, features {:.2e} (relative), foreground changed on {:.3%} anchors'.format(
+                precision, errors['logits'], errors['scores'], errors['regression'], errors['features'], errors['fg_flip']))
+    return teacher
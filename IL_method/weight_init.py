@@ -1,34 +1,16 @@
 
 import torch
-from torchvision import transforms
-from retinanet.dataloader import Resizer, Augmenter, Normalizer
+from retinanet.dataloader import get_transform
+from retinanet.matcher import Anchor_matcher
 THRESOLD = 0.5
 
-def calc_iou(a, b):
-    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
-
-    iw = torch.min(torch.unsqueeze(a[:, 2], dim=1), b[:, 2]) - torch.max(torch.unsqueeze(a[:, 0], 1), b[:, 0])
-    ih = torch.min(torch.unsqueeze(a[:, 3], dim=1), b[:, 3]) - torch.max(torch.unsqueeze(a[:, 1], 1), b[:, 1])
-
-    iw = torch.clamp(iw, min=0)
-    ih = torch.clamp(ih, min=0)
-
-    ua = torch.unsqueeze((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]), dim=1) + area - iw * ih
-
-    ua = torch.clamp(ua, min=1e-8)
-
-    intersection = iw * ih
-
-    IoU = intersection / ua
-
-    return IoU
-
 def get_similarity(model, dataset_train, thresold=THRESOLD):
     new_class_num = len(dataset_train.seen_class_id)
     old_class_num = model.num_classes
 
     # not use Augmenter
-    dataset_train.transform = transforms.Compose([Normalizer(), Resizer()])
+    prev_transform = dataset_train.transform
+    dataset_train.transform = get_transform(resize_backend=dataset_train.resize_backend)
     weight_similarity  =  Weight_similarity(model, new_class_num, old_class_num, thresold)
 
     img_count = torch.zeros(new_class_num, device=torch.device('cuda:0'))
@@ -63,7 +45,7 @@ def get_similarity(model, dataset_train, thresold=THRESOLD):
 
     similaritys /= img_count.unsqueeze(dim=1)
 
-    dataset_train.transform = transforms.Compose([Normalizer(), Augmenter(), Resizer()])
+    dataset_train.transform = prev_transform
 
     # discard very low category
     similaritys = torch.where(similaritys > 0.05, similaritys, torch.zeros(similaritys.shape, device=torch.device('cuda:0')))
@@ -78,6 +60,7 @@ class Weight_similarity(object):
         self.new_class_num = new_class_num
         self.old_class_num = old_class_num
         self.thresold = thresold
+        self.matcher = Anchor_matcher()
 
     def forward(self, img_batch, annotations):
         classifications, _ , anchors = self.model(img_batch, 
@@ -86,19 +69,13 @@ class Weight_similarity(object):
                                                     enable_act=True)
     
         classification = classifications[0, :, :]
-        bbox_annotation = annotations[0, :, :]
-        bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
-            
         classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
 
-        if bbox_annotation.shape[0] == 0:  
+        assignment = self.matcher(anchors, annotations)
+        if assignment.num_gt[0] == 0:  
             return
-        
 
-        IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4]) # shape=(num_anchors, num_annotations)
-        IoU_max, IoU_argmax = torch.max(IoU, dim=1) # shape=(num_anchors x 1)
-        
-        positive_indices = torch.ge(IoU_max, 0.5)
+        positive_indices = assignment.positive[0]
         
         greater = torch.ge(torch.sum(classification, dim = 1), self.thresold)
         
@@ -106,11 +83,9 @@ class Weight_similarity(object):
         
         classification = classification[indices,:]
         
-        IoU_max = IoU_max[indices]
-
         classification = classification[:,:] / torch.sum(classification, dim = 1).unsqueeze(dim=1)
         # ground truth label
-        assigned_annotations = bbox_annotation[IoU_argmax, :][indices,4]
+        assigned_annotations = assignment.labels[0][indices].float()
         
         return classification, assigned_annotations
 
@@ -0,0 +1,59 @@
+import argparse
+import os
+import time
+# retinanet
+from retinanet.decoder import DECODERS, create_decoder
+from retinanet.dataloader import MIN_SIDE, MAX_SIDE, get_resize_scale
+
+ROOT_DIR = "/home/deeplab307/Documents/Anaconda/Shiang/IL/"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def get_parser(args=None):
+    parser = argparse.ArgumentParser(description="report the decoding speed (images/sec) of each image decoder")
+    parser.add_argument('--dataset', help='Dataset name, must contain name and years, for instance: voc2007,voc2012', default='voc2007')
+    parser.add_argument('--root_dir', help='the root dir for training', default=ROOT_DIR)
+    parser.add_argument('--image_dir', help='the directory of images, default is root_dir/dataset/<dataset>/images', default=None)
+    parser.add_argument('--num_images', help='the number of images for benchmark, default = 200', type=int, default=200)
+    parser.add_argument('--decoders', help='the decoders for benchmark, default = all decoders', nargs='+', default=list(DECODERS.keys()))
+    parser.add_argument('--min_side', type=int, default=MIN_SIDE)
+    parser.add_argument('--max_side', type=int, default=MAX_SIDE)
+    return vars(parser.parse_args(args))
+
+def benchmark(decoder, paths:list, sizes:dict, min_side:int, max_side:int):
+    """decode all images and return images/sec, each image is decoded near the size for Resizer
+        Args:
+            sizes: path -> (width, height) of the origin image
+    """
+    start = time.time()
+    for path in paths:
+        width, height = sizes[path]
+        decoder(path, get_resize_scale(height, width, min_side, max_side))
+    return len(paths) / (time.time() - start)
+
+def main(args=None):
+    parser = get_parser(args)
+    image_dir = parser['image_dir']
+    if image_dir == None:
+        image_dir = os.path.join(parser['root_dir'], 'dataset', parser['dataset'], 'images')
+
+    paths = sorted(os.path.join(image_dir, name) for name in os.listdir(image_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+    paths = paths[:parser['num_images']]
+    if len(paths) == 0:
+        raise ValueError("No image in {}".format(image_dir))
+
+    # the origin size of images, like the width and height in annotations
+    sizes = {}
+    for path in paths:
+        img, _ = create_decoder('skimage')(path)
+        sizes[path] = (img.shape[1], img.shape[0])
+
+    print('Benchmark on {} images in {}'.format(len(paths), image_dir))
+    for name in parser['decoders']:
+        decoder = create_decoder(name)
+        # warm up the page cache and the decoder
+        benchmark(decoder, paths[:min(10, len(paths))], sizes, parser['min_side'], parser['max_side'])
+        speed = benchmark(decoder, paths, sizes, parser['min_side'], parser['max_side'])
+        print('{:<10} {:>8.1f} images/sec'.format(name, speed))
+
+if __name__ == '__main__':
+    main()
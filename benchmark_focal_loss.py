@@ -0,0 +1,79 @@
+import argparse
+import time
+import torch
+# retinanet
+from retinanet.anchors import Anchors
+from retinanet.matcher import Anchor_matcher
+from retinanet.lean_focal_loss import dense_focal_loss, lean_focal_loss, CHUNK_ELEMENTS
+
+def get_parser(args=None):
+    parser = argparse.ArgumentParser(description="compare the dense focal loss and the lean focal loss on CPU: time, saved memory for backward and differences")
+    parser.add_argument('--num_classes', help='the numbers of classes for benchmark, default = 20 80', type=int, nargs='+', default=[20, 80])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--image_size', help='the rows and cols of the input batch, default = 608 800', type=int, nargs=2, default=[608, 800])
+    parser.add_argument('--num_boxes', help='the number of annotations of each image, default = 8', type=int, default=8)
+    parser.add_argument('--chunk_elements', help='the number of scores in a chunk of lean focal loss, default = 2^20', type=int, default=CHUNK_ELEMENTS)
+    parser.add_argument('--repeat', type=int, default=5)
+    return vars(parser.parse_args(args))
+
+def random_annotations(batch_size:int, num_boxes:int, num_classes:int, rows:int, cols:int):
+    xy = torch.rand(batch_size, num_boxes, 2) * torch.tensor([cols * 0.8, rows * 0.8])
+    wh = torch.rand(batch_size, num_boxes, 2) * torch.tensor([cols * 0.3, rows * 0.3]) + 16
+    labels = torch.randint(0, num_classes, (batch_size, num_boxes, 1)).float()
+    return torch.cat((xy, xy + wh, labels), dim=2)
+
+def run(loss_fn, logits, loss_args:tuple):
+    """run forward and backward once
+        Return:
+            (bg_losses, fg_losses, grad, saved_bytes, seconds)
+    """
+    saved_bytes = [0]
+    def pack(tensor):
+        saved_bytes[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    logits = logits.detach().requires_grad_()
+    start = time.time()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        classifications = torch.sigmoid(logits)
+        bg_losses, fg_losses = loss_fn(classifications, *loss_args)
+    (bg_losses.sum() + fg_losses.sum()).backward()
+    return bg_losses.detach(), fg_losses.detach(), logits.grad, saved_bytes[0], time.time() - start
+
+def main(args=None):
+    parser = get_parser(args)
+    torch.manual_seed(0)
+    rows, cols = parser['image_size']
+    batch_size = parser['batch_size']
+    anchors = Anchors()(torch.zeros(1, 3, rows, cols))
+    num_anchors = anchors.shape[1]
+    print('Benchmark on CPU, batch size = {}, {} anchors per image'.format(batch_size, num_anchors))
+
+    for num_classes in parser['num_classes']:
+        annotations = random_annotations(batch_size, parser['num_boxes'], num_classes, rows, cols)
+        assignment = Anchor_matcher()(anchors, annotations)
+        labels = assignment.labels.masked_fill(~assignment.positive, -1)
+        bg_from = torch.full((batch_size, num_anchors), num_classes, dtype=torch.long)
+        bg_from[assignment.negative | assignment.positive] = 0
+        alpha_factor = torch.full((batch_size,), 0.25)
+        logits = torch.randn(batch_size, num_anchors, num_classes) - 4
+
+        lean_fn = lambda classifications, *loss_args: lean_focal_loss(classifications, *loss_args, chunk_elements=parser['chunk_elements'])
+        results = {}
+        for name, loss_fn in (('dense', dense_focal_loss), ('lean', lean_fn)):
+            run(loss_fn, logits, (labels, bg_from, alpha_factor, 2.0))
+            seconds = []
+            for _ in range(parser['repeat']):
+                result = run(loss_fn, logits, (labels, bg_from, alpha_factor, 2.0))
+                seconds.append(result[4])
+            results[name] = result
+            print('{:>3} classes {:<6} {:>8.1f} ms  {:>8.1f} MB saved for backward'.format(num_classes, name,
+                                                                                        1000 * sum(seconds) / len(seconds), result[3] / 2 ** 20))
+
+        dense, lean = results['dense'], results['lean']
+        loss_diff = max(float((dense[i] - lean[i]).abs().max() / dense[i].abs().max().clamp(min=1e-12)) for i in range(2))
+        grad_diff = float((dense[2] - lean[2]).abs().max() / dense[2].abs().max().clamp(min=1e-12))
+        print('{:>3} classes relative difference: loss {:.2e}, gradient {:.2e}'.format(num_classes, loss_diff, grad_diff))
+
+if __name__ == '__main__':
+    main()
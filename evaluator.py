@@ -12,12 +12,11 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime 
 # torch
 import torch
-from torchvision import transforms
 # pycocotools
 from pycocotools.cocoeval import COCOeval
 
 # retinanet
-from retinanet.dataloader import IL_dataset, Resizer, Normalizer
+from retinanet.dataloader import IL_dataset, get_transform, get_resize_backend
 from retinanet.model import create_retinanet
 from preprocessing.params import Params, create_dir
 
@@ -255,12 +254,12 @@ class Evaluator(Params):
     def init_dataset(self):
         if self['eval_on_train']:
             self.dataset = IL_dataset(self,
-                                    transform=transforms.Compose([Normalizer(), Resizer()]),
+                                    transform=get_transform(resize_backend=get_resize_backend(self)),
                                     start_state=self['state'],
                                     use_all_class=True)
         else:
             self.dataset = IL_dataset(self,
-                                    transform=transforms.Compose([Normalizer(), Resizer()]),
+                                    transform=get_transform(resize_backend=get_resize_backend(self)),
                                     start_state=self['state'])
     def get_result_path(self, epoch:int):
         """
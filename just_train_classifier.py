@@ -6,11 +6,10 @@ from evaluator import Evaluator
 # torch 
 import torch
 import torch.optim as optim
-from torchvision import transforms
 # retinanet
 from retinanet.model import create_retinanet
-from retinanet.dataloader import AspectRatioBasedSampler, IL_dataset, collater
-from retinanet.dataloader import Resizer, Augmenter, Normalizer
+from retinanet.dataloader import AspectRatioBasedSampler, IL_dataset, collater, prepare_img_batch
+from retinanet.dataloader import get_transform
 # preprocessing
 from preprocessing.params import Params
 # train
@@ -43,7 +42,7 @@ def create_tools(params:Params):
     start_epoch = params['start_epoch']
     # Training dataloader
     dataset_train = IL_dataset(params,
-                               transform=transforms.Compose([Normalizer(), Augmenter(), Resizer()]),
+                               transform=get_transform(augment=True),
                                start_state=start_state,
                                use_all_class=True)
 
@@ -136,7 +135,7 @@ def main(args=None):
 
             with torch.cuda.device(0):
                 try:
-                    cls_loss, reg_loss = model.cal_simple_focal_loss(data['img'].float().cuda(), 
+                    cls_loss, reg_loss = model.cal_simple_focal_loss(prepare_img_batch(data['img']), 
                                                 data['annot'].cuda(),
                                                 params)
 
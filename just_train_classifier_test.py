@@ -4,7 +4,7 @@ from torch import tensor
 from IL_method.persuado_label import Labeler
 import argparse
 import collections
-from retinanet.losses import calc_iou
+from retinanet.matcher import Anchor_matcher
 import torch.nn as nn
 
 from torch.utils.data.dataloader import DataLoader
@@ -12,11 +12,10 @@ from evaluator import Evaluator
 # torch 
 import torch
 import torch.optim as optim
-from torchvision import transforms
 # retinanet
 from retinanet.model import create_retinanet
-from retinanet.dataloader import AspectRatioBasedSampler, IL_dataset, Replay_dataset, collater
-from retinanet.dataloader import Resizer, Augmenter, Normalizer
+from retinanet.dataloader import AspectRatioBasedSampler, IL_dataset, Replay_dataset, collater, prepare_img_batch
+from retinanet.dataloader import get_transform
 # preprocessing
 from preprocessing.params import Params
 # train
@@ -31,6 +30,10 @@ DEFAULT_GAMMA = 2.0
 DEFAULT_BATCH_SIZE = 5
 
 class SimpleFocalLoss(nn.Module):
+    def __init__(self):
+        super(SimpleFocalLoss, self).__init__()
+        self.matcher = Anchor_matcher()
+
     def forward(self, classifications, regressions, anchors, annotations, params, cur_state:int):
         alpha = 0.25
         gamma = 2
@@ -41,10 +44,8 @@ class SimpleFocalLoss(nn.Module):
         regression_losses = []
 
         anchor = anchors[0, :, :]
-        anchor_widths  = anchor[:, 2] - anchor[:, 0]
-        anchor_heights = anchor[:, 3] - anchor[:, 1]
-        anchor_ctr_x   = anchor[:, 0] + 0.5 * anchor_widths
-        anchor_ctr_y   = anchor[:, 1] + 0.5 * anchor_heights
+        # match the anchors of all images at once
+        assignment = self.matcher(anchors, annotations)
 
         past_class_num = params.states[cur_state]['num_past_class']
         if params['enhance_on_new']:
@@ -54,12 +55,9 @@ class SimpleFocalLoss(nn.Module):
             classification = classifications[j, :, :] # shape = (num_anchors, class_num)
             regression = regressions[j, :, :]
 
-            bbox_annotation = annotations[j, :, :]
-            bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
-            
             classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
 
-            if bbox_annotation.shape[0] == 0:
+            if assignment.num_gt[j] == 0:
                 alpha_factor = torch.ones(classification.shape, device=torch.device('cuda:0')) * alpha
 
                 alpha_factor = 1. - alpha_factor
@@ -75,27 +73,24 @@ class SimpleFocalLoss(nn.Module):
                 regression_losses.append(torch.tensor(0).float().cuda())
                 continue
 
-            IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4]) # shape=(num_anchors, num_annotations)
-            IoU_max, IoU_argmax = torch.max(IoU, dim=1) # shape=(num_anchors x 1)
-            
             # compute the loss for classification
             targets = torch.ones(classification.shape, device=torch.device('cuda:0')) * -1
     
             # get background anchor idx
-            bg_mask = torch.lt(IoU_max, 0.4)
+            bg_mask = assignment.negative[j]
             # whether ignore past class
             if not params['ignore_past_class']:
                 targets[bg_mask, :] = 0
             else:
                 targets[bg_mask, past_class_num:] = 0
 
-            positive_indices = torch.ge(IoU_max, 0.5) 
+            positive_indices = assignment.positive[j]
 
             num_positive_anchors = positive_indices.sum()
-            assigned_annotations = bbox_annotation[IoU_argmax, :]
+            assigned_labels = assignment.labels[j]
 
             targets[positive_indices, :] = 0
-            targets[positive_indices, assigned_annotations[positive_indices, 4].long()] = 1
+            targets[positive_indices, assigned_labels[positive_indices]] = 1
             
             alpha_factor = torch.ones(targets.shape , device=torch.device('cuda:0')) * alpha
 
@@ -123,35 +118,7 @@ class SimpleFocalLoss(nn.Module):
 
             # compute the loss for regression
             if positive_indices.sum() > 0:
-                assigned_annotations = assigned_annotations[positive_indices, :]
-
-                anchor_widths_pi = anchor_widths[positive_indices]
-                anchor_heights_pi = anchor_heights[positive_indices]
-                anchor_ctr_x_pi = anchor_ctr_x[positive_indices]
-                anchor_ctr_y_pi = anchor_ctr_y[positive_indices]
-
-                gt_widths  = assigned_annotations[:, 2] - assigned_annotations[:, 0]
-                gt_heights = assigned_annotations[:, 3] - assigned_annotations[:, 1]
-                gt_ctr_x   = assigned_annotations[:, 0] + 0.5 * gt_widths
-                gt_ctr_y   = assigned_annotations[:, 1] + 0.5 * gt_heights
-
-                # clip widths to 1
-                gt_widths  = torch.clamp(gt_widths, min=1)
-                gt_heights = torch.clamp(gt_heights, min=1)
-
-                targets_dx = (gt_ctr_x - anchor_ctr_x_pi) / anchor_widths_pi
-                targets_dy = (gt_ctr_y - anchor_ctr_y_pi) / anchor_heights_pi
-                targets_dw = torch.log(gt_widths / anchor_widths_pi)
-                targets_dh = torch.log(gt_heights / anchor_heights_pi)
-
-                targets = torch.stack((targets_dx, targets_dy, targets_dw, targets_dh))
-                targets = targets.t()
-
-                if torch.cuda.is_available():
-                    # targets = targets/torch.Tensor([[0.1, 0.1, 0.2, 0.2]]).cuda()
-                    targets = targets/ torch.cuda.FloatTensor([[0.1, 0.1, 0.2, 0.2]])
-                else:
-                    targets = targets/torch.Tensor([[0.1, 0.1, 0.2, 0.2]])
+                targets = assignment.regression_targets(j, anchor, annotations)
 
                 regression_diff = torch.abs(targets - regression[positive_indices, :])
 
@@ -211,7 +178,7 @@ def create_tools(params:Params):
     
     # Training dataloader
     dataset_train = IL_dataset(params,
-                               transform=transforms.Compose([Normalizer(), Augmenter(), Resizer()]),
+                               transform=get_transform(augment=True),
                                start_state=start_state)
     if params['persuado_label']:
         labler = Labeler(retinanet, params)
@@ -275,7 +242,7 @@ def get_parser(args=None):
 def cal_loss(data, model, params):
     result = dict()
     with torch.cuda.device(0):
-        img_batch = data['img'].float().cuda()
+        img_batch = prepare_img_batch(data['img'])
         annotations = data['annot'].cuda()
         classifications, regressions, anchors = model(img_batch, 
                                                     return_feat=False, 
@@ -320,7 +287,7 @@ def main(args=None):
 
 
     # dataset_replay = Replay_dataset(params,
-    #                                 transform=transforms.Compose([Normalizer(), Augmenter(), Resizer()]))
+    #                                 transform=get_transform(augment=True))
 
 
     # path = os.path.join(params['ckp_path'], 'state{}'.format(cur_state))
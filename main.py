@@ -5,11 +5,10 @@ from evaluator import Evaluator
 # torch 
 import torch
 import torch.optim as optim
-from torchvision import transforms
 # retinanet
 from retinanet.model import create_retinanet
 from retinanet.dataloader import IL_dataset
-from retinanet.dataloader import Resizer, Augmenter, Normalizer
+from retinanet.dataloader import get_transform, get_resize_backend
 # preprocessing
 from preprocessing.params import Params
 # train
@@ -38,7 +37,7 @@ def create_IL_trainer(params:Params):
     start_epoch = params['start_epoch']
     # Training dataloader
     dataset_train = IL_dataset(params,
-                               transform=transforms.Compose([Normalizer(), Augmenter(), Resizer()]),
+                               transform=get_transform(augment=not params['batch_augment'], uint8=params['uint8_collate'], resize_backend=get_resize_backend(params)),
                                start_state=start_state,
                                use_data_ratio = params['use_data_ratio'])
 
@@ -94,6 +93,17 @@ def get_parser(args=None):
     # retinanet params
     parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA)
     parser.add_argument('--gamma', type=float, default=DEFAULT_GAMMA)
+    parser.add_argument('--sparse_matching', help='whether only compute IoU for the anchors near each ground truth when matching, it saves memory for crowded images, default = False', type=str2bool, default=False)
+    parser.add_argument('--target_cache', help='whether cache the anchor assignment of each image across epochs and runs, the records are stored in "ckp_path/target_cache" and the recent ones are kept in memory, it can\'t be used with batch_augment, default = False', type=str2bool, default=False)
+    parser.add_argument('--target_cache_mb', help='the memory limit (MB) of target cache, the least recently used records are read from disk again, default = 256', type=int, default=256)
+    parser.add_argument('--assign_in_worker', help='whether match the anchors in DataLoader workers, so the loss only rebuilds the targets, it can\'t be used with batch_augment, default = False', type=str2bool, default=False)
+    parser.add_argument('--lean_focal_loss', help='whether compute the focal loss in chunks with an analytic gradient, which doesn\'t keep dense targets for backward, default = False', type=str2bool, default=False)
+    parser.add_argument('--teacher_cache', help='whether cache the foreground outputs of previous model for distillation after the first epoch, it can\'t be used with batch_augment, default = False', type=str2bool, default=False)
+    parser.add_argument('--teacher_cache_mb', help='the memory limit (MB) of teacher cache, the least recently used images are evicted, default = 2048', type=int, default=2048)
+    parser.add_argument('--teacher_pipeline', help='whether run the previous model on the next batch while the current batch is trained, it can\'t be used with teacher_cache, default = False', type=str2bool, default=False)
+    parser.add_argument('--teacher_precision', help='the precision of previous model for distillation, "fp32", "fp16" or "bf16", BatchNorm is folded into convolutions for fp16 and bf16, default = fp32', default='fp32')
+    parser.add_argument('--teacher_calibration_batches', help='the number of training batches for measuring the error of low precision teacher, default = 4', type=int, default=4)
+    parser.add_argument('--share_backbone', help="whether previous model reuses the frozen backbone/FPN activations of student when their weights are identical, e.g. in warm-up stages, default = True", type=str2bool, default=True)
     # Other params
     parser.add_argument('--record', help='whether record training with tensorboard default=True', type=str2bool, default=True)  
     parser.add_argument('--print_il_info', help='whether debug in Train process, default = False', type=str2bool, default=True)
@@ -160,6 +170,24 @@ def get_parser(args=None):
     parser.add_argument('--mix_data_start', type=int, default=0)
     parser.add_argument('--every_iter', type=int, default=2)
 
+    # Data loading
+    parser.add_argument('--num_workers', help='the number of DataLoader workers, default = 2', type=int, default=2)
+    parser.add_argument('--prefetch_factor', help='the number of batches loaded in advance by each worker, default = 2', type=int, default=2)
+    parser.add_argument('--persistent_workers', help='whether keep the DataLoader workers alive across epochs and states, the changes of dataset in a new state are sent to the workers, default = True', type=str2bool, default=True)
+    parser.add_argument('--pin_memory', help='whether DataLoader copies the batches into pinned memory, it is always enabled by device_prefetch on GPU, default = False', type=str2bool, default=False)
+    parser.add_argument('--image_cache', help='whether read the resized images from the on-disk image cache, it is rebuilt if the image list, image_decoder or resizing is changed, default = False', type=str2bool, default=False)
+    parser.add_argument('--uint8_collate', help='whether collate uint8 batches and normalize them on GPU, default = False', type=str2bool, default=False)
+    parser.add_argument('--batch_pixels', help='if > 0, pack images into a batch until N*H*W of the padded batch reaches it, instead of using fixed batch_size, default = 0', type=int, default=0)
+    parser.add_argument('--resize_buckets', help='the canonical shapes "HxW" for resizing, e.g. "640x1024 1024x640 640x640", default = [] which means no bucket', nargs='*', default=[])
+    parser.add_argument('--bucket_min_scale', help='the image fitted in a bucket must be larger than bucket_min_scale * its normal resized size, default = 0.8', type=float, default=0.8)
+    parser.add_argument('--image_decoder', help='the backend for decoding images, must be "skimage", "opencv" or "pil", "opencv" also resizes images by cv2, which is faster but not equal to skimage, default = "skimage"', default="skimage")
+    parser.add_argument('--device_prefetch', help='whether move the next batch to GPU while the current step is running, the batches are pinned for it, default = True', type=str2bool, default=True)
+    parser.add_argument('--batch_augment', help='whether flip the collated batches on GPU instead of flipping each image in DataLoader workers, default = False', type=str2bool, default=False)
+    parser.add_argument('--image_pack', help='whether read the image files from the image pack built by pack_images.py, default = False', type=str2bool, default=False)
+    parser.add_argument('--read_ahead', help='the number of image files read in advance by the order of sampler, default = 0 which means disable', type=int, default=0)
+    parser.add_argument('--read_ahead_threads', help='the number of threads for read-ahead, default = 8', type=int, default=8)
+    parser.add_argument('--read_delay', help='the artificial delay (seconds) for reading each image file, for simulating slow storage, default = 0', type=float, default=0.0)
+
     # Record
     parser.add_argument('--output_examplar', help='whether output the .png for examplars, default = True',  type=str2bool, default=True)
     parser.add_argument('--description', help="description for this experiment", default="None")
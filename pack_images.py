@@ -0,0 +1,64 @@
+import argparse
+import os
+# retinanet
+from retinanet.decoder import create_decoder, DEFAULT_DECODER
+from retinanet.image_cache import Image_cache, SHARD_SIZE, get_cache_settings
+from retinanet.image_pack import Image_pack
+from retinanet.dataloader import MIN_SIDE, MAX_SIDE, get_resize_scale, get_resize_backend, resize_for_cache
+from preprocessing.enhance_coco import Enhance_COCO
+
+ROOT_DIR = "/home/deeplab307/Documents/Anaconda/Shiang/IL/"
+FORMATS = ['raw', 'resized']
+
+def get_parser(args=None):
+    parser = argparse.ArgumentParser(description="pack the images of dataset splits into a few large shard files")
+    parser.add_argument('--dataset', help='Dataset name, must contain name and years, for instance: voc2007,voc2012', default='voc2007')
+    parser.add_argument('--root_dir', help='the root dir for training', default=ROOT_DIR)
+    parser.add_argument('--data_split', help='the data splits for packing, default = trainval test', nargs='+', default=['trainval', 'test'])
+    parser.add_argument('--format', help='"raw" packs the encoded image files, which is read by --image_pack; \
+                                          "resized" packs the resized uint8 images, which is read by --image_cache, default = raw', default='raw')
+    parser.add_argument('--image_decoder', help='the decoder for "resized" format, "opencv" also resizes images by cv2, default = "skimage"', default=DEFAULT_DECODER)
+    parser.add_argument('--min_side', type=int, default=MIN_SIDE)
+    parser.add_argument('--max_side', type=int, default=MAX_SIDE)
+    parser.add_argument('--shard_size', help='the maximum bytes of a shard file, default = 1GB', type=int, default=SHARD_SIZE)
+    return vars(parser.parse_args(args))
+
+def pack_raw(coco, image_dir:str, pack_dir:str, shard_size:int):
+    file_names = [coco.imgs[img_id]['file_name'] for img_id in sorted(coco.imgs.keys())]
+    Image_pack(pack_dir).build(image_dir, file_names, shard_size)
+
+def pack_resized(coco, image_dir:str, cache_dir:str, decoder_name:str, min_side:int, max_side:int, resize_backend='skimage'):
+    decoder = create_decoder(decoder_name)
+    def load_fn(img_id):
+        img_info = coco.imgs[img_id]
+        img, decode_scale = decoder(os.path.join(image_dir, img_info['file_name']),
+                                    get_resize_scale(img_info['height'], img_info['width'], min_side, max_side))
+        img, scale = resize_for_cache(img, min_side, max_side, resize_backend)
+        return img, scale * decode_scale
+
+    images = [(img_id, img_info['file_name']) for img_id, img_info in coco.imgs.items()]
+    settings = get_cache_settings(decoder_name, resize_backend, images)
+    Image_cache(cache_dir, min_side, max_side, settings).build(sorted(coco.imgs.keys()), load_fn)
+
+def main(args=None):
+    parser = get_parser(args)
+    if parser['format'] not in FORMATS:
+        raise ValueError("Unknown format:{}, must be one of {}".format(parser['format'], FORMATS))
+
+    data_path = os.path.join(parser['root_dir'], 'dataset', parser['dataset'])
+    image_dir = os.path.join(data_path, 'images')
+    for data_split in parser['data_split']:
+        coco_path = os.path.join(data_path, 'annotations', '{}_{}.json'.format(parser['dataset'], data_split))
+        coco = Enhance_COCO(coco_path)
+        # the same directories as IL_dataset
+        if parser['format'] == 'raw':
+            out_dir = os.path.join(data_path, 'pack', data_split)
+            pack_raw(coco, image_dir, out_dir, parser['shard_size'])
+        else:
+            out_dir = os.path.join(data_path, 'cache', data_split)
+            pack_resized(coco, image_dir, out_dir, parser['image_decoder'], parser['min_side'], parser['max_side'],
+                         get_resize_backend(parser))
+        print('Pack {} images of {} into {}'.format(len(coco.imgs), data_split, out_dir))
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,203 @@
+import os
+import shutil
+import pickle
+import hashlib
 from collections import defaultdict
 import pandas as pd
 from pycocotools.coco import COCO
 import numpy as np
+from preprocessing.debug import debug_print, DEBUG_FLAG
+from retinanet.annotation_table import Annotation_table
+
+SNAPSHOT_VERSION = 2 # increase it when the content of snapshot is changed
+SNAPSHOT_META = "meta.pickle"
+SNAPSHOT_INDEX = "index.pickle"
+SNAPSHOT_ATTRS = ['dataset', 'anns', 'imgs', 'cats', 'imgToAnns', 'catToImgs', 'classes', 'reverse_classes']
+SNAPSHOT_ARRAYS = ['img_id_array', 'cat_id_array', 'ann_rows', 'ann_cols', 'incidence']
+
+def file_sha1(path:str):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
 class Enhance_COCO(COCO):
-    def __init__(self, path):
+    def __init__(self, path, use_snapshot=True):
+        """
+            Args:
+                path: the path of annotation json file
+                use_snapshot: whether read / write the binary snapshot of the index next to the json file, default = True
+        """
+        snapshot_dir = os.path.splitext(path)[0] + '_snapshot'
+        loaded = use_snapshot and self.is_snapshot_valid(snapshot_dir, path) and self.load_snapshot(snapshot_dir)
+        if not loaded:
+            super().__init__(path)
+            self.classes = defaultdict()
+            self.reverse_classes = defaultdict()
+            for category in self.loadCats(self.getCatIds()):
+                self.classes[category['id']] = category['name']
+                self.reverse_classes[category['name']] = category['id']
+            self.init_incidence()
+            if use_snapshot:
+                self.save_snapshot(snapshot_dir, path)
+
+        self.annotation_file = path
+        self.annotation_table = None
+
+    @staticmethod
+    def is_snapshot_valid(snapshot_dir:str, path:str):
+        """the snapshot is valid when it has the same version and is built from the same json file,
+            the hash of the json file is checked only when its mtime or size is changed
+        """
+        meta_path = os.path.join(snapshot_dir, SNAPSHOT_META)
+        try:
+            with open(meta_path, 'rb') as f:
+                meta = pickle.load(f)
+        except OSError:
+            # not built, or being replaced by another process
+            return False
+        if meta['version'] != SNAPSHOT_VERSION:
+            return False
+
+        stat = os.stat(path)
+        if meta['mtime'] == stat.st_mtime and meta['size'] == stat.st_size:
+            return True
+        if meta['size'] != stat.st_size or meta['sha1'] != file_sha1(path):
+            return False
+
+        # the content isn't changed, so update the mtime
+        meta['mtime'] = stat.st_mtime
+        with open(meta_path + '.tmp', 'wb') as f:
+            pickle.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        return True
+
+    @staticmethod
+    def read_snapshot_build(snapshot_dir:str):
+        """the id of the snapshot building, it is changed when the snapshot is replaced
+        """
+        try:
+            with open(os.path.join(snapshot_dir, SNAPSHOT_META), 'rb') as f:
+                return pickle.load(f).get('build')
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def load_snapshot(self, snapshot_dir:str):
+        """
+            Return:
+                bool, False if the snapshot is replaced by another process while loading, then it should be built from the json file
+        """
+        debug_print('Load COCO snapshot from {}'.format(snapshot_dir))
+        build = self.read_snapshot_build(snapshot_dir)
+        try:
+            with open(os.path.join(snapshot_dir, SNAPSHOT_INDEX), 'rb') as f:
+                index = pickle.load(f)
+            arrays = {name: np.load(os.path.join(snapshot_dir, name + '.npy'), mmap_mode='r') for name in SNAPSHOT_ARRAYS}
+        except OSError:
+            return False
+        if build == None or build != self.read_snapshot_build(snapshot_dir):
+            return False
+        for name in SNAPSHOT_ATTRS:
+            setattr(self, name, index[name])
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        return True
+
+    def save_snapshot(self, snapshot_dir:str, path:str):
+        """write the index, class maps and incidence matrix into a temporary directory, and then swap it with the snapshot directory,
+            so the other processes never read a half-written snapshot, and the opened memmaps of the old snapshot are still valid
+        """
+        tmp_dir = '{}.tmp{}'.format(snapshot_dir, os.getpid())
+        old_dir = '{}.old{}'.format(snapshot_dir, os.getpid())
+        try:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            with open(os.path.join(tmp_dir, SNAPSHOT_INDEX), 'wb') as f:
+                pickle.dump({name: getattr(self, name) for name in SNAPSHOT_ATTRS}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for name in SNAPSHOT_ARRAYS:
+                np.save(os.path.join(tmp_dir, name + '.npy'), getattr(self, name))
+
+            stat = os.stat(path)
+            meta = {'version': SNAPSHOT_VERSION, 'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': file_sha1(path), 
+                    'build': os.urandom(8).hex()}
+            with open(os.path.join(tmp_dir, SNAPSHOT_META), 'wb') as f:
+                pickle.dump(meta, f)
+
+            if os.path.isdir(snapshot_dir):
+                os.rename(snapshot_dir, old_dir)
+            os.rename(tmp_dir, snapshot_dir)
+        except OSError as e:
+            print("Cannot write COCO snapshot in {}: {}".format(snapshot_dir, e))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    def get_annotation_table(self):
+        """get the columnar annotation table, it is built and saved next to the annotation file when it doesn't exist or is out of date
+        """
+        if self.annotation_table == None:
+            table_dir = os.path.splitext(self.annotation_file)[0] + '_table'
+            if not Annotation_table.is_valid(table_dir, self.annotation_file):
+                Annotation_table.build(self, table_dir, self.annotation_file)
+            self.annotation_table = Annotation_table(table_dir)
+        return self.annotation_table
+
+    def init_incidence(self):
+        """build the image x category incidence matrix, incidence[i, j] = True means the i-th image contains the j-th category
+        """
+        self.img_id_array = np.array(sorted(self.imgs.keys()), dtype=np.int64)
+        self.cat_id_array = np.array(sorted(self.cats.keys()), dtype=np.int64)
 
-        super().__init__(path)
-        self.classes = defaultdict()
-        self.reverse_classes = defaultdict()
-        for category in self.loadCats(self.getCatIds()):
-            self.classes[category['id']] = category['name']
-            self.reverse_classes[category['name']] = category['id']
+        anns = self.dataset.get('annotations', [])
+        # the row and the column of each annotation
+        self.ann_rows = np.searchsorted(self.img_id_array, np.array([ann['image_id'] for ann in anns], dtype=np.int64))
+        self.ann_cols = np.searchsorted(self.cat_id_array, np.array([ann['category_id'] for ann in anns], dtype=np.int64))
+
+        self.incidence = np.zeros((len(self.img_id_array), len(self.cat_id_array)), dtype=bool)
+        self.incidence[self.ann_rows, self.ann_cols] = True
+
+    @staticmethod
+    def search_ids(sorted_ids:np.ndarray, ids, name:str):
+        """find the positions of ids in the sorted id array, raise ValueError if any id doesn't exist
+        """
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        pos = np.searchsorted(sorted_ids, ids)
+        found = pos < len(sorted_ids)
+        found[found] = sorted_ids[pos[found]] == ids[found]
+        if not found.all():
+            raise ValueError("{} id:{} doesn't exist in annotations".format(name, ids[~found].tolist()))
+        return pos
+
+    def img_index(self, imgIds):
+        """convert image ids to the rows of incidence matrix
+        """
+        return self.search_ids(self.img_id_array, imgIds, 'Image')
+
+    def cat_index(self, catIds):
+        """convert category ids to the columns of incidence matrix
+        """
+        return self.search_ids(self.cat_id_array, catIds, 'Category')
+
+    def img_mask_by_cats(self, catIds):
+        """ Given some indexs of category, and return a bool array over img_id_array, True means the image contains any of these category
+        """
+        return self.incidence[:, self.cat_index(catIds)].any(axis=1)
+
+    def get_img_array_by_cats(self, catIds):
+        """ Given some indexs of category, and return the sorted ids of images containing any of these category
+        """
+        return self.img_id_array[self.img_mask_by_cats(catIds)]
+
+    def get_img_array_without_cats(self, catIds):
+        """ Given some indexs of category, and return the sorted ids of images containing none of these category
+        """
+        return self.img_id_array[~self.img_mask_by_cats(catIds)]
+
+    def contains_cats(self, imgIds, catIds):
+        """ Given some image ids and some indexs of category, and return a bool array, True means the image contains any of these category
+        """
+        return self.incidence[self.img_index(imgIds)][:, self.cat_index(catIds)].any(axis=1)
 
     def get_cats_by_imgs(self, imgIds, return_name=False):
         """ Given some image ids, and return the category in these imgs
@@ -19,10 +206,8 @@ class Enhance_COCO(COCO):
                 imgIds: the image ids
                 return_name: return the name of category or the index of category, when return_name = 'true', return names, else return indexs 
         """
-        annotations = self.loadAnns(self.getAnnIds(imgIds=imgIds)) # get annotations
-        #get categoryId appear in annotations
-        catIds = [ann['category_id'] for ann in annotations]
-        catIds = list(set(catIds))
+        #get categoryId appear in these images
+        catIds = self.cat_id_array[self.incidence[self.img_index(imgIds)].any(axis=0)].tolist()
 
         if not return_name:
             return catIds
@@ -38,14 +223,10 @@ class Enhance_COCO(COCO):
 
             Args:
                 catIds: the index of category
+            Return:
+                a sorted list of image ids
         """
-        if type(catIds) == list:
-            imgIds = set()
-            for catId in catIds:
-                imgIds.update(self.getImgIds(catIds=catId))
-            return list(imgIds)
-        else:
-            return self.getImgIds(catIds=catIds)
+        return self.get_img_array_by_cats(catIds).tolist()
 
     def catId_to_name(self, catIds):
         """Convert the indexs of categories to the name of them
@@ -81,13 +262,12 @@ class Enhance_COCO(COCO):
     
     def get_catNum_by_catId(self, catIds):
         result = {'image':[], 'object':[]}
-        index = []
         catIds.sort()
+        cols = self.cat_index(catIds)
         
-        for catId in catIds:
-            index.append(self.classes[catId])
-            result['image'].append(len(self.getImgIds(catIds = catId)))
-            result['object'].append(len(self.getAnnIds(catIds = catId)))
+        index = [self.classes[catId] for catId in catIds]
+        result['image'] = self.incidence[:, cols].sum(axis=0).tolist()
+        result['object'] = np.bincount(self.ann_cols, minlength=len(self.cat_id_array))[cols].tolist()
 
         index.append('Counts')
         result['image'].append(sum(result['image']))
@@ -97,20 +277,18 @@ class Enhance_COCO(COCO):
         return result
 
     def get_catNum_by_imgs(self, imgIds):
-        #get annotations
-        annotations = self.loadAnns(self.getAnnIds(imgIds=imgIds))
-        #get categoryId appear in annotations
-        catIds = [ann['category_id'] for ann in annotations]
+        rows = np.unique(self.img_index(imgIds))
+        # object counts of all categories in these images
+        img_mask = np.zeros(len(self.img_id_array), dtype=bool)
+        img_mask[rows] = True
+        object_counts = np.bincount(self.ann_cols[img_mask[self.ann_rows]], minlength=len(self.cat_id_array))
+        cols = np.nonzero(object_counts)[0]
 
         result = {'image':[], 'object':[]}
 
-        index = self.catId_to_name(list(set(catIds)))
-        #object counts
-        result['object'] = np.unique(catIds, return_counts=True)[1].tolist()
-
-        catIds = list(set(catIds))
-        for catId in catIds:
-            result['image'].append(len(set(self.getImgIds(catIds = catId)) & set(imgIds)))
+        index = self.catId_to_name(self.cat_id_array[cols].tolist())
+        result['object'] = object_counts[cols].tolist()
+        result['image'] = self.incidence[rows][:, cols].sum(axis=0).tolist()
         
         print('Counts meaning for  image is your input imgIds number')
         index.append('Counts')
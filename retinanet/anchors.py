@@ -1,12 +1,20 @@
+from collections import OrderedDict
 import numpy as np
 import torch
 import torch.nn as nn
 
 
+MAX_CACHED_SHAPES = 32 # the maximum number of image shapes kept in the anchor cache
+
 class Anchors(nn.Module):
-    def __init__(self, pyramid_levels=None, strides=None, sizes=None, ratios=None, scales=None):
+    def __init__(self, pyramid_levels=None, strides=None, sizes=None, ratios=None, scales=None, max_cached_shapes=MAX_CACHED_SHAPES):
         super(Anchors, self).__init__()
 
+        self.pyramid_levels = pyramid_levels
+        self.strides = strides
+        self.sizes = sizes
+        self.ratios = ratios
+        self.scales = scales
         if pyramid_levels is None:
             self.pyramid_levels = [3, 4, 5, 6, 7]
         if strides is None:
@@ -18,26 +26,76 @@ class Anchors(nn.Module):
         if scales is None:
             self.scales = np.array([2 ** 0, 2 ** (1.0 / 3.0), 2 ** (2.0 / 3.0)])
 
-    def forward(self, image):
-        
-        image_shape = image.shape[2:]
-        image_shape = np.array(image_shape)
-        image_shapes = [(image_shape + 2 ** x - 1) // (2 ** x) for x in self.pyramid_levels]
-
-        # compute anchors over all pyramid levels
-        all_anchors = np.zeros((0, 4)).astype(np.float32)
+        # the base anchors (A, 4) of each pyramid level, they only depend on the settings
+        self.base_anchors = [torch.from_numpy(generate_anchors(base_size=size, ratios=self.ratios, scales=self.scales)).float() 
+                                for size in self.sizes]
+        # (rows, cols, device, dtype) -> anchors, the least recently used one is dropped when it is full
+        self.max_cached_shapes = max_cached_shapes
+        self.cache = OrderedDict()
+
+    def __setstate__(self, state):
+        # the models pickled before the anchor cache existed
+        super(Anchors, self).__setstate__(state)
+        if 'cache' not in self.__dict__:
+            self.base_anchors = [torch.from_numpy(generate_anchors(base_size=size, ratios=self.ratios, scales=self.scales)).float()
+                                    for size in self.sizes]
+            self.max_cached_shapes = MAX_CACHED_SHAPES
+            self.cache = OrderedDict()
 
-        for idx, p in enumerate(self.pyramid_levels):
-            anchors         = generate_anchors(base_size=self.sizes[idx], ratios=self.ratios, scales=self.scales)
-            shifted_anchors = shift(image_shapes[idx], self.strides[idx], anchors)
-            all_anchors     = np.append(all_anchors, shifted_anchors, axis=0)
-
-        all_anchors = np.expand_dims(all_anchors, axis=0)
-
-        if torch.cuda.is_available():
-            return torch.from_numpy(all_anchors.astype(np.float32)).cuda()
+    def forward(self, image):
+        """
+            Return:
+                anchors with shape (1, num_anchors, 4), float32 tensor on the device of image, 
+                the tensor is shared by the calls with the same image shape, so don't modify it in place
+        """
+        rows, cols = int(image.shape[2]), int(image.shape[3])
+        key = (rows, cols, image.device, torch.float32)
+        anchors = self.cache.get(key)
+        if anchors is None:
+            anchors = self.compute_anchors(rows, cols, image.device)
+            self.cache[key] = anchors
+            if len(self.cache) > self.max_cached_shapes:
+                self.cache.popitem(last=False)
         else:
-            return torch.from_numpy(all_anchors.astype(np.float32))
+            self.cache.move_to_end(key)
+        return anchors
+
+    def grid_shape(self, anchors):
+        """get the image shape of the anchors which are returned by forward()
+            Return:
+                (rows, cols), or None if the anchors aren't in the cache
+        """
+        for (rows, cols, _, _), cached in self.cache.items():
+            if cached.data_ptr() == anchors.data_ptr() and cached.shape[1] == anchors.shape[-2]:
+                return rows, cols
+        return None
+
+    def level_shapes(self, rows:int, cols:int):
+        """
+            Return:
+                list of (level_rows, level_cols) for each pyramid level
+        """
+        return [((rows + 2 ** level - 1) // (2 ** level), (cols + 2 ** level - 1) // (2 ** level)) for level in self.pyramid_levels]
+
+    def compute_anchors(self, rows:int, cols:int, device):
+        """compute anchors over all pyramid levels on the device
+        """
+        all_anchors = []
+        for idx, (level_rows, level_cols) in enumerate(self.level_shapes(rows, cols)):
+            stride = self.strides[idx]
+
+            shift_x = (torch.arange(level_cols, device=device, dtype=torch.float32) + 0.5) * stride
+            shift_y = (torch.arange(level_rows, device=device, dtype=torch.float32) + 0.5) * stride
+            # the same order as np.meshgrid: x changes first
+            shift_x = shift_x.view(1, -1).expand(level_rows, level_cols)
+            shift_y = shift_y.view(-1, 1).expand(level_rows, level_cols)
+            shifts = torch.stack((shift_x.reshape(-1), shift_y.reshape(-1), shift_x.reshape(-1), shift_y.reshape(-1)), dim=1)
+
+            # (1, A, 4) + (K, 1, 4) -> (K * A, 4)
+            base_anchors = self.base_anchors[idx].to(device)
+            all_anchors.append((base_anchors.view(1, -1, 4) + shifts.view(-1, 1, 4)).view(-1, 4))
+
+        return torch.cat(all_anchors, dim=0).unsqueeze(0)
 
 def generate_anchors(base_size=16, ratios=None, scales=None):
     """
@@ -0,0 +1,146 @@
+import os
+import pickle
+import numpy as np
+
+from preprocessing.debug import debug_print, DEBUG_FLAG
+
+TABLE_VERSION = 1 # increase it when the columns or the filtering rules of annotations are changed
+META_FILE = "meta.pickle"
+COLUMNS = ['img_ids', 'offsets', 'boxes', 'cat_ids', 'widths', 'heights', 'file_names']
+
+class Annotation_table(object):
+    """Columnar annotation table built from the coco annotations
+
+        All annotations are stored in flat arrays, and the annotations of the i-th image are boxes[offsets[i]:offsets[i + 1]].
+        The arrays are saved as .npy files and opened with mmap_mode='r', so the DataLoader workers share the same pages
+        instead of copying the python dicts of pycocotools.
+
+        Columns:
+            img_ids: (num_imgs,) sorted image ids
+            offsets: (num_imgs + 1,) the start index of each image in boxes and cat_ids
+            boxes: (num_anns, 4) float32, [x1, y1, x2, y2]
+            cat_ids: (num_anns,) the category id of each box
+            widths, heights: (num_imgs,) the size of each image
+            file_names: (num_imgs,) the file name of each image
+    """
+    def __init__(self, table_dir:str):
+        """
+            Args:
+                table_dir: the directory which stores the table
+        """
+        self.table_dir = table_dir
+        self._load()
+
+    def __getstate__(self):
+        # the memmaps are reopened in each DataLoader worker
+        return {'table_dir': self.table_dir}
+
+    def __setstate__(self, state):
+        self.table_dir = state['table_dir']
+        self._load()
+
+    def _load(self):
+        for name in COLUMNS:
+            setattr(self, name, np.load(os.path.join(self.table_dir, name + '.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def index(self, img_id):
+        """get the row index of the image
+        """
+        row = int(np.searchsorted(self.img_ids, img_id))
+        if row == len(self.img_ids) or self.img_ids[row] != img_id:
+            raise ValueError("Image id:{} doesn't exist in annotation table".format(img_id))
+        return row
+
+    def get_annotations(self, img_id):
+        """get the annotations of the image
+            Return:
+                (boxes, cat_ids), boxes is [x1, y1, x2, y2]
+        """
+        row = self.index(img_id)
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.boxes[start:end], self.cat_ids[start:end]
+
+    def get_size(self, img_id):
+        """
+            Return:
+                (width, height)
+        """
+        row = self.index(img_id)
+        return int(self.widths[row]), int(self.heights[row])
+
+    def get_file_name(self, img_id):
+        return str(self.file_names[self.index(img_id)])
+
+    @staticmethod
+    def is_valid(table_dir:str, annotation_file:str):
+        """check whether the table exists, has the current version and is built from the current annotation file
+        """
+        meta_path = os.path.join(table_dir, META_FILE)
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path, 'rb') as f:
+            meta = pickle.load(f)
+        if meta.get('version') != TABLE_VERSION:
+            return False
+        stat = os.stat(annotation_file)
+        return meta['mtime'] == stat.st_mtime and meta['size'] == stat.st_size
+
+    @staticmethod
+    def build(coco, table_dir:str, annotation_file:str):
+        """build the table from a COCO object, the crowd annotations and the annotations which have basically no width / height are skipped
+            Args:
+                coco: the COCO object
+                table_dir: the directory which stores the table
+                annotation_file: the json file of coco, used to check whether the table is out of date
+        """
+        debug_print('Build annotation table in {}'.format(table_dir))
+        if not os.path.isdir(table_dir):
+            os.makedirs(table_dir)
+
+        img_ids = np.array(sorted(coco.imgs.keys()), dtype=np.int64)
+        offsets = np.zeros(len(img_ids) + 1, dtype=np.int64)
+        widths = np.zeros(len(img_ids), dtype=np.int32)
+        heights = np.zeros(len(img_ids), dtype=np.int32)
+        file_names = []
+        boxes = []
+        cat_ids = []
+        for row, img_id in enumerate(img_ids):
+            img_info = coco.imgs[int(img_id)]
+            widths[row] = img_info['width']
+            heights[row] = img_info['height']
+            file_names.append(img_info['file_name'])
+
+            for ann in coco.imgToAnns[int(img_id)]:
+                if ann.get('iscrowd', 0):
+                    continue
+                # some annotations have basically no width / height, skip them
+                if ann['bbox'][2] < 1 or ann['bbox'][3] < 1:
+                    continue
+                boxes.append(ann['bbox'])
+                cat_ids.append(ann['category_id'])
+            offsets[row + 1] = len(boxes)
+
+        # transform from [x, y, w, h] to [x1, y1, x2, y2]
+        boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+        boxes[:, 2] = boxes[:, 0] + boxes[:, 2]
+        boxes[:, 3] = boxes[:, 1] + boxes[:, 3]
+
+        columns = {'img_ids': img_ids,
+                   'offsets': offsets,
+                   'boxes': boxes.astype(np.float32),
+                   'cat_ids': np.array(cat_ids, dtype=np.int64),
+                   'widths': widths,
+                   'heights': heights,
+                   'file_names': np.array(file_names, dtype=np.str_)}
+        for name, value in columns.items():
+            np.save(os.path.join(table_dir, name + '.npy'), value)
+
+        # write the meta at last, so an interrupted building won't be used
+        stat = os.stat(annotation_file)
+        meta_path = os.path.join(table_dir, META_FILE)
+        with open(meta_path + '.tmp', 'wb') as f:
+            pickle.dump({'version': TABLE_VERSION, 'mtime': stat.st_mtime, 'size': stat.st_size}, f)
+        os.replace(meta_path + '.tmp', meta_path)
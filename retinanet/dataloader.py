@@ -1,12 +1,16 @@
 
 from __future__ import print_function, division
 import os
+import uuid
+import tempfile
+import weakref
+from collections import defaultdict
 
 import torch
 import numpy as np
 import random
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, get_worker_info
 from torch.utils.data.sampler import Sampler
 
 import skimage.io
@@ -14,12 +18,149 @@ import skimage.transform
 import skimage.color
 import skimage
 import pickle
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
 from preprocessing.debug import debug_print, DEBUG_FLAG
-
+from retinanet.image_cache import Image_cache, get_cache_settings
+from retinanet.decoder import create_decoder, DEFAULT_DECODER
+from retinanet.image_pack import Image_pack
+from retinanet.read_ahead import File_reader, Read_ahead, DEFAULT_NUM_THREADS
+from retinanet.target_cache import Target_collater
+
+MIN_SIDE = 608
+MAX_SIDE = 1024
+DEFAULT_NUM_WORKERS = 2
+DEFAULT_PREFETCH_FACTOR = 2
+DEFAULT_BUCKET_MIN_SCALE = 0.8
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+RESIZE_BACKENDS = ['skimage', 'opencv']
+
+def get_resize_scale(rows:int, cols:int, min_side=MIN_SIDE, max_side=MAX_SIDE):
+    """compute the scale which let the smallest side be min_side, and the largest side isn't greater than max_side
+    """
+    smallest_side = min(rows, cols)
+
+    # rescale the image so the smallest side is min_side
+    scale = min_side / smallest_side
+
+    # check if the largest side is now greater than max_side, which can happen
+    # when images have a large aspect ratio
+    largest_side = max(rows, cols)
+
+    if largest_side * scale > max_side:
+        scale = max_side / largest_side
+    return scale
+
+def get_resized_shape(rows:int, cols:int, bucket=None, min_side=MIN_SIDE, max_side=MAX_SIDE):
+    """get the shape of the image after resizing and padding
+        Args:
+            rows, cols: the size of image
+            bucket: (H, W), if it is given, the image is resized to fit in the bucket, and padded to the bucket
+        Return:
+            (rows, cols, scale, padded_rows, padded_cols)
+    """
+    scale = get_resize_scale(rows, cols, min_side, max_side)
+    if bucket != None:
+        scale = min(scale, bucket[0] / rows, bucket[1] / cols)
+    rows, cols = int(round(rows*scale)), int(round((cols*scale)))
+    if bucket != None:
+        return min(rows, bucket[0]), min(cols, bucket[1]), scale, bucket[0], bucket[1]
+    return rows, cols, scale, rows + 32 - rows%32, cols + 32 - cols%32
+
+def parse_buckets(buckets:list):
+    """parse the bucket shapes
+        Args:
+            buckets: a list of str, each one is "HxW", H and W must be the multiple of 32
+        Return:
+            a list of (H, W)
+    """
+    if buckets == None:
+        return []
+    shapes = []
+    for bucket in buckets:
+        try:
+            rows, cols = [int(side) for side in bucket.lower().split('x')]
+        except ValueError:
+            raise ValueError("Bucket shape must be 'HxW', but got '{}'".format(bucket))
+        if rows % 32 != 0 or cols % 32 != 0:
+            raise ValueError("Bucket shape must be the multiple of 32, but got '{}'".format(bucket))
+        shapes.append((rows, cols))
+    return shapes
+
+def get_bucket(rows:int, cols:int, buckets:list, min_scale=DEFAULT_BUCKET_MIN_SCALE, min_side=MIN_SIDE, max_side=MAX_SIDE):
+    """choose the bucket for the image, the image is resized isotropically to fit the bucket, so the aspect ratio isn't distorted
+        Args:
+            rows, cols: the size of image
+            buckets: a list of (H, W)
+            min_scale: the image fitted in the bucket must be larger than min_scale * (the size resized by Resizer)
+        Return:
+            (H, W), the bucket which wastes least padding area, or None if no bucket is suitable
+    """
+    scale = get_resize_scale(rows, cols, min_side, max_side)
+    # the size resized by Resizer
+    rows, cols = int(round(rows*scale)), int(round((cols*scale)))
+
+    best_bucket = None
+    best_area = None
+    for bucket in buckets:
+        # the image isn't enlarged beyond the size of Resizer
+        fit_scale = min(bucket[0] / rows, bucket[1] / cols, 1.0)
+        if fit_scale < min_scale:
+            continue
+        area = bucket[0] * bucket[1]
+        if best_area == None or area < best_area:
+            best_bucket = bucket
+            best_area = area
+    return best_bucket
+
+def get_resize_backend(params):
+    """the library for resizing images, "opencv" only if params['image_decoder'] is "opencv", otherwise "skimage" like Resizer
+    """
+    if params != None and params['image_decoder'] == 'opencv':
+        return 'opencv'
+    return 'skimage'
+
+def resize_image(img:np.ndarray, rows:int, cols:int, backend='skimage'):
+    """resize the image to (rows, cols)
+        Args:
+            backend: "skimage", the anti-aliased bilinear resize of Resizer, or "opencv", which is faster but not equal to Resizer
+        Return:
+            the resized image, float64 for "skimage", the same dtype as img for "opencv"
+    """
+    if backend not in RESIZE_BACKENDS:
+        raise ValueError("Unknown resize backend:{}, must be one of {}".format(backend, RESIZE_BACKENDS))
+    if backend == 'opencv':
+        if cv2 == None:
+            raise ValueError("Resize backend opencv needs cv2, please install opencv-python")
+        interpolation = cv2.INTER_AREA if rows < img.shape[0] else cv2.INTER_LINEAR
+        return cv2.resize(np.ascontiguousarray(img), (cols, rows), interpolation=interpolation)
+    return skimage.transform.resize(img, (rows, cols), preserve_range=True)
+
+def resize_for_cache(img:np.ndarray, min_side=MIN_SIDE, max_side=MAX_SIDE, backend='skimage'):
+    """resize the decoded image like Resizer for storing in Image_cache
+        Return:
+            (image, scale), image is uint8
+    """
+    scale = get_resize_scale(img.shape[0], img.shape[1], min_side, max_side)
+    img = resize_image(img, int(round(img.shape[0]*scale)), int(round((img.shape[1]*scale))), backend)
+    return np.clip(np.round(img), 0, 255).astype(np.uint8), scale
+
+def remove_state_file(path:str, pid:int):
+    # only the process which creates the dataset removes the file, not the forked DataLoader workers
+    if os.getpid() == pid and os.path.isfile(path):
+        os.remove(path)
 
 class IL_dataset(Dataset):
-    """incremental learning dataset."""
+    """incremental learning dataset.
+
+        The attributes in STATE_ATTRS are changed between states (e.g. next_state()), publish_state() sends them to 
+        the persistent DataLoader workers, which reload them in __getitem__ when the shared state version is changed.
+    """
+    STATE_ATTRS = ['cur_state', 'image_ids', '_seen_class_id', 'label_lut', '_persuado_label', 'persuado_annots']
 
     def __init__(self, params,transform=None, start_state=0, use_data_ratio = 1, use_all_class=False, persuado_label=dict()):
         """
@@ -31,17 +172,28 @@ class IL_dataset(Dataset):
             use_data_ratio: use data ratio, default = 1, which means using all data
         """
 
+        # the published state, the version is in shared memory, so the workers see the changes
+        self._state_version = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self._local_version = 0
+        self._state_file = os.path.join(tempfile.gettempdir(), 'il_dataset_state_{}.pickle'.format(uuid.uuid4().hex))
+        weakref.finalize(self, remove_state_file, self._state_file, os.getpid())
+
         self.data_split = params['data_split'] # must be 'train', 'val', 'trainval' or 'test' 
         self.image_path = os.path.join(params['data_path'], 'images')
 
         self.transform = transform
+        self.decoder_name = params['image_decoder'] if params['image_decoder'] != None else DEFAULT_DECODER
+        self.decoder = create_decoder(self.decoder_name)
+        self.resize_backend = get_resize_backend(params)
         self.cur_state = start_state
         self.use_data_ratio = use_data_ratio
 
         self.states = params.states
         # read annotation and some related data
         self.coco = params.states.coco
+        self.annotation_table = self.coco.get_annotation_table()
 
+        self.init_classes()
 
         # set annotation seen class
         if self.data_split == "test" or use_all_class:
@@ -49,10 +201,82 @@ class IL_dataset(Dataset):
         else:
             self.seen_class_id = self.states[self.cur_state]['new_class']['id']
 
-        self.init_classes()
         self.update_imgIds()  #get this state's data
         self.persuado_label = persuado_label
+
+        self.resize_buckets = parse_buckets(params['resize_buckets'])
+        self.bucket_min_scale = params['bucket_min_scale'] if params['bucket_min_scale'] != None else DEFAULT_BUCKET_MIN_SCALE
+
+        # the reader of image files, None means the decoder reads the files by path
+        self.image_reader = None
+        if params['image_pack']:
+            self.image_reader = Image_pack(os.path.join(params['data_path'], 'pack', self.data_split))
+            if not self.image_reader.is_built():
+                raise ValueError("Image pack in {} isn't built, please run pack_images.py first".format(self.image_reader.pack_dir))
+        elif params['read_delay']:
+            self.image_reader = File_reader(self.image_path, delay=params['read_delay'])
+
+        self.read_ahead = None
+        self.image_cache = None
+        if params['image_cache']:
+            self.init_image_cache(os.path.join(params['data_path'], 'cache', self.data_split))
+
+        # the cached images are read from memmaps, so read-ahead is only used for image files
+        if params['read_ahead'] and self.image_cache == None:
+            reader = self.image_reader if self.image_reader != None else File_reader(self.image_path)
+            num_threads = params['read_ahead_threads'] if params['read_ahead_threads'] != None else DEFAULT_NUM_THREADS
+            self.read_ahead = Read_ahead(reader, params['read_ahead'], num_threads)
+
+    def init_image_cache(self, root_dir:str, min_side=MIN_SIDE, max_side=MAX_SIDE):
+        """open the on-disk cache of resized images, if it doesn't exist, then build it for all images in annotations
+        """
+        images = [(img_id, img_info['file_name']) for img_id, img_info in self.coco.imgs.items()]
+        settings = get_cache_settings(self.decoder_name, self.resize_backend, images)
+        self.image_cache = Image_cache(root_dir, min_side, max_side, settings)
+        if not self.image_cache.is_built():
+            def load_fn(img_id):
+                width, height = self.annotation_table.get_size(img_id)
+                img, decode_scale = self.read_image(img_id, get_resize_scale(height, width, min_side, max_side))
+                img, scale = resize_for_cache(img, min_side, max_side, self.resize_backend)
+                return img, scale * decode_scale
+
+            self.image_cache.build(self.coco.getImgIds(), load_fn)
         
+    @property
+    def seen_class_id(self):
+        return self._seen_class_id
+
+    @seen_class_id.setter
+    def seen_class_id(self, class_ids:list):
+        """set the seen class ids, and update the lookup table which maps category id -> label, -1 means unseen
+        """
+        self._seen_class_id = class_ids
+        self.label_lut = np.full_like(self.label_table, -1)
+        for catId in class_ids:
+            self.label_lut[catId] = self.label_table[catId]
+
+    @property
+    def persuado_label(self):
+        return self._persuado_label
+
+    @persuado_label.setter
+    def persuado_label(self, persuado_label:dict):
+        """set the persuado labels, and convert them to the annotation array for each image
+            Args:
+                persuado_label: a dict, img_id -> a list of {'bbox':[x, y, w, h], 'category_id':int}
+        """
+        self._persuado_label = persuado_label
+        self.persuado_annots = {}
+        for img_id, anns in persuado_label.items():
+            annotations = np.zeros((len(anns), 5))
+            for idx, ann in enumerate(anns):
+                annotations[idx, :4] = ann['bbox']
+                annotations[idx, 4] = self.coco_label_to_label(ann['category_id'])
+            # transform from [x, y, w, h] to [x1, y1, x2, y2]
+            annotations[:, 2] = annotations[:, 0] + annotations[:, 2]
+            annotations[:, 3] = annotations[:, 1] + annotations[:, 3]
+            self.persuado_annots[img_id] = annotations
+
     def update_imgIds(self):
         imgIds = self.coco.get_imgs_by_cats(self.seen_class_id)
         if 'test' != self.data_split:
@@ -72,77 +296,111 @@ class IL_dataset(Dataset):
     def init_classes(self):
         self.coco_labels         = {} # dataloader ID -> origin annotation ID
         self.coco_labels_inverse = {} # origin annotation ID -> dataloader ID
+        self.label_table = np.full(max(self.coco.getCatIds()) + 1, -1, dtype=np.int64) # origin annotation ID -> dataloader ID, -1 means unknown
 
         for idx, catId in enumerate(self.states[len(self.states) - 1]['knowing_class']['id']):
             self.coco_labels[idx] = catId
             self.coco_labels_inverse[catId] = idx
+            self.label_table[catId] = idx
+
+    def publish_state(self):
+        """send the attributes in STATE_ATTRS to the DataLoader workers, call it in the main process after they are changed
+        """
+        version = int(self._state_version[0]) + 1
+        state = {name: getattr(self, name) for name in self.STATE_ATTRS if hasattr(self, name)}
+        with open(self._state_file + '.tmp', 'wb') as f:
+            pickle.dump((version, state), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self._state_file + '.tmp', self._state_file)
+        self._local_version = version
+        self._state_version[0] = version
+
+    def sync_state(self):
+        """reload the published state in a DataLoader worker if it is changed
+        """
+        if self._local_version == int(self._state_version[0]):
+            return
+        with open(self._state_file, 'rb') as f:
+            version, state = pickle.load(f)
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._local_version = version
 
     def __len__(self):
         return len(self.image_ids)
 
     def __getitem__(self, idx):
-        img = self.load_image(idx)
+        self.sync_state()
         annot, num_persuado_labels = self.load_annotations(idx)
 
-        sample = {'img': img, 'annot': annot, 'num_persuado_labels':num_persuado_labels}
+        # the cached image is resized already, and the decoder may decode a reduced image, so scale the annotations here
+        if self.image_cache != None:
+            img, scale = self.load_cached_image(idx)
+        else:
+            img, scale = self.load_image(idx)
+        annot[:, :4] *= scale
+        sample = {'img': img, 'annot': annot, 'num_persuado_labels':num_persuado_labels, 'scale': scale, 'img_id': self.image_ids[idx]}
+        if len(self.resize_buckets) != 0:
+            sample['bucket'] = self.image_bucket(idx)
+
         if self.transform:
             sample = self.transform(sample)
         
         return sample
 
-    def load_image(self, image_index):
-        image_info = self.coco.loadImgs(self.image_ids[image_index])[0]
-        file_name = image_info['file_name']
-        path = os.path.join(self.image_path, file_name) #file_name[:-4] mean the image's id
-        img = skimage.io.imread(path)
+    def read_image(self, img_id, scale=None):
+        """read the uint8 RGB image by image id
+            Args:
+                img_id: the image id
+                scale: the target resize scale, the decoder may decode a reduced image which is still larger than it
+            Return:
+                (image, decode_scale), decode_scale is the ratio of decoded size to the origin size
+        """
+        file_name = self.annotation_table.get_file_name(img_id)
+        # the buffer of read-ahead only lives in the main process, DataLoader workers read the warmed files directly
+        if self.read_ahead != None and get_worker_info() == None:
+            source = self.read_ahead.get(file_name)
+        elif self.image_reader != None:
+            source = self.image_reader.read(file_name)
+        else:
+            source = os.path.join(self.image_path, file_name) #file_name[:-4] mean the image's id
+        return self.decoder(source, scale)
 
-        if len(img.shape) == 2:
-            img = skimage.color.gray2rgb(img)
-            
-        return img.astype(np.float32)/255.0
+    def load_image(self, image_index):
+        """read the image which is decoded near the size for Resizer
+            Return:
+                (image, scale), image is uint8 RGB image
+        """
+        img_id = self.image_ids[image_index]
+        width, height = self.annotation_table.get_size(img_id)
+        return self.read_image(img_id, get_resize_scale(height, width))
+
+    def load_cached_image(self, image_index):
+        """read the resized image from image cache
+            Return:
+                (image, scale), image is a read-only uint8 view
+        """
+        if self.image_cache == None:
+            raise ValueError("Image cache isn't enabled")
+        return self.image_cache[self.image_ids[image_index]]
 
     def load_annotations(self, image_index):
-        # get ground truth annotations
-        annotations_ids = self.coco.getAnnIds(imgIds=self.image_ids[image_index], iscrowd=False)
-        annotations     = np.zeros((0, 5))
-
-        # some images appear to miss annotations (like image with id 257034)
-        if len(annotations_ids) == 0:
-            return annotations
-
-        # parse annotations
-        coco_annotations = self.coco.loadAnns(annotations_ids)
-        for idx, ann in enumerate(coco_annotations):
-            #When the category doesn't exist in this state, then ignored it 
-            if(ann['category_id'] not in self.seen_class_id):
-                continue
-
-            # some annotations have basically no width / height, skip them
-            if ann['bbox'][2] < 1 or ann['bbox'][3] < 1:
-                continue
-
-            annotation        = np.zeros((1, 5))
-            annotation[0, :4] = ann['bbox']
-            annotation[0, 4]  = self.coco_label_to_label(ann['category_id'])
-            annotations       = np.append(annotations, annotation, axis=0)
-
-        #persuado label
-        if len(self.persuado_label) != 0:
-            img_id = self.image_ids[image_index]
-            for ann in self.persuado_label[img_id]:
-                annotation        = np.zeros((1, 5))
-                annotation[0, :4] = ann['bbox']
-                annotation[0, 4]  = self.coco_label_to_label(ann['category_id'])
-                annotations       = np.append(annotations, annotation, axis=0)
-
-
+        """get ground truth annotations, the category which doesn't exist in this state is ignored
+            Return:
+                (annotations, num_persuado_labels), annotations is [x1, y1, x2, y2, label], num_persuado_labels = -1 means not using persuado label
+        """
+        img_id = self.image_ids[image_index]
+        boxes, cat_ids = self.annotation_table.get_annotations(img_id)
+        labels = self.label_lut[cat_ids]
+        mask = labels != -1
 
-        # transform from [x, y, w, h] to [x1, y1, x2, y2]
-        annotations[:, 2] = annotations[:, 0] + annotations[:, 2]
-        annotations[:, 3] = annotations[:, 1] + annotations[:, 3]
+        annotations = np.zeros((int(mask.sum()), 5))
+        annotations[:, :4] = boxes[mask]
+        annotations[:, 4] = labels[mask]
 
+        #persuado label
         if len(self.persuado_label) != 0:
-            return annotations, len(self.persuado_label[img_id])
+            persuado_annots = self.persuado_annots.get(img_id, np.zeros((0, 5)))
+            return np.concatenate((annotations, persuado_annots), axis=0), len(persuado_annots)
         else:
             return annotations, -1
 
@@ -152,9 +410,29 @@ class IL_dataset(Dataset):
     def label_to_coco_label(self, label):
         return self.coco_labels[label]
 
+    def image_file(self, image_index):
+        return self.annotation_table.get_file_name(self.image_ids[image_index])
+
     def image_aspect_ratio(self, image_index):
-        image = self.coco.loadImgs(self.image_ids[image_index])[0]
-        return float(image['width']) / float(image['height'])
+        width, height = self.annotation_table.get_size(self.image_ids[image_index])
+        return float(width) / float(height)
+
+    def image_bucket(self, image_index):
+        """get the bucket shape (H, W) of the image, None means the image doesn't use bucket
+        """
+        if len(self.resize_buckets) == 0:
+            return None
+        width, height = self.annotation_table.get_size(self.image_ids[image_index])
+        return get_bucket(height, width, self.resize_buckets, self.bucket_min_scale)
+
+    def image_shape(self, image_index):
+        """get the shape of the image after resizing and padding
+            Return:
+                (rows, cols, padded_rows, padded_cols)
+        """
+        width, height = self.annotation_table.get_size(self.image_ids[image_index])
+        rows, cols, _, padded_rows, padded_cols = get_resized_shape(height, width, self.image_bucket(image_index))
+        return rows, cols, padded_rows, padded_cols
 
     def num_new_classes(self):
         return self.states[self.cur_state]['num_new_class']
@@ -162,43 +440,27 @@ class IL_dataset(Dataset):
         return self.states[self.cur_state]['num_knowing_class']
 
 class Bic_dataset(IL_dataset):
+    STATE_ATTRS = IL_dataset.STATE_ATTRS + ['seen_class_ids']
+
     def __init__(self, params, transform=None, image_ids=[], seen_class_ids=[]):
         super().__init__(params, transform, 1, 1)
         self.seen_class_ids = seen_class_ids
         self.image_ids = image_ids
 
     def load_annotations(self, image_index):
-        # get ground truth annotations
-        annotations_ids = self.coco.getAnnIds(imgIds=self.image_ids[image_index], iscrowd=False)
-        annotations     = np.zeros((0, 5))
-
-        # some images appear to miss annotations (like image with id 257034)
-        if len(annotations_ids) == 0:
-            return annotations
-
-        # parse annotations
-        coco_annotations = self.coco.loadAnns(annotations_ids)
-        for idx, ann in enumerate(coco_annotations):
-            #When the category doesn't exist in this state, then ignored it 
-            if(ann['category_id'] not in self.seen_class_ids[image_index]):
-                continue
-
-            # some annotations have basically no width / height, skip them
-            if ann['bbox'][2] < 1 or ann['bbox'][3] < 1:
-                continue
-
-            annotation        = np.zeros((1, 5))
-            annotation[0, :4] = ann['bbox']
-            annotation[0, 4]  = self.coco_label_to_label(ann['category_id'])
-            annotations       = np.append(annotations, annotation, axis=0)
-
-        # transform from [x, y, w, h] to [x1, y1, x2, y2]
-        annotations[:, 2] = annotations[:, 0] + annotations[:, 2]
-        annotations[:, 3] = annotations[:, 1] + annotations[:, 3]
+        """get ground truth annotations, the seen categories are different for each image
+        """
+        boxes, cat_ids = self.annotation_table.get_annotations(self.image_ids[image_index])
+        mask = np.isin(cat_ids, self.seen_class_ids[image_index])
 
-        return annotations
+        annotations = np.zeros((int(mask.sum()), 5))
+        annotations[:, :4] = boxes[mask]
+        annotations[:, 4] = self.label_table[cat_ids[mask]]
+        return annotations, -1
 
 class Replay_dataset(IL_dataset):
+    STATE_ATTRS = IL_dataset.STATE_ATTRS + ['per_num']
+
     def __init__(self, params, transform=None):
         """
         Args:
@@ -240,10 +502,14 @@ class Replay_dataset(IL_dataset):
                     return
             raise ValueError("The length of img_ids doesn't meet any state")
         
-    def sample_imgs(self, sample_CIDs:list, limit_imgIds:list):
+    def sample_imgs(self, sample_CIDs:list, future_CIDs:list):
+        """sample per_num images for each class, the images containing future classes or sampled already are excluded
+        """
+        valid_mask = ~self.coco.img_mask_by_cats(future_CIDs)
         for CID in sample_CIDs:
-            imgIds = self.coco.get_imgs_by_cats(CID)
-            imgIds = list(set(imgIds) - limit_imgIds - set(self.image_ids))
+            mask = self.coco.img_mask_by_cats(CID) & valid_mask
+            mask[self.coco.img_index(self.image_ids)] = False
+            imgIds = self.coco.img_id_array[mask].tolist()
             if imgIds == []:
                 raise(ValueError('Class id:{} contained zero pictures different from other class in current state.'.format(CID)))
 
@@ -268,7 +534,7 @@ class Replay_dataset(IL_dataset):
         for i in range(self.cur_state, len(self.states)):
             future_CIDs.extend(self.states[i]['new_class']['id'])
 
-        self.sample_imgs(self.seen_class_id, set(self.coco.get_imgs_by_cats(future_CIDs)))
+        self.sample_imgs(self.seen_class_id, future_CIDs)
 
     def next_state(self):
         """add new state, sample old data
@@ -281,14 +547,14 @@ class Replay_dataset(IL_dataset):
             raise(ValueError("State{} doesn't exist in Replay dataloader".format(self.cur_state)))
 
         sample_CIDs = self.states[self.cur_state - 1]['new_class']['id']
-        self.seen_class_id.extend(sample_CIDs)
+        self.seen_class_id = self.seen_class_id + sample_CIDs
 
         # get futrue class ids and futrue imgs
         future_CIDs = []
         for i in range(self.cur_state, len(self.states)):
             future_CIDs.extend(self.states[i]['new_class']['id'])
 
-        self.sample_imgs(self.seen_class_id, set(self.coco.get_imgs_by_cats(future_CIDs)))
+        self.sample_imgs(self.seen_class_id, future_CIDs)
     
         
     # def load_annotations(self, image_index):
@@ -345,6 +611,18 @@ def collater(data):
         img = imgs[i]
         padded_imgs[i, :int(img.shape[0]), :int(img.shape[1]), :] = img
 
+    annot_padded = pad_annots(annots)
+
+    padded_imgs = padded_imgs.permute(0, 3, 1, 2)
+
+    # the size of images before padding
+    shapes = torch.tensor([s.get('img_shape', s['img'].shape[:2]) for s in data], dtype=torch.int64)
+    return {'img': padded_imgs, 'annot': annot_padded, 'scale': scales, 'num_persuado_labels': num_persuado_labels, 'shape': shapes,
+            'img_id': [s.get('img_id') for s in data], 'flip': [s.get('flip', False) for s in data]}
+
+def pad_annots(annots:list):
+    """pad the annotations of each image to the same number, padded annotations are -1
+    """
     max_num_annots = max(annot.shape[0] for annot in annots)
     
     if max_num_annots > 0:
@@ -357,34 +635,193 @@ def collater(data):
                     annot_padded[idx, :annot.shape[0], :] = annot
     else:
         annot_padded = torch.ones((len(annots), 1, 5)) * -1
+    return annot_padded
+
+def new_shared_uint8(numel:int):
+    """allocate a uint8 tensor in shared memory, so sending it to the main process doesn't copy it again
+    """
+    if hasattr(torch, 'UntypedStorage'):
+        # torch >= 2.0
+        storage = torch.UntypedStorage._new_shared(numel)
+        return torch.empty(0, dtype=torch.uint8).set_(storage)
+    storage = torch.ByteTensor().storage()._new_shared(numel)
+    return torch.ByteTensor().new(storage)
+
+class Uint8_collater(object):
+    """Collate the uint8 images (from Fused_transform with normalize=False) into a padded uint8 NCHW batch
+
+        The batch is normalized on the device by prepare_img_batch, so the transfer size is 1/4 of float32 batch.
+        In DataLoader workers, the batch is allocated in shared memory directly.
+        In the main process, the batches are allocated from a pool of (pinned) buffers, a buffer is reused when its batch is released.
+    """
+    def __init__(self, pool_size=4):
+        """
+            Args:
+                pool_size: the maximum number of buffers in the pool
+        """
+        self.pool_size = pool_size
+        # the padding value, it is about 0 after normalization
+        self.pad_value = np.round(np.array(MEAN) * 255).astype(np.uint8)
+        self.pool = [] # list of [flat buffer, weakref of the batch using it]
+
+    def __getstate__(self):
+        # the pool can't be shared with DataLoader workers
+        state = self.__dict__.copy()
+        state['pool'] = []
+        return state
+
+    def alloc(self, shape:tuple):
+        numel = int(np.prod(shape))
+        if get_worker_info() != None:
+            return new_shared_uint8(numel).view(shape)
+
+        entry = None
+        for e in self.pool:
+            if e[1] == None or e[1]() == None:
+                if e[0].numel() >= numel:
+                    entry = e
+                    break
+        if entry == None:
+            buffer = torch.empty(numel, dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+            free = [e for e in self.pool if e[1] == None or e[1]() == None]
+            if len(self.pool) < self.pool_size:
+                entry = [buffer, None]
+                self.pool.append(entry)
+            elif len(free) != 0:
+                # replace a smaller free buffer
+                entry = free[0]
+                entry[0] = buffer
+            else:
+                return buffer.view(shape)
+
+        batch = entry[0][:numel].view(shape)
+        entry[1] = weakref.ref(batch)
+        return batch
+
+    def __call__(self, data):
+        imgs = [s['img'] for s in data]
+        annots = [s['annot'] for s in data]
+        scales = [s['scale'] for s in data]
+        num_persuado_labels = [s['num_persuado_labels'] for s in data]
+
+        # pad to the multiple of 32 (like Resizer) or the bucket shape
+        max_rows = max(s['pad_shape'][0] for s in data)
+        max_cols = max(s['pad_shape'][1] for s in data)
+
+        padded_imgs = self.alloc((len(imgs), 3, max_rows, max_cols))
+        out = padded_imgs.numpy()
+        out[...] = self.pad_value.reshape(1, 3, 1, 1)
+        shapes = torch.zeros((len(imgs), 2), dtype=torch.int64)
+        for i, img in enumerate(imgs):
+            img = np.asarray(img)
+            out[i, :, :img.shape[0], :img.shape[1]] = img.transpose(2, 0, 1)
+            shapes[i, 0], shapes[i, 1] = img.shape[0], img.shape[1]
+
+        return {'img': padded_imgs, 'annot': pad_annots(annots), 'scale': scales, 'num_persuado_labels': num_persuado_labels, 'shape': shapes,
+                'img_id': [s.get('img_id') for s in data], 'flip': [s.get('flip', False) for s in data]}
+
+def get_collater(params, assign_targets=False):
+    """get the collate function for DataLoader, which must match get_transform(uint8=params['uint8_collate'])
+        Args:
+            params: Params
+            assign_targets: whether match the anchors in DataLoader workers if params['assign_in_worker']
+    """
+    collate_fn = Uint8_collater() if params['uint8_collate'] else collater
+    if assign_targets and params['assign_in_worker']:
+        return Target_collater(collate_fn, params)
+    return collate_fn
+
+_norm_params = {}
+def prepare_img_batch(img_batch:torch.Tensor, device=None, non_blocking=False):
+    """move the image batch to the device, uint8 batch is normalized on the device
+        Args:
+            img_batch: float32 normalized batch from collater, or uint8 batch from Uint8_collater
+            device: default is cuda
+            non_blocking: whether copy the batch asynchronously, the batch should be in pinned memory
+    """
+    if device == None:
+        device = torch.device('cuda')
+    if img_batch.dtype != torch.uint8:
+        return img_batch.float().to(device, non_blocking=non_blocking)
+
+    img_batch = img_batch.to(device, non_blocking=non_blocking)
+    if img_batch.device not in _norm_params:
+        # (x / 255 - mean) / std = x * alpha + beta
+        std = torch.tensor(STD, device=img_batch.device).view(1, 3, 1, 1)
+        mean = torch.tensor(MEAN, device=img_batch.device).view(1, 3, 1, 1)
+        _norm_params[img_batch.device] = (1.0 / (255.0 * std), -mean / std)
+    alpha, beta = _norm_params[img_batch.device]
+    return torch.addcmul(beta, img_batch.float(), alpha)
+
+class Batch_augmenter(object):
+    """Augment the collated batch on its device, so DataLoader workers only decode and resize the images
+
+        Each image is at the top-left corner of the padded batch, data['shape'] from the collaters gives its (rows, cols).
+        The images are flipped inside their own region by one gather, and the padded annotations are updated by the same masks.
+    """
+    def __init__(self, flip_x=0.5):
+        """
+            Args:
+                flip_x: the probability of horizontal flip
+        """
+        self.flip_x = flip_x
 
-
-    padded_imgs = padded_imgs.permute(0, 3, 1, 2)
-
-    return {'img': padded_imgs, 'annot': annot_padded, 'scale': scales, 'num_persuado_labels': num_persuado_labels}
+    def __call__(self, img_batch:torch.Tensor, annots:torch.Tensor, shapes:torch.Tensor):
+        """
+            Args:
+                img_batch: (N, C, H, W) padded batch
+                annots: (N, K, 5) padded annotations, the padded annotations are -1
+                shapes: (N, 2) the (rows, cols) of each image before padding
+            Return:
+                (img_batch, annots)
+        """
+        if self.flip_x > 0:
+            img_batch, annots = self.flip(img_batch, annots, shapes)
+        return img_batch, annots
+
+    def flip(self, img_batch:torch.Tensor, annots:torch.Tensor, shapes:torch.Tensor):
+        batch_size, channels, rows, cols = img_batch.shape
+        device = img_batch.device
+        flip = torch.rand(batch_size, device=device) < self.flip_x
+        if not bool(flip.any()):
+            return img_batch, annots
+        widths = shapes[:, 1].to(device)
+
+        # the column j of the flipped image is the column (width - 1 - j) of the image, the padding isn't moved
+        columns = torch.arange(cols, device=device).unsqueeze(0)
+        mirrored = widths.unsqueeze(1) - 1 - columns
+        index = torch.where(flip.unsqueeze(1) & (mirrored >= 0), mirrored, columns)
+        img_batch = torch.gather(img_batch, 3, index.view(batch_size, 1, 1, cols).expand(batch_size, channels, rows, cols))
+
+        annots = annots.clone()
+        widths = widths.to(annots.device, annots.dtype).unsqueeze(1)
+        mask = flip.to(annots.device).unsqueeze(1) & (annots[:, :, 4] != -1)
+        x1 = annots[:, :, 0].clone()
+        annots[:, :, 0] = torch.where(mask, widths - annots[:, :, 2], annots[:, :, 0])
+        annots[:, :, 2] = torch.where(mask, widths - x1, annots[:, :, 2])
+        return img_batch, annots
+
+def get_batch_augmenter(params):
+    """get the Batch_augmenter if params['batch_augment'], otherwise None, and the dataset should use get_transform(augment=False)
+    """
+    if params['batch_augment']:
+        return Batch_augmenter(flip_x=0.5)
+    return None
 
 class Resizer(object):
     """Convert ndarrays in sample to Tensors."""
 
-    def __call__(self, sample, min_side=608, max_side=1024):
+    def __call__(self, sample, min_side=MIN_SIDE, max_side=MAX_SIDE):
         image, annots = sample['img'], sample['annot']
 
         rows, cols, cns = image.shape
 
-        smallest_side = min(rows, cols)
-
-        # rescale the image so the smallest side is min_side
-        scale = min_side / smallest_side
+        scale = get_resize_scale(rows, cols, min_side, max_side)
 
-        # check if the largest side is now greater than max_side, which can happen
-        # when images have a large aspect ratio
-        largest_side = max(rows, cols)
-
-        if largest_side * scale > max_side:
-            scale = max_side / largest_side
-
-        # resize the image with the computed scale
-        image = skimage.transform.resize(image, (int(round(rows*scale)), int(round((cols*scale)))))
+        # resize the image with the computed scale, the image may be resized already (e.g. read from image cache)
+        new_shape = (int(round(rows*scale)), int(round((cols*scale))))
+        if new_shape != (rows, cols):
+            image = skimage.transform.resize(image, new_shape)
         rows, cols, cns = image.shape
 
         pad_w = 32 - rows%32
@@ -395,6 +832,9 @@ class Resizer(object):
 
         annots[:, :4] *= scale
 
+        # the scale which has been applied before Resizer
+        scale *= sample.get('scale', 1.0)
+
         return {'img': torch.from_numpy(new_image), 'annot': torch.from_numpy(annots), 'scale': scale, 'num_persuado_labels':sample['num_persuado_labels']}
 
 class Augmenter(object):
@@ -416,7 +856,9 @@ class Augmenter(object):
             annots[:, 0] = cols - x2
             annots[:, 2] = cols - x_tmp
 
-            sample = {'img': image, 'annot': annots, 'num_persuado_labels': sample['num_persuado_labels']}
+            sample = dict(sample)
+            sample['img'] = image
+            sample['annot'] = annots
 
         return sample
 
@@ -424,14 +866,133 @@ class Augmenter(object):
 class Normalizer(object):
 
     def __init__(self):
-        self.mean = np.array([[[0.485, 0.456, 0.406]]])
-        self.std = np.array([[[0.229, 0.224, 0.225]]])
+        self.mean = np.array([[MEAN]])
+        self.std = np.array([[STD]])
 
     def __call__(self, sample):
 
+        sample = dict(sample)
+        image = sample['img'].astype(np.float32)
+        # the image read by dataset is uint8
+        if sample['img'].dtype == np.uint8:
+            image /= 255.0
+        sample['img'] = (image-self.mean)/self.std
+        return sample
+
+class Fused_transform(object):
+    """Resize, flip(optional), normalize and pad the uint8 image in one step, which is equal to Normalizer -> Augmenter -> Resizer
+        with the default "skimage" resize backend, up to float rounding, because the resize and the normalization are both linear
+
+        The normalized float32 image is written into the padded output directly, so there is only one allocation for each sample.
+    """
+    def __init__(self, flip_x=0.5, min_side=MIN_SIDE, max_side=MAX_SIDE, normalize=True, resize_backend='skimage'):
+        """
+            Args:
+                flip_x: the probability of horizontal flip, 0 means not flip
+                min_side: the min_side for resizing
+                max_side: the max_side for resizing
+                normalize: whether output the normalized float32 padded image, 
+                            if False, output the resized uint8 image, which is padded and normalized by Uint8_collater and prepare_img_batch
+                resize_backend: "skimage" or "opencv", see resize_image(), default = "skimage"
+        """
+        self.flip_x = flip_x
+        self.normalize = normalize
+        self.resize_backend = resize_backend
+        self.min_side = min_side
+        self.max_side = max_side
+        # (x / 255 - mean) / std = x * alpha + beta
+        self.alpha = (1.0 / (255.0 * np.array(STD))).astype(np.float32)
+        self.beta = (-np.array(MEAN) / np.array(STD)).astype(np.float32)
+
+    def get_shape(self, image, bucket=None):
+        """
+            Args:
+                bucket: (H, W), if it is given, the image is resized to fit in the bucket, and padded to the bucket
+            Return:
+                (rows, cols, scale, padded_rows, padded_cols), the size after resizing and padding
+        """
+        return get_resized_shape(image.shape[0], image.shape[1], bucket, self.min_side, self.max_side)
+
+    def resize(self, image, rows:int, cols:int):
+        if image.shape[:2] == (rows, cols):
+            return image
+        return resize_image(image, rows, cols, self.resize_backend)
+
+    def apply(self, sample):
+        """resize and flip the uint8 image, and scale and flip the annotations
+            Return:
+                the new sample, 'img' is the resized image, which may be a flipped view,
+                it is uint8 if not normalize, otherwise it may be float for the normalization
+        """
         image, annots = sample['img'], sample['annot']
+        rows, cols, scale, padded_rows, padded_cols = self.get_shape(image, sample.get('bucket'))
+        image = self.resize(image, rows, cols)
+        # skimage returns float64, which is rounded like resize_for_cache, instead of truncated by Uint8_collater
+        if not self.normalize and image.dtype != np.uint8:
+            image = np.clip(np.round(image), 0, 255).astype(np.uint8)
+
+        flip = self.flip_x > 0 and np.random.rand() < self.flip_x
+        if flip:
+            image = image[:, ::-1, :]
 
-        return {'img':((image.astype(np.float32)-self.mean)/self.std), 'annot': annots, 'num_persuado_labels':sample['num_persuado_labels']}
+        annots[:, :4] *= scale
+        if flip:
+            x1 = annots[:, 0].copy()
+            annots[:, 0] = cols - annots[:, 2]
+            annots[:, 2] = cols - x1
+
+        sample = dict(sample)
+        sample['img'] = image
+        sample['annot'] = annots
+        sample['img_shape'] = (rows, cols)
+        sample['flip'] = flip
+        sample['pad_shape'] = (padded_rows, padded_cols)
+        # the scale which has been applied before
+        sample['scale'] = scale * sample.get('scale', 1.0)
+        return sample
+
+    def write(self, sample, out:np.ndarray):
+        """write the normalized image into the top-left corner of out, and the rest of out is filled with 0
+            Args:
+                sample: the sample which contains uint8 image
+                out: float32 array with shape (padded_rows, padded_cols, 3) at least
+            Return:
+                the new sample, 'img' is out
+        """
+        sample = self.apply(sample)
+        rows, cols = sample['img'].shape[:2]
+
+        region = out[:rows, :cols, :]
+        np.multiply(sample['img'], self.alpha, out=region)
+        region += self.beta
+        out[rows:, :, :] = 0
+        out[:rows, cols:, :] = 0
+
+        sample['img'] = out
+        return sample
+
+    def __call__(self, sample):
+        if self.normalize:
+            _, _, _, padded_rows, padded_cols = self.get_shape(sample['img'], sample.get('bucket'))
+            out = np.empty((padded_rows, padded_cols, 3), dtype=np.float32)
+            sample = self.write(sample, out)
+            sample['img'] = torch.from_numpy(out)
+        else:
+            sample = self.apply(sample)
+        sample['annot'] = torch.from_numpy(sample['annot'])
+        return sample
+
+def get_transform(augment=False, uint8=False, resize_backend='skimage'):
+    """get the transform for dataset
+        Args:
+            augment: whether use random horizontal flip
+            uint8: whether output uint8 image for Uint8_collater
+            resize_backend: "skimage" or "opencv", see get_resize_backend(), default = "skimage"
+    """
+    if augment:
+        return Fused_transform(flip_x=0.5, normalize=not uint8, resize_backend=resize_backend)
+    else:
+        return Fused_transform(flip_x=0, normalize=not uint8, resize_backend=resize_backend)
 
 class UnNormalizer(object):
     def __init__(self, mean=None, std=None):
@@ -456,30 +1017,147 @@ class UnNormalizer(object):
         return tensor
 
 
+def create_dataloader(params, dataset, batch_size:int, shuffle=True, drop_last=False, assign_targets=False, persistent=True, max_batches=None):
+    """create the DataLoader with AspectRatioBasedSampler, the setting of workers is read from params
+        Args:
+            params: Params, use 'num_workers', 'prefetch_factor', 'persistent_workers', 'pin_memory', 'device_prefetch', 'batch_pixels' and 'uint8_collate'
+            dataset: the dataset
+            batch_size: the batch size
+            shuffle: whether shuffle the batches
+            drop_last: whether drop the last batch
+            assign_targets: whether the batches carry the anchor assignment records for training, see get_collater()
+            persistent: whether keep the workers alive if params['persistent_workers'], False for the loaders which are used once
+            max_batches: if it is given, the loader only yields this number of batches, see AspectRatioBasedSampler
+    """
+    sampler = AspectRatioBasedSampler(dataset, batch_size=batch_size, drop_last=drop_last, shuffle=shuffle, 
+                                      batch_pixels=params['batch_pixels'], max_batches=max_batches)
+
+    num_workers = params['num_workers']
+    if num_workers == None:
+        num_workers = DEFAULT_NUM_WORKERS
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = params['prefetch_factor'] if params['prefetch_factor'] != None else DEFAULT_PREFETCH_FACTOR
+        kwargs['persistent_workers'] = persistent and bool(params['persistent_workers'])
+
+    # with workers, the images are decoded in other processes, so read-ahead only warms the page cache
+    if getattr(dataset, 'read_ahead', None) != None:
+        dataset.read_ahead.keep_data = (num_workers == 0)
+
+    # the non-blocking copies of Batch_prefetcher only overlap with the training step if the batches are in pinned memory
+    pin_memory = (bool(params['pin_memory']) or bool(params['device_prefetch'])) and torch.cuda.is_available()
+    return DataLoader(dataset, 
+                      num_workers=num_workers, 
+                      collate_fn=get_collater(params, assign_targets), 
+                      batch_sampler=sampler, 
+                      pin_memory=pin_memory,
+                      **kwargs)
+
+def refresh_dataloader(dataloader:DataLoader):
+    """call it after the images of dataset are changed (e.g. next state), the sampler regroups the images, 
+        and the state of dataset is published to the persistent workers, so they are kept alive across states
+        Return:
+            the DataLoader, which is the same one
+    """
+    dataloader.batch_sampler.groups = dataloader.batch_sampler.group_images()
+    if hasattr(dataloader.dataset, 'publish_state'):
+        dataloader.dataset.publish_state()
+    return dataloader
+
 class AspectRatioBasedSampler(Sampler):
 
-    def __init__(self, data_source, batch_size, drop_last,shuffle=True):
+    def __init__(self, data_source, batch_size, drop_last,shuffle=True, batch_pixels=None, max_batches=None):
+        """
+            Args:
+                data_source: the dataset
+                batch_size: the number of images in a batch
+                drop_last: whether drop the last incomplete batch (of each bucket if resize_buckets are used)
+                shuffle: whether shuffle the batches
+                batch_pixels: if it is given, pack the images into a batch until the padded pixels of batch (N * H * W) reach it, 
+                                and batch_size is ignored
+                max_batches: if it is given, only keep this number of batches evenly spaced over the aspect ratios, e.g. for calibration
+        """
         self.data_source = data_source
         self.batch_size = batch_size
         self.drop_last = drop_last
+        self.batch_pixels = batch_pixels
+        self.max_batches = max_batches
         self.groups = self.group_images()
         self.shuffle = shuffle
     def __iter__(self):
         if self.shuffle:
             random.shuffle(self.groups)
+
+        # publish the order of this epoch, so the files are read before the batches are loaded
+        read_ahead = getattr(self.data_source, 'read_ahead', None)
+        if read_ahead != None:
+            read_ahead.schedule([self.data_source.image_file(idx) for group in self.groups for idx in group])
+
         for group in self.groups:
+            if read_ahead != None:
+                read_ahead.advance(len(group))
             yield group
 
     def __len__(self):
-        if self.drop_last:
-            return len(self.data_source) // self.batch_size
-        else:
-            return (len(self.data_source) + self.batch_size - 1) // self.batch_size
+        return len(self.groups)
 
     def group_images(self):
         # determine the order of the images
         order = list(range(len(self.data_source)))
         order.sort(key=lambda x: self.data_source.image_aspect_ratio(x))
 
-        # divide into groups, one group = one batch
-        return [[order[x % len(order)] for x in range(i, i + self.batch_size)] for i in range(0, len(order), self.batch_size)]
+        # when the images are resized to buckets, each batch only contains the images in the same bucket
+        if len(getattr(self.data_source, 'resize_buckets', [])) != 0:
+            bucket_orders = defaultdict(list)
+            for idx in order:
+                bucket_orders[self.data_source.image_bucket(idx)].append(idx)
+            groups = []
+            for bucket in sorted(bucket_orders.keys(), key=lambda b: (b == None, b)):
+                groups.extend(self.divide(bucket_orders[bucket]))
+        else:
+            groups = self.divide(order)
+
+        if self.max_batches and len(groups) > self.max_batches:
+            step = len(groups) / self.max_batches
+            groups = [groups[int(i * step)] for i in range(self.max_batches)]
+        return groups
+
+    def divide(self, order:list):
+        """divide the ordered images into groups, one group = one batch, 
+            the last group is dropped if drop_last and it isn't full (fewer than batch_size images, or below batch_pixels)
+        """
+        if not self.batch_pixels:
+            groups = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+            if self.drop_last and len(groups) != 0 and len(groups[-1]) < self.batch_size:
+                groups.pop()
+            return groups
+
+        groups = []
+        group = []
+        max_rows, max_cols = 0, 0
+        for idx in order:
+            _, _, rows, cols = self.data_source.image_shape(idx)
+            rows, cols = max(rows, max_rows), max(cols, max_cols)
+            if len(group) != 0 and (len(group) + 1) * rows * cols > self.batch_pixels:
+                groups.append(group)
+                group = []
+                _, _, rows, cols = self.data_source.image_shape(idx)
+            group.append(idx)
+            max_rows, max_cols = rows, cols
+        # the last group is incomplete, because no image is left to reach batch_pixels
+        if len(group) != 0 and not self.drop_last:
+            groups.append(group)
+        return groups
+
+    def padding_waste(self):
+        """the ratio of padded pixels in all batches, which is wasted computation
+        """
+        image_pixels = 0
+        batch_pixels = 0
+        for group in self.groups:
+            shapes = [self.data_source.image_shape(idx) for idx in group]
+            image_pixels += sum(rows * cols for rows, cols, _, _ in shapes)
+            batch_pixels += len(group) * max(shape[2] for shape in shapes) * max(shape[3] for shape in shapes)
+        if batch_pixels == 0:
+            return 0.0
+        return 1.0 - image_pixels / batch_pixels
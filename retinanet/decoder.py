@@ -0,0 +1,109 @@
+import io
+import math
+import numpy as np
+
+import skimage.io
+import skimage.color
+
+DEFAULT_DECODER = "skimage"
+REDUCE_FACTORS = [8, 4, 2] # the factors supported by JPEG DCT-scaled decoding
+
+def get_reduce_factor(scale:float):
+    """get the largest factor n which let the image decoded by 1/n is still larger than the target scale
+    """
+    if scale == None:
+        return 1
+    for factor in REDUCE_FACTORS:
+        if 1 / factor >= scale:
+            return factor
+    return 1
+
+def to_rgb(img:np.ndarray):
+    if len(img.shape) == 2:
+        img = skimage.color.gray2rgb(img)
+    elif img.shape[2] == 4:
+        img = img[:, :, :3]
+    return img
+
+class Skimage_decoder(object):
+    """decode the full resolution image by skimage, which is the origin behavior
+    """
+    def __call__(self, source, scale=None):
+        """
+            Args:
+                source: the path of image or the bytes of image file
+                scale: the target resize scale, ignored by this decoder
+            Return:
+                (image, decode_scale), image is uint8 RGB image, decode_scale is the ratio of decoded size to the origin size
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        img = skimage.io.imread(source)
+        return to_rgb(img), 1.0
+
+class OpenCV_decoder(object):
+    """decode the image by OpenCV, JPEG images are decoded with reduced resolution when the target scale is small
+    """
+    def __init__(self):
+        import cv2
+        self.cv2 = cv2
+        self.flags = {1: cv2.IMREAD_COLOR,
+                      2: cv2.IMREAD_REDUCED_COLOR_2,
+                      4: cv2.IMREAD_REDUCED_COLOR_4,
+                      8: cv2.IMREAD_REDUCED_COLOR_8}
+
+    def __call__(self, source, scale=None):
+        cv2 = self.cv2
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            data = np.frombuffer(source, dtype=np.uint8)
+        else:
+            data = np.fromfile(source, dtype=np.uint8)
+
+        factor = get_reduce_factor(scale)
+        # ignore EXIF orientation, like skimage
+        flags = self.flags[factor] | cv2.IMREAD_IGNORE_ORIENTATION
+        img = cv2.imdecode(data, flags)
+        if img is None:
+            raise ValueError("OpenCV cannot decode the image")
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        # the reduced size is ceil(size / factor), pixels map to the origin image by 1 / factor
+        return img, 1.0 / factor
+
+class PIL_decoder(object):
+    """decode the image by PIL, JPEG images are decoded by draft mode (DCT scaling) near the target size
+    """
+    def __init__(self):
+        from PIL import Image
+        self.Image = Image
+
+    def __call__(self, source, scale=None):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        with self.Image.open(source) as img:
+            width, height = img.size
+            if scale != None and scale < 1:
+                # draft keeps the decoded size larger than the requested size
+                img.draft('RGB', (int(math.ceil(width * scale)), int(math.ceil(height * scale))))
+            # the reduced size is ceil(size / factor), pixels map to the origin image by 1 / factor
+            decode_scale = 1.0 / round(width / img.size[0])
+            img = np.asarray(img.convert('RGB'))
+        return img, decode_scale
+
+DECODERS = {'skimage': Skimage_decoder,
+            'opencv': OpenCV_decoder,
+            'pil': PIL_decoder}
+
+def create_decoder(name:str):
+    """create the image decoder
+        Args:
+            name: must be 'skimage', 'opencv' or 'pil', None means the default decoder
+    """
+    if name == None:
+        name = DEFAULT_DECODER
+    if name not in DECODERS:
+        raise ValueError("Unknown image decoder:{}, must be one of {}".format(name, list(DECODERS.keys())))
+    try:
+        return DECODERS[name]()
+    except ImportError as e:
+        raise ValueError("Image decoder '{}' is unavailable: {}".format(name, e))
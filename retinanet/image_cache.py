@@ -0,0 +1,134 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+
+from preprocessing.debug import debug_print, DEBUG_FLAG
+
+SHARD_SIZE = 1 << 30 # the maximum bytes of a shard file
+INDEX_FILE = "index.pickle"
+CACHE_VERSION = 1 # increase it when the resizing or the rounding of cached images is changed
+
+def get_cache_settings(decoder:str, resize_backend:str, images):
+    """the settings which produce the cached images, the cache is rebuilt if they are changed
+        Args:
+            decoder: the name of image decoder
+            resize_backend: "skimage" or "opencv"
+            images: the (img_id, file_name) of the cached images
+    """
+    sha1 = hashlib.sha1()
+    for img_id, file_name in sorted(images):
+        sha1.update('{}:{};'.format(img_id, file_name).encode())
+    return {'version': CACHE_VERSION, 'decoder': decoder, 'resize_backend': resize_backend, 'images': sha1.hexdigest()}
+
+class Image_cache(object):
+    """On-disk cache of resized uint8 images
+
+        The images are stored in a few large shard files, and an index maps image id -> (shard, offset, shape, scale).
+        The shards are opened with numpy.memmap, so reading an image returns a zero-copy view.
+        The index file also stores the settings which produced the images, see get_cache_settings(),
+        and the cache isn't built if they are different from the given settings.
+    """
+    def __init__(self, root_dir:str, min_side:int, max_side:int, settings=None):
+        """
+            Args:
+                root_dir: the directory for storing the caches
+                min_side: the min_side for Resizer
+                max_side: the max_side for Resizer
+                settings: the settings from get_cache_settings()
+        """
+        self.min_side = min_side
+        self.max_side = max_side
+        self.settings = settings
+        self.cache_dir = os.path.join(root_dir, '{}_{}'.format(min_side, max_side))
+        self.index = None
+        self._shards = {}
+
+        index_path = os.path.join(self.cache_dir, INDEX_FILE)
+        if os.path.isfile(index_path):
+            with open(index_path, 'rb') as f:
+                data = pickle.load(f)
+            # the cache built by other settings or by the old version without settings is rebuilt
+            if isinstance(data, dict) and data.get('settings') == settings and 'index' in data:
+                self.index = data['index']
+            else:
+                debug_print('Image cache in {} is built by other settings, rebuild it'.format(self.cache_dir))
+
+    def __getstate__(self):
+        # memmaps are opened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __len__(self):
+        if self.index == None:
+            return 0
+        return len(self.index)
+
+    def __contains__(self, img_id):
+        return self.index != None and img_id in self.index
+
+    def __getitem__(self, img_id):
+        """get the resized image
+            Return:
+                (image, scale), image is a read-only uint8 view with shape (rows, cols, 3)
+        """
+        shard_id, offset, shape, scale = self.index[img_id]
+        size = shape[0] * shape[1] * shape[2]
+        return self._get_shard(shard_id)[offset:offset + size].reshape(shape), scale
+
+    def is_built(self):
+        return self.index != None
+
+    def _shard_path(self, shard_id:int):
+        return os.path.join(self.cache_dir, 'shard_{:03d}.bin'.format(shard_id))
+
+    def _get_shard(self, shard_id:int):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(self._shard_path(shard_id), dtype=np.uint8, mode='r')
+        return self._shards[shard_id]
+
+    def build(self, img_ids:list, load_fn):
+        """write all images into shard files
+
+            Args:
+                img_ids: the image ids which will be cached
+                load_fn: a function, load_fn(img_id) return (resized uint8 image, scale)
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        debug_print('Build image cache in {}'.format(self.cache_dir))
+        # the shards are overwritten, so the old index is removed first
+        index_path = os.path.join(self.cache_dir, INDEX_FILE)
+        if os.path.isfile(index_path):
+            os.remove(index_path)
+        self.index = None
+
+        index = {}
+        shard_id = 0
+        offset = 0
+        f = open(self._shard_path(shard_id), 'wb')
+        try:
+            for img_id in img_ids:
+                img, scale = load_fn(img_id)
+                img = np.ascontiguousarray(img, dtype=np.uint8)
+                if offset != 0 and offset + img.nbytes > SHARD_SIZE:
+                    f.close()
+                    shard_id += 1
+                    offset = 0
+                    f = open(self._shard_path(shard_id), 'wb')
+
+                f.write(img.tobytes())
+                index[img_id] = (shard_id, offset, img.shape, scale)
+                offset += img.nbytes
+        finally:
+            f.close()
+
+        # write the index at last, so an interrupted building won't be used
+        with open(index_path + '.tmp', 'wb') as f:
+            pickle.dump({'settings': self.settings, 'index': index}, f)
+        os.replace(index_path + '.tmp', index_path)
+
+        self.index = index
+        self._shards = {}
+        debug_print('Image cache contains {} images'.format(len(index)))
@@ -0,0 +1,102 @@
+import os
+import pickle
+import numpy as np
+
+from preprocessing.debug import debug_print, DEBUG_FLAG
+from retinanet.image_cache import SHARD_SIZE, INDEX_FILE
+
+class Image_pack(object):
+    """Pack of encoded image files
+
+        The bytes of image files (e.g. JPEG) are stored in a few large shard files, and an index maps file name -> (shard, offset, size).
+        It has the same read(file_name) as File_reader, so it can be used by Read_ahead and the decoders directly.
+    """
+    def __init__(self, pack_dir:str):
+        """
+            Args:
+                pack_dir: the directory which stores the shards and the index
+        """
+        self.pack_dir = pack_dir
+        self.index = None
+        self._shards = {}
+
+        index_path = os.path.join(self.pack_dir, INDEX_FILE)
+        if os.path.isfile(index_path):
+            with open(index_path, 'rb') as f:
+                self.index = pickle.load(f)
+
+    def __getstate__(self):
+        # memmaps are opened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __len__(self):
+        if self.index == None:
+            return 0
+        return len(self.index)
+
+    def __contains__(self, file_name:str):
+        return self.index != None and file_name in self.index
+
+    def is_built(self):
+        return self.index != None
+
+    def read(self, file_name:str):
+        """get the bytes of the image file
+        """
+        if file_name not in self:
+            raise ValueError("Image file:{} doesn't exist in image pack {}".format(file_name, self.pack_dir))
+        shard_id, offset, size = self.index[file_name]
+        # copy the bytes, so the pages are really read here (e.g. in the threads of Read_ahead)
+        return self._get_shard(shard_id)[offset:offset + size].tobytes()
+
+    def _shard_path(self, shard_id:int):
+        return os.path.join(self.pack_dir, 'shard_{:03d}.bin'.format(shard_id))
+
+    def _get_shard(self, shard_id:int):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(self._shard_path(shard_id), dtype=np.uint8, mode='r')
+        return self._shards[shard_id]
+
+    def build(self, image_dir:str, file_names:list, shard_size=SHARD_SIZE):
+        """copy the image files into shard files
+
+            Args:
+                image_dir: the directory of image files
+                file_names: the file names which will be packed
+                shard_size: the maximum bytes of a shard file
+        """
+        if not os.path.isdir(self.pack_dir):
+            os.makedirs(self.pack_dir)
+        debug_print('Build image pack in {}'.format(self.pack_dir))
+
+        index = {}
+        shard_id = 0
+        offset = 0
+        f = open(self._shard_path(shard_id), 'wb')
+        try:
+            for file_name in file_names:
+                with open(os.path.join(image_dir, file_name), 'rb') as image_file:
+                    data = image_file.read()
+                if offset != 0 and offset + len(data) > shard_size:
+                    f.close()
+                    shard_id += 1
+                    offset = 0
+                    f = open(self._shard_path(shard_id), 'wb')
+
+                f.write(data)
+                index[file_name] = (shard_id, offset, len(data))
+                offset += len(data)
+        finally:
+            f.close()
+
+        # write the index at last, so an interrupted building won't be used
+        index_path = os.path.join(self.pack_dir, INDEX_FILE)
+        with open(index_path + '.tmp', 'wb') as f:
+            pickle.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+        self.index = index
+        self._shards = {}
+        debug_print('Image pack contains {} images'.format(len(index)))
@@ -0,0 +1,148 @@
+import torch
+
+CHUNK_ELEMENTS = 2 ** 20 # the number of scores in a chunk of Lean_focal_loss
+EPSILON = 1e-4 # the scores are clamped into [EPSILON, 1 - EPSILON]
+
+# The focal loss is described by per-anchor tensors instead of dense (batch_size, num_anchors, num_classes) targets:
+#     labels: (batch_size, num_anchors) the class of positive anchors, -1 for the other anchors
+#     bg_from: (batch_size, num_anchors) the classes >= bg_from are background, except the label of positive anchors,
+#              so it is 0 for negative and positive anchors, and num_classes for ignored anchors
+#     fg_upper, fg_floor: (batch_size, num_anchors) the focal weight of the label is fg_upper - score if score < fg_upper,
+#              otherwise fg_floor, default is 1 - score
+#     bg_scale: (batch_size, num_anchors) the scale of the background loss on the first num_scaled_classes classes
+#              when score > 0.05, default is no scale
+#     alpha_factor: (batch_size,) the alpha of each image
+
+def clamped_class_sum(classifications, num_classes:int, chunk_elements=CHUNK_ELEMENTS):
+    """sum the clamped scores of the first num_classes classes without gradient, in chunks of anchors
+        Return:
+            (batch_size, num_anchors)
+    """
+    batch_size, num_anchors, _ = classifications.shape
+    step = max(1, chunk_elements // max(1, batch_size * num_classes))
+    with torch.no_grad():
+        return torch.cat([torch.clamp(classifications[:, start:start + step, :num_classes], EPSILON, 1.0 - EPSILON).sum(dim=2)
+                            for start in range(0, num_anchors, step)], dim=1)
+
+def _chunk_masks(scores, labels, bg_from, bg_scale, num_scaled_classes:int):
+    class_ids = torch.arange(scores.shape[2], device=scores.device)
+    fg_mask = labels.unsqueeze(2) == class_ids
+    bg_mask = (class_ids >= bg_from.unsqueeze(2)) & ~fg_mask
+    scale = None
+    if bg_scale != None:
+        scale_mask = (class_ids < num_scaled_classes) & (scores > 0.05)
+        scale = torch.where(scale_mask, bg_scale.unsqueeze(2), torch.ones_like(scores))
+    return fg_mask, bg_mask, scale
+
+def dense_focal_loss(classifications, labels, bg_from, alpha_factor, gamma:float, fg_upper=None, fg_floor=None, bg_scale=None, num_scaled_classes=0):
+    """the focal loss with dense tensors, the reference of lean_focal_loss()
+        Return:
+            (bg_losses, fg_losses), the sum of background and foreground losses of each image
+    """
+    batch_size, num_anchors, _ = classifications.shape
+    fg_upper, fg_floor = _default_weights(fg_upper, fg_floor, batch_size, num_anchors, classifications.device)
+    scores = torch.clamp(classifications, EPSILON, 1.0 - EPSILON)
+    fg_mask, bg_mask, scale = _chunk_masks(scores, labels, bg_from, bg_scale, num_scaled_classes)
+
+    upper = fg_upper.unsqueeze(2)
+    fg_weight = torch.where(scores < upper, upper - scores, fg_floor.unsqueeze(2).expand_as(scores))
+    focal_weight = alpha_factor.view(-1, 1, 1) * torch.pow(torch.where(fg_mask, fg_weight, scores), gamma)
+    bce = -torch.where(fg_mask, torch.log(scores), torch.log(1.0 - scores))
+    cls_loss = focal_weight * bce
+    if scale != None:
+        cls_loss = cls_loss * scale
+    return cls_loss.masked_fill(~bg_mask, 0.).sum(dim=(1, 2)), cls_loss.masked_fill(~fg_mask, 0.).sum(dim=(1, 2))
+
+def _default_weights(fg_upper, fg_floor, batch_size:int, num_anchors:int, device):
+    if fg_upper == None:
+        fg_upper = torch.ones((batch_size, num_anchors), device=device)
+    if fg_floor == None:
+        fg_floor = torch.zeros((batch_size, num_anchors), device=device)
+    return fg_upper, fg_floor
+
+class Lean_focal_loss(torch.autograd.Function):
+    """The focal loss computed in chunks of anchors, only the scores and the per-anchor tensors are saved for backward,
+        and the gradient is computed analytically in the same chunks, so the dense temporaries only exist for a chunk
+    """
+    @staticmethod
+    def forward(ctx, classifications, labels, bg_from, alpha_factor, fg_upper, fg_floor, bg_scale, gamma:float, num_scaled_classes:int, chunk_elements:int):
+        ctx.save_for_backward(classifications, labels, bg_from, alpha_factor, fg_upper, fg_floor, bg_scale)
+        ctx.gamma = gamma
+        ctx.num_scaled_classes = num_scaled_classes
+        ctx.chunk_elements = chunk_elements
+
+        batch_size = classifications.shape[0]
+        bg_losses = torch.zeros(batch_size, device=classifications.device, dtype=classifications.dtype)
+        fg_losses = torch.zeros(batch_size, device=classifications.device, dtype=classifications.dtype)
+        for chunk in Lean_focal_loss._chunks(classifications, chunk_elements):
+            terms = Lean_focal_loss._terms(classifications[:, chunk], labels[:, chunk], bg_from[:, chunk], alpha_factor,
+                                            fg_upper[:, chunk], fg_floor[:, chunk],
+                                            bg_scale[:, chunk] if bg_scale != None else None,
+                                            gamma, num_scaled_classes, need_grad=False)
+            bg_losses += terms['bg_loss'].sum(dim=(1, 2))
+            fg_losses += terms['fg_loss'].sum(dim=(1, 2))
+        return bg_losses, fg_losses
+
+    @staticmethod
+    def backward(ctx, grad_bg, grad_fg):
+        classifications, labels, bg_from, alpha_factor, fg_upper, fg_floor, bg_scale = ctx.saved_tensors
+        grad = torch.empty_like(classifications)
+        grad_bg = grad_bg.view(-1, 1, 1)
+        grad_fg = grad_fg.view(-1, 1, 1)
+        for chunk in Lean_focal_loss._chunks(classifications, ctx.chunk_elements):
+            terms = Lean_focal_loss._terms(classifications[:, chunk], labels[:, chunk], bg_from[:, chunk], alpha_factor,
+                                            fg_upper[:, chunk], fg_floor[:, chunk],
+                                            bg_scale[:, chunk] if bg_scale != None else None,
+                                            ctx.gamma, ctx.num_scaled_classes, need_grad=True)
+            grad[:, chunk] = grad_bg * terms['bg_grad'] + grad_fg * terms['fg_grad']
+        return grad, None, None, None, None, None, None, None, None, None
+
+    @staticmethod
+    def _chunks(classifications, chunk_elements:int):
+        batch_size, num_anchors, num_classes = classifications.shape
+        step = max(1, chunk_elements // max(1, batch_size * num_classes))
+        return [slice(start, start + step) for start in range(0, num_anchors, step)]
+
+    @staticmethod
+    def _terms(classifications, labels, bg_from, alpha_factor, fg_upper, fg_floor, bg_scale, gamma:float, num_scaled_classes:int, need_grad:bool):
+        """the masked losses of a chunk, or their gradients with respect to the scores if need_grad
+        """
+        scores = torch.clamp(classifications, EPSILON, 1.0 - EPSILON)
+        fg_mask, bg_mask, scale = _chunk_masks(scores, labels, bg_from, bg_scale, num_scaled_classes)
+        alpha = alpha_factor.view(-1, 1, 1)
+
+        upper = fg_upper.unsqueeze(2)
+        below = scores < upper
+        fg_weight = torch.where(below, upper - scores, fg_floor.unsqueeze(2).expand_as(scores))
+        log_scores = torch.log(scores)
+        log_rest = torch.log(1.0 - scores)
+
+        if not need_grad:
+            # the same order of operations as dense_focal_loss
+            bg_loss = alpha * torch.pow(scores, gamma) * -log_rest
+            fg_loss = alpha * torch.pow(fg_weight, gamma) * -log_scores
+            if scale != None:
+                bg_loss = bg_loss * scale
+                fg_loss = fg_loss * scale
+            return {'bg_loss': bg_loss.masked_fill(~bg_mask, 0.), 'fg_loss': fg_loss.masked_fill(~fg_mask, 0.)}
+
+        # d/ds of alpha * s^gamma * -log(1 - s)
+        bg_grad = alpha * (gamma * torch.pow(scores, gamma - 1) * -log_rest + torch.pow(scores, gamma) / (1.0 - scores))
+        # d/ds of alpha * w^gamma * -log(s), where dw/ds = -1 if s < fg_upper, otherwise 0
+        fg_grad = alpha * (-gamma * torch.pow(fg_weight, gamma - 1) * below * -log_scores - torch.pow(fg_weight, gamma) / scores)
+        if scale != None:
+            bg_grad = bg_grad * scale
+            fg_grad = fg_grad * scale
+        # the gradient of clamp
+        inside = (classifications >= EPSILON) & (classifications <= 1.0 - EPSILON)
+        return {'bg_grad': bg_grad.masked_fill(~(bg_mask & inside), 0.), 'fg_grad': fg_grad.masked_fill(~(fg_mask & inside), 0.)}
+
+def lean_focal_loss(classifications, labels, bg_from, alpha_factor, gamma:float, fg_upper=None, fg_floor=None, bg_scale=None, num_scaled_classes=0,
+                    chunk_elements=CHUNK_ELEMENTS):
+    """the focal loss computed by Lean_focal_loss, which gives the same results as dense_focal_loss()
+        Return:
+            (bg_losses, fg_losses), the sum of background and foreground losses of each image
+    """
+    batch_size, num_anchors, _ = classifications.shape
+    fg_upper, fg_floor = _default_weights(fg_upper, fg_floor, batch_size, num_anchors, classifications.device)
+    return Lean_focal_loss.apply(classifications, labels, bg_from, alpha_factor, fg_upper, fg_floor, bg_scale, gamma, num_scaled_classes, chunk_elements)
@@ -1,455 +1,163 @@
+import os
 import torch
 import torch.nn as nn
-
-def calc_iou(a, b):
-    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
-
-    iw = torch.min(torch.unsqueeze(a[:, 2], dim=1), b[:, 2]) - torch.max(torch.unsqueeze(a[:, 0], 1), b[:, 0])
-    ih = torch.min(torch.unsqueeze(a[:, 3], dim=1), b[:, 3]) - torch.max(torch.unsqueeze(a[:, 1], 1), b[:, 1])
-
-    iw = torch.clamp(iw, min=0)
-    ih = torch.clamp(ih, min=0)
-
-    ua = torch.unsqueeze((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]), dim=1) + area - iw * ih
-
-    ua = torch.clamp(ua, min=1e-8)
-
-    intersection = iw * ih
-
-    IoU = intersection / ua
-
-    return IoU
+from retinanet.matcher import Anchor_matcher, create_matcher
+from retinanet.target_cache import Target_cache, DEFAULT_MAX_MB as DEFAULT_TARGET_CACHE_MB
+from retinanet.lean_focal_loss import clamped_class_sum, dense_focal_loss, lean_focal_loss
+from IL_method.teacher_cache import Teacher_cache, DEFAULT_MAX_MB as DEFAULT_TEACHER_CACHE_MB
+from IL_method.shared_backbone import Shared_backbone
+
+def batch_focal_loss(classifications, regressions, anchors, annotations, assignment, cur_state:int, params, progress=-1):
+    """compute the focal loss and regression loss of the whole batch at once
+        Args:
+            classifications: (batch_size, num_anchors, num_classes) the scores after activation
+            regressions: (batch_size, num_anchors, 4)
+            anchors: (1, num_anchors, 4)
+            annotations: (batch_size, num_boxes, 5) the padded annotations
+            assignment: the Anchor_assignment of the batch
+            cur_state: the current state
+            params: Params
+            progress: the progress of training for pseudo labels, -1 means disabled
+        Return:
+            a dict, 'cls_loss' is (bg_losses, fg_losses) with shape (batch_size,), 'reg_loss' has shape (1,),
+            'bg_masks' and 'enhance_on_new_loss' are added in the incremental state if params['distill'] and params['enhance_on_new']
+    """
+    alpha = params['alpha'] # default = 0.25
+    gamma = params['gamma'] # default = 2
+
+    # whether the state > 0, mean it is incremental state
+    incremental_state = (cur_state > 0)
+    past_class_num = params.states[cur_state]['num_past_class']
+
+    batch_size, num_anchors, num_classes = classifications.shape
+    device = classifications.device
+
+    has_gt = (assignment.num_gt > 0).to(device) # shape = (batch_size,)
+    positive_indices = assignment.positive
+    bg_mask = assignment.negative
+    num_positive_anchors = positive_indices.sum(dim=1).float()
+
+    # the classes >= bg_from are background, ignored anchors have no background class
+    labels = assignment.labels.masked_fill(~positive_indices, -1)
+    bg_from = torch.full((batch_size, num_anchors), num_classes, dtype=torch.long, device=device)
+    bg_from[bg_mask] = 0
+    # whether ignore past class, the images without annotation always use all classes as background
+    if incremental_state and params['ignore_past_class']:
+        new_bg_mask = bg_mask & has_gt.unsqueeze(1)
+        bg_from[new_bg_mask] = past_class_num
+        if params['new_ignore_past_class']:
+            old_prod = clamped_class_sum(classifications, past_class_num)
+            bg_from[torch.logical_and(new_bg_mask, old_prod < 0.5)] = 0
+    bg_from[positive_indices] = 0
+
+    # the images without annotation use 1 - alpha
+    alpha_factor = torch.full((batch_size,), 1. - alpha, device=device)
+    alpha_factor[has_gt] = alpha
+
+    # the focal weight of positive class is fg_upper - score, or fg_floor when the score is larger
+    fg_upper = torch.ones((batch_size, num_anchors), device=device)
+    fg_floor = torch.zeros((batch_size, num_anchors), device=device)
+    if incremental_state and params['decrease_positive_by_IOU']:
+        mid_indices = torch.le(assignment.max_iou, 0.7) & positive_indices
+        fg_upper[mid_indices] = torch.clip(assignment.max_iou[mid_indices] + 0.2, 1e-4, 1 - 1e-4)
+        fg_floor[mid_indices] = 1e-4
+    elif incremental_state:
+        fg_upper.fill_(params['decrease_positive'])
+
+    # fake label, scale the loss of old classes on the anchors assigned to new classes
+    bg_scale = None
+    if incremental_state and params['persuado_label'] and progress != -1:
+        fake_label_anchor = positive_indices & (labels >= past_class_num)
+        bg_scale = torch.where(fake_label_anchor, torch.full_like(fg_upper, progress), torch.ones_like(fg_upper))
+
+    if params['lean_focal_loss']:
+        bg_losses, fg_losses = lean_focal_loss(classifications, labels, bg_from, alpha_factor, gamma, fg_upper, fg_floor, bg_scale, past_class_num)
+    else:
+        bg_losses, fg_losses = dense_focal_loss(classifications, labels, bg_from, alpha_factor, gamma, fg_upper, fg_floor, bg_scale, past_class_num)
+    normalizer = torch.clamp(num_positive_anchors, min=1.0)
+    bg_losses = bg_losses / normalizer
+    fg_losses = fg_losses / normalizer
+
+    # compute the loss for regression, the mean of each image, and 0 for the images without positive anchors
+    image_index, anchor_index = positive_indices.nonzero(as_tuple=True)
+    regression_targets = assignment.positive_regression_targets(anchors[0, :, :], annotations)
+    regression_diff = torch.abs(regression_targets - regressions[image_index, anchor_index, :])
+    regression_loss = torch.where(
+        torch.le(regression_diff, 1.0 / 9.0),
+        0.5 * 9.0 * torch.pow(regression_diff, 2),
+        regression_diff - 0.5 / 9.0
+    )
+    regression_losses = torch.zeros(batch_size, device=device, dtype=regression_loss.dtype)
+    regression_losses.index_add_(0, image_index, regression_loss.sum(dim=1))
+    regression_losses = regression_losses / torch.clamp(num_positive_anchors * 4, min=1.0)
+
+    result = {'cls_loss': (bg_losses, fg_losses),
+              'reg_loss': regression_losses.mean(dim=0, keepdim=True)}
+
+    if incremental_state:
+        # store non positive anchors for distillation loss
+        if params['distill']:
+            result['bg_masks'] = ~positive_indices
+        if params['enhance_on_new']:
+            # false negative on new task
+            new_class_bg = torch.clamp(classifications[:, :, past_class_num:], 1e-4, 1.0 - 1e-4)
+            fn_mask = (bg_mask & has_gt.unsqueeze(1)).unsqueeze(2) & (new_class_bg > 0.05)
+            result['enhance_on_new_loss'] = torch.pow(new_class_bg, 2).masked_fill(~fn_mask, 0.).sum()
+    return result
 
 class ProtoTypeFocalLoss(nn.Module):
-    def forward(self, classifications, regressions, anchors, annotations, cur_state:int,params, cls_features, prototype_features):
+    def __init__(self, matcher=None):
+        super(ProtoTypeFocalLoss, self).__init__()
+        self.matcher = matcher if matcher != None else Anchor_matcher()
+
+    def forward(self, classifications, regressions, anchors, annotations, cur_state:int,params, cls_features, prototype_features, assignment=None):
         def _distance(a, b):
             return torch.norm(a - b, dim=2)
-        alpha = params['alpha'] # default = 0.25
-        gamma = params['gamma'] # default = 2
         num_anchors = 9
 
-        # whether the state > 0, mean it is incremental state
-        incremental_state = (cur_state > 0)
-        if incremental_state:
-            # if params['enhance_on_new']:
-            #     enhance_loss_on_new = None
-            if params['distill']:
-                bg_masks = []
-
-        batch_size = classifications.shape[0]
-        classification_losses = []
-        regression_losses = []
-
-        anchor = anchors[0, :, :]
-        anchor_widths  = anchor[:, 2] - anchor[:, 0]
-        anchor_heights = anchor[:, 3] - anchor[:, 1]
-        anchor_ctr_x   = anchor[:, 0] + 0.5 * anchor_widths
-        anchor_ctr_y   = anchor[:, 1] + 0.5 * anchor_heights
-        
-        pos_indices = []
-        pos_targets = []
-        for j in range(batch_size):
-
-            classification = classifications[j, :, :] # shape = (num_anchors, class_num)
-            regression = regressions[j, :, :]
-
-            bbox_annotation = annotations[j, :, :]
-            bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
-            
-            classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
-
-            if bbox_annotation.shape[0] == 0:
-                alpha_factor = torch.ones(classification.shape, device=torch.device('cuda:0')) * alpha
-
-                alpha_factor = 1. - alpha_factor
-                focal_weight = classification
-                focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
-
-                bce = -(torch.log(1.0 - classification))
-
-                cls_loss = focal_weight * bce
-                classification_losses.append(cls_loss.sum())
-                regression_losses.append(torch.tensor(0).float().cuda())
-                continue
-
-            IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4]) # shape=(num_anchors, num_annotations)
-            IoU_max, IoU_argmax = torch.max(IoU, dim=1) # shape=(num_anchors x 1)
-            
-
-            pos_indices.append(torch.ge(IoU_max, 0.5).view(-1, num_anchors).unsqueeze(dim=0))
-            target = bbox_annotation[IoU_argmax, 4].view(-1, num_anchors)
-            pos_targets.append(target.long().unsqueeze(dim=0))
-
-
-            # compute the loss for classification
-            targets = torch.ones(classification.shape, device=torch.device('cuda:0')) * -1
-    
-            # get background anchor idx
-            bg_mask = torch.lt(IoU_max, 0.4)
-            # whether ignore past class
-            if not incremental_state or (incremental_state and not params['ignore_past_class']):
-                targets[bg_mask, :] = 0
-            else:
-                past_class_num = params.states[cur_state]['num_past_class']
-                targets[bg_mask, past_class_num:] = 0
-                if params['new_ignore_past_class']:
-                    # targets_old = torch.zeros(classification.shape, device=torch.device('cuda:0'))
-                    # targets_old[bg_mask, :past_class_num] = 1
-
-                    old_prod = torch.sum(classification[:, :past_class_num], dim=1)
-                    targets[torch.logical_and(bg_mask, old_prod < 0.5), :past_class_num] = 0
-                    #torch.log(old_prod) * (1 - torch.clamp(old_prod, max=1)) 
-
-            positive_indices = torch.ge(IoU_max, 0.5) 
-
-            # store non positive anchors for distillation loss
-            if incremental_state and params['distill']:
-                bg_masks.append((~positive_indices).unsqueeze(dim=0))
-
-            num_positive_anchors = positive_indices.sum()
-            assigned_annotations = bbox_annotation[IoU_argmax, :]
-
-            targets[positive_indices, :] = 0
-            targets[positive_indices, assigned_annotations[positive_indices, 4].long()] = 1
-            
-
-            if torch.cuda.is_available():
-                alpha_factor = torch.ones(targets.shape , device=torch.device('cuda:0')) * alpha
-                # alpha_factor = torch.ones(targets.shape).cuda() * alpha
-            else: 
-                alpha_factor = torch.ones(targets.shape) * alpha
-            
-
-            if not incremental_state:
-                focal_weight = torch.where(torch.eq(targets, 1.), 1. - classification, classification) #shape = (Anchor_num, class_num)
-            elif params['decrease_positive_by_IOU']:
-                mid_indices = torch.logical_and(torch.le(IoU_max, 0.7), positive_indices)
-
-                focal_weight = torch.where(torch.eq(targets, 1.), 1. - classification, classification)
-
-                targets_for_mid = torch.zeros(classification.shape, device=torch.device('cuda:0'))
-                targets_for_mid[mid_indices, assigned_annotations[mid_indices, 4].long()] = 1
-                
-                upper_score = torch.clip(IoU_max + 0.2, 1e-4, 1 - 1e-4).unsqueeze(dim=1)
-                focal_weight = torch.where(torch.eq(targets_for_mid, 1), torch.where(classification >= upper_score, torch.ones(classification.shape, device=torch.device('cuda:0')) * 1e-4, torch.abs(classification - upper_score)), focal_weight)
-
-            else:
-                new_class_upper_score = params['decrease_positive']
-                focal_weight = torch.where(torch.eq(targets, 1.), new_class_upper_score - torch.clip(classification, 0, new_class_upper_score), classification)
-
-
-            focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
-            bce = -(targets * torch.log(classification) + (1.0 - targets) * torch.log(1.0 - classification))
-            
-            cls_loss = focal_weight * bce
-            
-            if torch.cuda.is_available():
-                cls_loss = torch.where(torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape, device=torch.device('cuda:0')))
-            else:
-                cls_loss = torch.where(torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape))
-
-            bg_losses.append(cls_loss[torch.eq(targets, 0.0)].sum() /torch.clamp(num_positive_anchors.float(), min=1.0))
-            fg_losses.append(cls_loss[torch.eq(targets, 1.0)].sum() /torch.clamp(num_positive_anchors.float(), min=1.0))
-
-            # classification_losses.append(cls_loss.sum()/torch.clamp(num_positive_anchors.float(), min=1.0))
-
-
-            # if incremental_state and params['enhance_on_new']:
-            #     new_class_bg = classification[bg_mask, past_class_num:]
-            #     # false negative mask
-            #     fn_mask = new_class_bg > 0.05
-            #     if (fn_mask > 0.05).sum() != 0:
-            #         if enhance_loss_on_new == None:
-            #             enhance_loss_on_new = torch.pow(new_class_bg[fn_mask], 2).sum() /torch.clamp(num_positive_anchors.float(), min=1.0)
-            #         else:
-            #             enhance_loss_on_new += torch.pow(new_class_bg[fn_mask], 2).sum() /torch.clamp(num_positive_anchors.float(), min=1.0)
-
-            # compute the loss for regression
-            if positive_indices.sum() > 0:
-                assigned_annotations = assigned_annotations[positive_indices, :]
-
-                anchor_widths_pi = anchor_widths[positive_indices]
-                anchor_heights_pi = anchor_heights[positive_indices]
-                anchor_ctr_x_pi = anchor_ctr_x[positive_indices]
-                anchor_ctr_y_pi = anchor_ctr_y[positive_indices]
-
-                gt_widths  = assigned_annotations[:, 2] - assigned_annotations[:, 0]
-                gt_heights = assigned_annotations[:, 3] - assigned_annotations[:, 1]
-                gt_ctr_x   = assigned_annotations[:, 0] + 0.5 * gt_widths
-                gt_ctr_y   = assigned_annotations[:, 1] + 0.5 * gt_heights
-
-                # clip widths to 1
-                gt_widths  = torch.clamp(gt_widths, min=1)
-                gt_heights = torch.clamp(gt_heights, min=1)
-
-                targets_dx = (gt_ctr_x - anchor_ctr_x_pi) / anchor_widths_pi
-                targets_dy = (gt_ctr_y - anchor_ctr_y_pi) / anchor_heights_pi
-                targets_dw = torch.log(gt_widths / anchor_widths_pi)
-                targets_dh = torch.log(gt_heights / anchor_heights_pi)
-
-                targets = torch.stack((targets_dx, targets_dy, targets_dw, targets_dh))
-                targets = targets.t()
-
-                if torch.cuda.is_available():
-                    # targets = targets/torch.Tensor([[0.1, 0.1, 0.2, 0.2]]).cuda()
-                    targets = targets/ torch.cuda.FloatTensor([[0.1, 0.1, 0.2, 0.2]])
-                else:
-                    targets = targets/torch.Tensor([[0.1, 0.1, 0.2, 0.2]])
-
-                regression_diff = torch.abs(targets - regression[positive_indices, :])
-
-                regression_loss = torch.where(
-                    torch.le(regression_diff, 1.0 / 9.0),
-                    0.5 * 9.0 * torch.pow(regression_diff, 2),
-                    regression_diff - 0.5 / 9.0
-                )
-                regression_losses.append(regression_loss.mean())
-            else:
-                if torch.cuda.is_available():
-                    regression_losses.append(torch.tensor(0).float().cuda())
-                else:
-                    regression_losses.append(torch.tensor(0).float())
+        # match the anchors of all images at once
+        if assignment == None:
+            assignment = self.matcher(anchors, annotations)
+        result = batch_focal_loss(classifications, regressions, anchors, annotations, assignment, cur_state, params)
 
         # cal prototype_loss
-        pos_indices = torch.cat(pos_indices) #shape = (batch_size, all_anchor_num / 9, 9)
-        pos_targets = torch.cat(pos_targets)
+        batch_size = classifications.shape[0]
+        past_class_num = params.states[cur_state]['num_past_class']
+        pos_indices = assignment.positive.view(batch_size, -1, num_anchors) #shape = (batch_size, all_anchor_num / 9, 9)
+        pos_targets = assignment.labels.view(batch_size, -1, num_anchors)
         
         mask = pos_indices.any(dim=2)
         pos_indices = pos_indices[mask,:]
-        pos_targets = pos_targets[mask,:]
+        pos_targets = pos_targets[mask,:] - past_class_num
 
         cls_features = cls_features[mask] # shape = (num_pos_anchor, channels)   
         
         num_new_classes = len(params.states[cur_state]['new_class']['id'])
-        count = torch.zeros(num_new_classes, num_anchors, 1).cuda()
-        cur_prototype_features = torch.zeros(num_new_classes, num_anchors, cls_features.shape[1]).cuda()
-        pos_targets -= past_class_num
-        
-        # for class_id in range(past_class_num):
-        for i in range(cls_features.shape[0]):
-            count[pos_targets[i][pos_indices[i]], pos_indices[i],:] += 1
-            cur_prototype_features[pos_targets[i][pos_indices[i]], pos_indices[i],:] += cls_features[i]
+        count = torch.zeros(num_new_classes, num_anchors, 1, device=cls_features.device)
+        cur_prototype_features = torch.zeros(num_new_classes, num_anchors, cls_features.shape[1], device=cls_features.device)
+
+        # accumulate the features of each (class, anchor) pair
+        feature_index, anchor_index = pos_indices.nonzero(as_tuple=True)
+        class_index = pos_targets[feature_index, anchor_index]
+        count.index_put_((class_index, anchor_index), torch.ones(class_index.shape[0], 1, device=count.device), accumulate=True)
+        cur_prototype_features.index_put_((class_index, anchor_index), cls_features[feature_index], accumulate=True)
 
         cur_prototype_features /= torch.clamp(count,min=1)
         cur_prototype_features = torch.mean(cur_prototype_features, dim=1).unsqueeze(dim=1)
         distance = _distance(cur_prototype_features.view(-1, cls_features.shape[1]), prototype_features)
-        prototype_loss = torch.clamp(600 - distance, min=0).mean() * 0.1
-
-        # if (prototype_loss == 0).sum() == 0:
-        #     prototype_loss = torch.tensor(0).float().cuda()
-        # else:
-        #     prototype_loss = torch.mean(prototype_loss[prototype_loss != 0])
-
-        result = {'cls_loss': torch.stack(classification_losses),
-                  'reg_loss': torch.stack(regression_losses).mean(dim=0, keepdim=True),
-                  'prototype_loss': prototype_loss}
-        
-        if incremental_state:
-            if params['distill']:
-                result['bg_masks'] = torch.cat(bg_masks)
+        result['prototype_loss'] = torch.clamp(600 - distance, min=0).mean() * 0.1
         return result
 
 class FocalLoss(nn.Module):
-    def forward(self, classifications, regressions, anchors, annotations, cur_state:int,params, progress=-1):
-        alpha = params['alpha'] # default = 0.25
-        gamma = params['gamma'] # default = 2
-
-        # whether the state > 0, mean it is incremental state
-        incremental_state = (cur_state > 0)
-            
-       
-        if incremental_state:
-            # if params['enhance_on_new']:
-            #     enhance_loss_on_new = None
-            if params['distill']:
-                bg_masks = []
-            if params['enhance_on_new']:
-                enhance_on_new_loss = torch.tensor(0).float().cuda()
- 
-
-        batch_size = classifications.shape[0]
-        bg_losses = []
-        fg_losses = []
-        # classification_losses = []
-        regression_losses = []
-
-        anchor = anchors[0, :, :]
-        anchor_widths  = anchor[:, 2] - anchor[:, 0]
-        anchor_heights = anchor[:, 3] - anchor[:, 1]
-        anchor_ctr_x   = anchor[:, 0] + 0.5 * anchor_widths
-        anchor_ctr_y   = anchor[:, 1] + 0.5 * anchor_heights
-        
-
-        for j in range(batch_size):
-            classification = classifications[j, :, :] # shape = (num_anchors, class_num)
-            regression = regressions[j, :, :]
-
-            bbox_annotation = annotations[j, :, :]
-            bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
-            
-            classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
-
-            if bbox_annotation.shape[0] == 0:
-                alpha_factor = torch.ones(classification.shape, device=torch.device('cuda:0')) * alpha
-
-                alpha_factor = 1. - alpha_factor
-                focal_weight = classification
-                focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
-
-                bce = -(torch.log(1.0 - classification))
-
-                cls_loss = focal_weight * bce
-
-                bg_losses.append(cls_loss.sum())
-                fg_losses.append(torch.tensor(0).float().cuda())
-                # classification_losses.append(cls_loss.sum())
-                regression_losses.append(torch.tensor(0).float().cuda())
-                continue
-
-            IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4]) # shape=(num_anchors, num_annotations)
-            IoU_max, IoU_argmax = torch.max(IoU, dim=1) # shape=(num_anchors x 1)
-            
-            # compute the loss for classification
-            targets = torch.ones(classification.shape, device=torch.device('cuda:0')) * -1
-    
-            # get background anchor idx
-            bg_mask = torch.lt(IoU_max, 0.4)
-            past_class_num = params.states[cur_state]['num_past_class']
-            # whether ignore past class
-            if not incremental_state or (incremental_state and not params['ignore_past_class']):
-                targets[bg_mask, :] = 0
-            else:
-                targets[bg_mask, past_class_num:] = 0
-                if params['new_ignore_past_class']:
-                    # targets_old = torch.zeros(classification.shape, device=torch.device('cuda:0'))
-                    # targets_old[bg_mask, :past_class_num] = 1
-
-                    old_prod = torch.sum(classification[:, :past_class_num], dim=1)
-                    targets[torch.logical_and(bg_mask, old_prod < 0.5), :past_class_num] = 0
-                    #torch.log(old_prod) * (1 - torch.clamp(old_prod, max=1)) 
-
-            positive_indices = torch.ge(IoU_max, 0.5) 
-
-            # store non positive anchors for distillation loss
-            if incremental_state and params['distill']:
-                bg_masks.append((~positive_indices).unsqueeze(dim=0))
-
-            num_positive_anchors = positive_indices.sum()
-            assigned_annotations = bbox_annotation[IoU_argmax, :]
-
-            targets[positive_indices, :] = 0
-            targets[positive_indices, assigned_annotations[positive_indices, 4].long()] = 1
-            
-
-            if torch.cuda.is_available():
-                alpha_factor = torch.ones(targets.shape , device=torch.device('cuda:0')) * alpha
-                # alpha_factor = torch.ones(targets.shape).cuda() * alpha
-            else: 
-                alpha_factor = torch.ones(targets.shape) * alpha
-            
-
-            if not incremental_state:
-                focal_weight = torch.where(torch.eq(targets, 1.), 1. - classification, classification) #shape = (Anchor_num, class_num)
-            elif params['decrease_positive_by_IOU']:
-                mid_indices = torch.logical_and(torch.le(IoU_max, 0.7), positive_indices)
+    def __init__(self, matcher=None):
+        super(FocalLoss, self).__init__()
+        self.matcher = matcher if matcher != None else Anchor_matcher()
 
-                focal_weight = torch.where(torch.eq(targets, 1.), 1. - classification, classification)
-
-                targets_for_mid = torch.zeros(classification.shape, device=torch.device('cuda:0'))
-                targets_for_mid[mid_indices, assigned_annotations[mid_indices, 4].long()] = 1
-                
-                upper_score = torch.clip(IoU_max + 0.2, 1e-4, 1 - 1e-4).unsqueeze(dim=1)
-                focal_weight = torch.where(torch.eq(targets_for_mid, 1), torch.where(classification >= upper_score, torch.ones(classification.shape, device=torch.device('cuda:0')) * 1e-4, torch.abs(classification - upper_score)), focal_weight)
-
-            else:
-                new_class_upper_score = params['decrease_positive']
-                focal_weight = torch.where(torch.eq(targets, 1.), new_class_upper_score - torch.clip(classification, 0, new_class_upper_score), classification)
-
-
-            focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
-            bce = -(targets * torch.log(classification) + (1.0 - targets) * torch.log(1.0 - classification))
-            
-            cls_loss = focal_weight * bce
-            
-            if torch.cuda.is_available():
-                cls_loss = torch.where(torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape, device=torch.device('cuda:0')))
-            else:
-                cls_loss = torch.where(torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape))
-
-            
-            if incremental_state and params['enhance_on_new']:
-                # false negative mask on new task
-                fn_mask = classification[bg_mask, past_class_num:] > 0.05
-                if fn_mask.sum() != 0:
-                    enhance_on_new_loss += torch.pow(classification[bg_mask, past_class_num:][fn_mask], 2).sum()
-                    # print(cls_loss[bg_mask, past_class_num:][fn_mask].sum())
-            
-            # fake label
-            if incremental_state and params['persuado_label'] and progress != -1:
-                fake_label_anchor = (targets[:,past_class_num:] == 1).any(dim=1)
-                # false positive for old class in new target
-                fp_mask = classification[fake_label_anchor, :past_class_num] > 0.05
-                cls_loss[fake_label_anchor, :past_class_num][fp_mask] *= progress
-
-
-            bg_losses.append(cls_loss[torch.eq(targets, 0.0)].sum() /torch.clamp(num_positive_anchors.float(), min=1.0))
-            fg_losses.append(cls_loss[torch.eq(targets, 1.0)].sum() /torch.clamp(num_positive_anchors.float(), min=1.0))
-
-            # compute the loss for regression
-            if positive_indices.sum() > 0:
-                assigned_annotations = assigned_annotations[positive_indices, :]
-
-                anchor_widths_pi = anchor_widths[positive_indices]
-                anchor_heights_pi = anchor_heights[positive_indices]
-                anchor_ctr_x_pi = anchor_ctr_x[positive_indices]
-                anchor_ctr_y_pi = anchor_ctr_y[positive_indices]
-
-                gt_widths  = assigned_annotations[:, 2] - assigned_annotations[:, 0]
-                gt_heights = assigned_annotations[:, 3] - assigned_annotations[:, 1]
-                gt_ctr_x   = assigned_annotations[:, 0] + 0.5 * gt_widths
-                gt_ctr_y   = assigned_annotations[:, 1] + 0.5 * gt_heights
-
-                # clip widths to 1
-                gt_widths  = torch.clamp(gt_widths, min=1)
-                gt_heights = torch.clamp(gt_heights, min=1)
-
-                targets_dx = (gt_ctr_x - anchor_ctr_x_pi) / anchor_widths_pi
-                targets_dy = (gt_ctr_y - anchor_ctr_y_pi) / anchor_heights_pi
-                targets_dw = torch.log(gt_widths / anchor_widths_pi)
-                targets_dh = torch.log(gt_heights / anchor_heights_pi)
-
-                targets = torch.stack((targets_dx, targets_dy, targets_dw, targets_dh))
-                targets = targets.t()
-
-                if torch.cuda.is_available():
-                    # targets = targets/torch.Tensor([[0.1, 0.1, 0.2, 0.2]]).cuda()
-                    targets = targets/ torch.cuda.FloatTensor([[0.1, 0.1, 0.2, 0.2]])
-                else:
-                    targets = targets/torch.Tensor([[0.1, 0.1, 0.2, 0.2]])
-
-                regression_diff = torch.abs(targets - regression[positive_indices, :])
-
-                regression_loss = torch.where(
-                    torch.le(regression_diff, 1.0 / 9.0),
-                    0.5 * 9.0 * torch.pow(regression_diff, 2),
-                    regression_diff - 0.5 / 9.0
-                )
-                regression_losses.append(regression_loss.mean())
-            else:
-                if torch.cuda.is_available():
-                    regression_losses.append(torch.tensor(0).float().cuda())
-                else:
-                    regression_losses.append(torch.tensor(0).float())
-
-        result = {'cls_loss': (torch.stack(bg_losses), torch.stack(fg_losses)),
-                  'reg_loss': torch.stack(regression_losses).mean(dim=0, keepdim=True)}
-        
-        if incremental_state:
-            if params['distill']:
-                result['bg_masks'] = torch.cat(bg_masks)
-            if params['enhance_on_new']:
-                result['enhance_on_new_loss'] = enhance_on_new_loss
-        return result
+    def forward(self, classifications, regressions, anchors, annotations, cur_state:int,params, progress=-1, assignment=None):
+        # match the anchors of all images at once
+        if assignment == None:
+            assignment = self.matcher(anchors, annotations)
+        return batch_focal_loss(classifications, regressions, anchors, annotations, assignment, cur_state, params, progress)
 
 class IL_Loss():
     def __init__(self, il_trainer):
@@ -457,13 +165,37 @@ class IL_Loss():
         self.model = il_trainer.model
         self.il_trainer = il_trainer
         self.params = il_trainer.params
-        self.focal_loss = FocalLoss()
+        self.focal_loss = FocalLoss(create_matcher(self.params, self.model.anchors))
         self.classifier_act = nn.Sigmoid()
         self.smoothL1Loss = nn.SmoothL1Loss()
 
+        if self.params['assign_in_worker'] and self.params['batch_augment']:
+            raise ValueError("assign_in_worker can't be used with batch_augment, because the batch is flipped after collation")
+        # cache the anchor assignments across epochs
+        if self.params['target_cache']:
+            if self.params['batch_augment']:
+                raise ValueError("target_cache can't be used with batch_augment, because the batch is flipped after collation")
+            cache_dir = os.path.join(self.params['ckp_path'], 'target_cache') if self.params['ckp_path'] != None else None
+            max_mb = self.params['target_cache_mb'] if self.params['target_cache_mb'] != None else DEFAULT_TARGET_CACHE_MB
+            matcher = self.focal_loss.matcher
+            self.target_cache = Target_cache(cache_dir, max_mb, signature=(matcher.positive_thresold, matcher.negative_thresold))
+        else:
+            self.target_cache = None
+        if self.params['teacher_pipeline'] and self.params['teacher_cache']:
+            raise ValueError("teacher_pipeline computes the outputs of previous model for each batch, it can't be used with teacher_cache")
+        # cache the outputs of previous model for distillation
+        if self.params['teacher_cache']:
+            if self.params['batch_augment']:
+                raise ValueError("teacher_cache can't be used with batch_augment, because the batch is flipped after collation")
+            max_mb = self.params['teacher_cache_mb'] if self.params['teacher_cache_mb'] != None else DEFAULT_TEACHER_CACHE_MB
+            self.teacher_cache = Teacher_cache(max_mb)
+        else:
+            self.teacher_cache = None
+        # reuse the frozen backbone or FPN activations of student in previous model
+        self.shared_backbone = Shared_backbone() if self.params['share_backbone'] else None
 
         if self.params['prototype_loss']:
-            self.prototypefocal_loss = ProtoTypeFocalLoss()
+            self.prototypefocal_loss = ProtoTypeFocalLoss(create_matcher(self.params, self.model.anchors))
             # if self.il_trainer.protoTyper.prototype_features == None:
             #     self.il_trainer.protoTyper.init_prototype(self.il_trainer.cur_state - 1)
             _ , _ , feature_channels = self.il_trainer.protoTyper.prototype_features.shape    
@@ -512,12 +244,85 @@ class IL_Loss():
             
         return sim_loss
      
-    def forward(self, img_batch, annotations, is_replay=False, is_bic=False):
+    def get_assignment(self, img_batch, anchors, annotations, target_keys, target_records, is_replay:bool):
+        """get the anchor assignment from the records of DataLoader workers or target cache, 
+            return None if neither is available, then the focal loss matches the anchors itself
+        """
+        if target_records != None:
+            return Target_cache.build_assignment(target_records, anchors.shape[1], anchors.device)
+        if self.target_cache == None or target_keys == None:
+            return None
+        rows, cols = int(img_batch.shape[2]), int(img_batch.shape[3])
+        keys = [(self.il_trainer.cur_state, is_replay) + key + (rows, cols) for key in target_keys]
+        return self.target_cache.get_assignment(keys, anchors, annotations, self.focal_loss.matcher)
+
+    def get_shared_level(self):
+        """
+            Return:
+                'fpn' or 'backbone' if previous model can reuse the activations of student, otherwise None
+        """
+        if self.shared_backbone == None or self.il_trainer.prev_model == None:
+            return None
+        return self.shared_backbone.get_level(self.il_trainer.model, self.il_trainer.prev_model, self.il_trainer.cur_warm_stage)
+
+    def get_teacher_features(self, img_batch, shared_level=None, features=None, backbone_features=None):
+        """the FPN features of previous model, which are computed from the activations of student if they are shared
+        """
+        prev_model = self.il_trainer.prev_model
+        with torch.no_grad():
+            if shared_level == 'fpn':
+                return [feature.detach() for feature in features]
+            if shared_level == 'backbone':
+                return prev_model.fpn([x.detach() for x in backbone_features])
+            return prev_model.forward_feature(img_batch)
+
+    def get_teacher_outputs(self, img_batch, target_keys, teacher_outputs=None, shared_level=None, features=None, backbone_features=None):
+        """run the previous model, or read its outputs from Teacher_pipeline or teacher cache
+            Args:
+                shared_level: 'fpn' or 'backbone' if previous model reuses the features or backbone_features of student, default = None
+                features: the FPN features of student, default = None
+                backbone_features: the backbone outputs of student, default = None
+            Return:
+                (prev_classification, prev_regression, prev_features), the classification is logits
+        """
+        if teacher_outputs != None:
+            return teacher_outputs.get()
+        prev_model = self.il_trainer.prev_model
+        keys = None
+        if self.teacher_cache != None and target_keys != None:
+            self.teacher_cache.set_state(self.il_trainer.cur_state)
+            rows, cols = int(img_batch.shape[2]), int(img_batch.shape[3])
+            keys = [key + (rows, cols) for key in target_keys]
+            cached = self.teacher_cache.get(keys, img_batch.device)
+            if cached != None:
+                prev_classification, prev_regression = cached
+                # the features aren't cached, so only the backbone and FPN are run
+                prev_features = self.get_teacher_features(img_batch, shared_level, features, backbone_features)
+                return prev_classification, prev_regression, prev_features
+
+        with torch.no_grad():
+            if shared_level != None:
+                # only the heads, or the FPN and the heads, of previous model are run
+                prev_features = self.get_teacher_features(img_batch, shared_level, features, backbone_features)
+                prev_classification, prev_regression = prev_model.forward_heads(prev_features, enable_act=False)
+            else:
+                prev_classification, prev_regression, prev_features = prev_model(img_batch,
+                                                                                return_feat=True, 
+                                                                                return_anchor=False, 
+                                                                                enable_act=False)
+        if keys != None:
+            self.teacher_cache.put(keys, prev_classification, prev_regression)
+        return prev_classification, prev_regression, prev_features
+
+    def forward(self, img_batch, annotations, is_replay=False, is_bic=False, target_keys=None, target_records=None, teacher_outputs=None):
         """
             Args:
                 img_batch: a tenor for input
                 annotations: the annotation for img_batch
                 is_replay: whether the data is from replay dataset, default=False
+                target_keys: the keys of images for target cache, see get_target_keys(), default=None
+                target_records: the anchor assignment records from Target_collater, default=None
+                teacher_outputs: the Teacher_outputs of previous model from Teacher_pipeline, default=None
         """
 
         ##############
@@ -569,7 +374,8 @@ class IL_Loss():
                                                                     return_feat=False, 
                                                                     return_anchor=True, 
                                                                     enable_act=True)
-            losses = self.focal_loss(classification, regression, anchors, annotations, 0, self.params)
+            assignment = self.get_assignment(img_batch, anchors, annotations, target_keys, target_records, is_replay)
+            losses = self.focal_loss(classification, regression, anchors, annotations, 0, self.params, assignment=assignment)
 
             # clip too small loss
             if self.il_trainer.params['clip_loss'] and is_replay:
@@ -603,21 +409,31 @@ class IL_Loss():
                 result['enhance_loss'] = enhance_loss
         # incremental state
         else:
+            shared_level = self.get_shared_level() if self.params['distill'] and teacher_outputs == None else None
+            backbone_features = None
             if self.il_trainer.params['prototype_loss'] and self.il_trainer.cur_epoch > 5:
                 classification, regression, features, anchors, cls_features = self.il_trainer.model.forward_prototype(img_batch, 
                                                                                                         return_feat=True, 
                                                                                                         return_anchor=True, 
                                                                                                         enable_act=False)
+                # forward_prototype doesn't return the backbone outputs
+                if shared_level == 'backbone':
+                    shared_level = None
             else:
-                classification, regression, features, anchors = self.il_trainer.model(img_batch, 
-                                                                                    return_feat=True, 
-                                                                                    return_anchor=True, 
-                                                                                    enable_act=False)
+                outputs = self.il_trainer.model(img_batch, 
+                                                return_feat=True, 
+                                                return_anchor=True, 
+                                                enable_act=False,
+                                                return_backbone=(shared_level == 'backbone'))
+                classification, regression, features, anchors = outputs[:4]
+                if shared_level == 'backbone':
+                    backbone_features = outputs[4]
                                                                                     
             # Bic method
             if self.params['bic']:
                 classification = self.il_trainer.bic.bic_correction(classification)
             
+            assignment = self.get_assignment(img_batch, anchors, annotations, target_keys, target_records, is_replay)
             # Compute focal loss
             if self.il_trainer.params['prototype_loss'] and self.il_trainer.cur_epoch > 5:
                 losses = self.prototypefocal_loss(self.classifier_act(classification), 
@@ -626,7 +442,8 @@ class IL_Loss():
                                                     cur_state,
                                                     self.params, 
                                                     cls_features, 
-                                                    self.il_trainer.protoTyper.prototype_features)
+                                                    self.il_trainer.protoTyper.prototype_features,
+                                                    assignment=assignment)
                 result['prototype_loss'] = losses['prototype_loss']
             else:
                 if not self.il_trainer.params['persuado_label']:
@@ -635,7 +452,8 @@ class IL_Loss():
                                             anchors, 
                                             annotations,
                                             cur_state,
-                                            self.params)
+                                            self.params,
+                                            assignment=assignment)
                 else:
                     finish_progress =  float(self.il_trainer.cur_epoch / self.il_trainer.end_epoch)
                     losses = self.focal_loss(self.classifier_act(classification), 
@@ -644,7 +462,8 @@ class IL_Loss():
                                             annotations,
                                             cur_state,
                                             self.params,
-                                            finish_progress)
+                                            finish_progress,
+                                            assignment=assignment)
 
             # clip too small loss
             if self.il_trainer.params['clip_loss']:
@@ -674,11 +493,8 @@ class IL_Loss():
                 if self.params['classifier_loss']:
                     # divide by batch_size
                     result['sim_loss'] = self.cal_classifier_loss()
-                with torch.no_grad():
-                    prev_classification, prev_regression, prev_features = self.il_trainer.prev_model(img_batch,
-                                                                                                    return_feat=True, 
-                                                                                                    return_anchor=False, 
-                                                                                                    enable_act=False)
+                prev_classification, prev_regression, prev_features = self.get_teacher_outputs(img_batch, target_keys, teacher_outputs,
+                                                                                               shared_level, features, backbone_features)
                 
 
                 # use cosine similarity to calculate distillation feature loss
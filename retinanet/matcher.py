@@ -0,0 +1,319 @@
+import torch
+
+POSITIVE_THRESOLD = 0.5 # the anchor whose max IoU >= it is positive
+NEGATIVE_THRESOLD = 0.4 # the anchor whose max IoU < it is background, the others are ignored
+BOX_STD = [0.1, 0.1, 0.2, 0.2] # the std for normalizing the regression targets
+
+def calc_iou(a, b):
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+
+    iw = torch.min(torch.unsqueeze(a[:, 2], dim=1), b[:, 2]) - torch.max(torch.unsqueeze(a[:, 0], 1), b[:, 0])
+    ih = torch.min(torch.unsqueeze(a[:, 3], dim=1), b[:, 3]) - torch.max(torch.unsqueeze(a[:, 1], 1), b[:, 1])
+
+    iw = torch.clamp(iw, min=0)
+    ih = torch.clamp(ih, min=0)
+
+    ua = torch.unsqueeze((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]), dim=1) + area - iw * ih
+
+    ua = torch.clamp(ua, min=1e-8)
+
+    intersection = iw * ih
+
+    IoU = intersection / ua
+
+    return IoU
+
+def calc_batch_iou(anchors, boxes):
+    """
+        Args:
+            anchors: (num_anchors, 4)
+            boxes: (batch_size, num_boxes, 4)
+        Return:
+            IoU with shape (batch_size, num_anchors, num_boxes)
+    """
+    a = anchors.unsqueeze(0).unsqueeze(2) # (1, A, 1, 4)
+    b = boxes.unsqueeze(1) # (B, 1, K, 4)
+    area = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+
+    iw = torch.clamp(torch.min(a[..., 2], b[..., 2]) - torch.max(a[..., 0], b[..., 0]), min=0)
+    ih = torch.clamp(torch.min(a[..., 3], b[..., 3]) - torch.max(a[..., 1], b[..., 1]), min=0)
+    intersection = iw * ih
+
+    ua = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1]) + area - intersection
+    ua = torch.clamp(ua, min=1e-8)
+    return intersection / ua
+
+def calc_pair_iou(a, b):
+    """the IoU of a[i] and b[i], which is computed like calc_batch_iou
+        Args:
+            a, b: (N, 4)
+        Return:
+            (N,)
+    """
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+
+    iw = torch.clamp(torch.min(a[:, 2], b[:, 2]) - torch.max(a[:, 0], b[:, 0]), min=0)
+    ih = torch.clamp(torch.min(a[:, 3], b[:, 3]) - torch.max(a[:, 1], b[:, 1]), min=0)
+    intersection = iw * ih
+
+    ua = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) + area - intersection
+    ua = torch.clamp(ua, min=1e-8)
+    return intersection / ua
+
+def ragged_to_padded(boxes, offsets):
+    """transform the ragged annotations into the padded annotations like collater, the padded annotations are -1
+        Args:
+            boxes: (num_boxes, 5) the annotations of all images, [x1, y1, x2, y2, label]
+            offsets: (batch_size + 1,) the annotations of the i-th image are boxes[offsets[i]:offsets[i + 1]]
+    """
+    offsets = torch.as_tensor(offsets, device=boxes.device).long()
+    counts = offsets[1:] - offsets[:-1]
+    batch_size = counts.shape[0]
+    max_num = max(int(counts.max()) if batch_size != 0 else 0, 1)
+
+    annotations = torch.full((batch_size, max_num, 5), -1, dtype=boxes.dtype, device=boxes.device)
+    image_ids = torch.repeat_interleave(torch.arange(batch_size, device=boxes.device), counts)
+    columns = torch.arange(boxes.shape[0], device=boxes.device) - offsets[image_ids]
+    annotations[image_ids, columns] = boxes
+    return annotations
+
+def encode_boxes(anchors, boxes):
+    """get the normalized regression targets
+        Args:
+            anchors: (N, 4) [x1, y1, x2, y2]
+            boxes: (N, 4) [x1, y1, x2, y2] the assigned ground truth of each anchor
+        Return:
+            (N, 4) targets [dx, dy, dw, dh] / BOX_STD
+    """
+    anchor_widths  = anchors[:, 2] - anchors[:, 0]
+    anchor_heights = anchors[:, 3] - anchors[:, 1]
+    anchor_ctr_x   = anchors[:, 0] + 0.5 * anchor_widths
+    anchor_ctr_y   = anchors[:, 1] + 0.5 * anchor_heights
+
+    gt_widths  = boxes[:, 2] - boxes[:, 0]
+    gt_heights = boxes[:, 3] - boxes[:, 1]
+    gt_ctr_x   = boxes[:, 0] + 0.5 * gt_widths
+    gt_ctr_y   = boxes[:, 1] + 0.5 * gt_heights
+
+    # clip widths to 1
+    gt_widths  = torch.clamp(gt_widths, min=1)
+    gt_heights = torch.clamp(gt_heights, min=1)
+
+    targets_dx = (gt_ctr_x - anchor_ctr_x) / anchor_widths
+    targets_dy = (gt_ctr_y - anchor_ctr_y) / anchor_heights
+    targets_dw = torch.log(gt_widths / anchor_widths)
+    targets_dh = torch.log(gt_heights / anchor_heights)
+
+    targets = torch.stack((targets_dx, targets_dy, targets_dw, targets_dh), dim=1)
+    return targets / torch.tensor([BOX_STD], dtype=targets.dtype, device=targets.device)
+
+class Anchor_assignment(object):
+    """The result of Anchor_matcher, all tensors have shape (batch_size, num_anchors) except num_gt
+
+        Attributes:
+            gt_index: the index of the assigned annotation in the padded annotations, it is 0 for the image without annotation
+            labels: the label of the assigned annotation, -1 for the image without annotation
+            max_iou: the max IoU with the annotations, 0 for the image without annotation
+            positive: whether max_iou >= positive thresold
+            negative: whether max_iou < negative thresold, which means background
+            ignore: the anchors which are neither positive nor negative
+            num_gt: (batch_size,) the number of annotations of each image
+    """
+    def __init__(self, gt_index, labels, max_iou, positive, negative, num_gt):
+        self.gt_index = gt_index
+        self.labels = labels
+        self.max_iou = max_iou
+        self.positive = positive
+        self.negative = negative
+        self.num_gt = num_gt
+
+    @property
+    def ignore(self):
+        return ~(self.positive | self.negative)
+
+    def regression_targets(self, image_index:int, anchors, annotations):
+        """get the regression targets of the positive anchors of an image, in the order of anchor index
+            Args:
+                image_index: the index of image in the batch
+                anchors: (num_anchors, 4)
+                annotations: (batch_size, num_boxes, 5) the padded annotations used for matching
+            Return:
+                (num_positive, 4)
+        """
+        positive = self.positive[image_index]
+        boxes = annotations[image_index, self.gt_index[image_index][positive], :4]
+        return encode_boxes(anchors[positive], boxes)
+
+    def positive_regression_targets(self, anchors, annotations):
+        """get the regression targets of the positive anchors of the whole batch, in the order of positive.nonzero()
+            Args:
+                anchors: (num_anchors, 4)
+                annotations: (batch_size, num_boxes, 5) the padded annotations used for matching
+            Return:
+                (num_positive, 4)
+        """
+        image_index, anchor_index = self.positive.nonzero(as_tuple=True)
+        boxes = annotations[image_index, self.gt_index[image_index, anchor_index], :4]
+        return encode_boxes(anchors[anchor_index], boxes)
+
+    def assigned_annotations(self, annotations):
+        """
+            Args:
+                annotations: (batch_size, num_boxes, 5) the padded annotations used for matching
+            Return:
+                (batch_size, num_anchors, 5) the assigned annotation of each anchor
+        """
+        index = self.gt_index.unsqueeze(2).expand(-1, -1, annotations.shape[2])
+        return torch.gather(annotations, 1, index)
+
+class Anchor_matcher(object):
+    """Match the anchors to the annotations of the whole batch in one call
+    """
+    def __init__(self, positive_thresold=POSITIVE_THRESOLD, negative_thresold=NEGATIVE_THRESOLD):
+        self.positive_thresold = positive_thresold
+        self.negative_thresold = negative_thresold
+
+    def __call__(self, anchors, annotations, offsets=None):
+        """
+            Args:
+                anchors: (1, num_anchors, 4) or (num_anchors, 4)
+                annotations: (batch_size, num_boxes, 5) the padded annotations, the padded annotations are -1,
+                             or (num_boxes, 5) the ragged annotations when offsets is given
+                offsets: (batch_size + 1,) the offsets of the ragged annotations
+            Return:
+                Anchor_assignment
+        """
+        anchors, annotations = self.prepare(anchors, annotations, offsets)
+        valid = annotations[:, :, 4] != -1
+        IoU = calc_batch_iou(anchors, annotations[:, :, :4]) # shape=(batch_size, num_anchors, num_boxes)
+        # the padded annotations are never matched
+        IoU.masked_fill_(~valid.unsqueeze(1), -1)
+        max_iou, gt_index = torch.max(IoU, dim=2)
+        return self.assign(annotations, valid, max_iou, gt_index)
+
+    def prepare(self, anchors, annotations, offsets=None):
+        if anchors.dim() == 3:
+            anchors = anchors[0]
+        if offsets != None:
+            annotations = ragged_to_padded(annotations, offsets)
+        if annotations.shape[1] == 0:
+            annotations = torch.full((annotations.shape[0], 1, 5), -1, dtype=anchors.dtype, device=anchors.device)
+        return anchors, annotations
+
+    def assign(self, annotations, valid, max_iou, gt_index):
+        """build Anchor_assignment from the max IoU and its annotation index of each anchor
+        """
+        num_gt = valid.sum(dim=1)
+        has_gt = (num_gt > 0).unsqueeze(1)
+        max_iou = torch.where(has_gt, max_iou, torch.zeros_like(max_iou))
+        gt_index = torch.where(has_gt, gt_index, torch.zeros_like(gt_index))
+        labels = torch.gather(annotations[:, :, 4], 1, gt_index).long()
+        labels = torch.where(has_gt, labels, torch.full_like(labels, -1))
+
+        positive = torch.ge(max_iou, self.positive_thresold)
+        negative = torch.lt(max_iou, self.negative_thresold)
+        return Anchor_assignment(gt_index, labels, max_iou, positive, negative, num_gt)
+
+class Sparse_anchor_matcher(Anchor_matcher):
+    """Match the anchors like Anchor_matcher, but only compute IoU for the anchors near each annotation
+
+        The anchors of each pyramid level are a regular grid, so the cells which may overlap an annotation are a rectangle.
+        The IoU of the (anchor, annotation) pairs in these rectangles are reduced to the max IoU and its annotation of each anchor,
+        so the memory scales with the number of overlapping anchors instead of num_anchors * num_annotations.
+        The result is the same as Anchor_matcher.
+    """
+    def __init__(self, anchor_generator, positive_thresold=POSITIVE_THRESOLD, negative_thresold=NEGATIVE_THRESOLD):
+        """
+            Args:
+                anchor_generator: the Anchors module which generates the anchors for matching
+        """
+        super(Sparse_anchor_matcher, self).__init__(positive_thresold, negative_thresold)
+        self.anchor_generator = anchor_generator
+
+    def __call__(self, anchors, annotations, offsets=None):
+        grid_shape = self.anchor_generator.grid_shape(anchors)
+        if grid_shape == None:
+            # the anchors aren't generated by anchor_generator, so the grid is unknown
+            return super(Sparse_anchor_matcher, self).__call__(anchors, annotations, offsets)
+
+        anchors, annotations = self.prepare(anchors, annotations, offsets)
+        batch_size, num_boxes = annotations.shape[:2]
+        num_anchors = anchors.shape[0]
+        device = anchors.device
+
+        valid = annotations[:, :, 4] != -1
+        image_ids, box_ids = valid.nonzero(as_tuple=True)
+        boxes = annotations[image_ids, box_ids, :4]
+
+        pair_boxes, pair_anchors = self.candidate_pairs(boxes, grid_shape, device)
+        IoU = calc_pair_iou(anchors[pair_anchors], boxes[pair_boxes])
+        keys = image_ids[pair_boxes] * num_anchors + pair_anchors
+        pair_box_ids = box_ids[pair_boxes]
+
+        # the pairs of each anchor are in the order of annotations, after the stable sorts, the first pair of each anchor has
+        # the max IoU and the smallest annotation index among the ties, which is the same as torch.max in Anchor_matcher
+        order = torch.sort(IoU, descending=True, stable=True)[1]
+        order = order[torch.sort(keys[order], stable=True)[1]]
+        keys, IoU, pair_box_ids = keys[order], IoU[order], pair_box_ids[order]
+        first = torch.ones_like(keys, dtype=torch.bool)
+        first[1:] = keys[1:] != keys[:-1]
+        # the anchors which don't overlap any annotation are matched to the first annotation with IoU 0
+        first &= IoU > 0
+
+        first_box = torch.where(valid, torch.arange(num_boxes, device=device).unsqueeze(0), torch.full_like(valid, num_boxes, dtype=torch.long))
+        first_box = torch.clamp(first_box.min(dim=1)[0], max=num_boxes - 1)
+        max_iou = torch.zeros(batch_size * num_anchors, dtype=anchors.dtype, device=device)
+        gt_index = first_box.unsqueeze(1).repeat(1, num_anchors).view(-1)
+        max_iou[keys[first]] = IoU[first]
+        gt_index[keys[first]] = pair_box_ids[first]
+        return self.assign(annotations, valid, max_iou.view(batch_size, num_anchors), gt_index.view(batch_size, num_anchors))
+
+    def candidate_pairs(self, boxes, grid_shape, device):
+        """get the (annotation, anchor) pairs whose anchor cell is close enough to the annotation for a positive IoU
+            Args:
+                boxes: (num_boxes, 4)
+                grid_shape: (rows, cols) of the image
+            Return:
+                (box_index, anchor_index), both are (num_pairs,)
+        """
+        all_box_index = []
+        all_anchor_index = []
+        level_offset = 0
+        for idx, (level_rows, level_cols) in enumerate(self.anchor_generator.level_shapes(*grid_shape)):
+            stride = self.anchor_generator.strides[idx]
+            base_anchors = self.anchor_generator.base_anchors[idx]
+            num_base = base_anchors.shape[0]
+            # the max distance from the center of cell to the edge of its anchors
+            half_w = float(base_anchors[:, 2].max())
+            half_h = float(base_anchors[:, 3].max())
+
+            # the centers of cells are (i + 0.5) * stride, keep one more cell at each side for the rounding error
+            col_start = torch.clamp(torch.ceil((boxes[:, 0] - half_w) / stride - 0.5).long() - 1, min=0)
+            col_end = torch.clamp(torch.floor((boxes[:, 2] + half_w) / stride - 0.5).long() + 1, max=level_cols - 1)
+            row_start = torch.clamp(torch.ceil((boxes[:, 1] - half_h) / stride - 0.5).long() - 1, min=0)
+            row_end = torch.clamp(torch.floor((boxes[:, 3] + half_h) / stride - 0.5).long() + 1, max=level_rows - 1)
+            num_cols = torch.clamp(col_end - col_start + 1, min=0)
+            num_rows = torch.clamp(row_end - row_start + 1, min=0)
+
+            # enumerate the rectangle of cells and the base anchors of each annotation
+            counts = num_cols * num_rows * num_base
+            box_index = torch.repeat_interleave(torch.arange(boxes.shape[0], device=device), counts)
+            starts = torch.cumsum(counts, dim=0) - counts
+            local = torch.arange(box_index.shape[0], device=device) - starts[box_index]
+            base = local % num_base
+            cell = local // num_base
+            cols = col_start[box_index] + cell % num_cols[box_index]
+            rows = row_start[box_index] + cell // num_cols[box_index]
+
+            all_box_index.append(box_index)
+            all_anchor_index.append(level_offset + (rows * level_cols + cols) * num_base + base)
+            level_offset += level_rows * level_cols * num_base
+
+        return torch.cat(all_box_index), torch.cat(all_anchor_index)
+
+def create_matcher(params, anchor_generator=None):
+    """get Sparse_anchor_matcher if params['sparse_matching'] and anchor_generator is given, otherwise Anchor_matcher
+    """
+    if params['sparse_matching'] and anchor_generator != None:
+        return Sparse_anchor_matcher(anchor_generator)
+    return Anchor_matcher()
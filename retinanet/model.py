@@ -386,7 +386,11 @@ class ResNet(nn.Module):
         self.freeze_bn()
   
 
-    def forward_feature(self, img_batch):
+    def forward_backbone(self, img_batch):
+        """
+            Return:
+                list, the outputs of layer2, layer3 and layer4 for FPN
+        """
         x = self.conv1(img_batch)
         x = self.bn1(x)
         x = self.relu(x)
@@ -396,8 +400,20 @@ class ResNet(nn.Module):
         x2 = self.layer2(x1)
         x3 = self.layer3(x2)
         x4 = self.layer4(x3)
-        features = self.fpn([x2, x3, x4])
+        return [x2, x3, x4]
+
+    def forward_feature(self, img_batch):
+        features = self.fpn(self.forward_backbone(img_batch))
         return features
+
+    def forward_heads(self, features, enable_act=True):
+        """
+            Return:
+                (classification, regression) of the FPN features
+        """
+        regression = torch.cat([self.regressionModel(feature) for feature in features], dim=1)  #shape = (batch_size, W*H*A(Anchor_num), 4)
+        classification = torch.cat([self.classificationModel(feature, enable_act) for feature in features], dim=1) #shape = (batch_size, W*H*A(Anchor_num), class_num)
+        return classification, regression
     
     def get_classification_feature(self, img_batch):
         x = self.conv1(img_batch)
@@ -447,37 +463,29 @@ class ResNet(nn.Module):
 
         return tuple(result)
 
-    def forward(self, img_batch, return_feat=False, return_anchor=True, enable_act=True):
+    def forward(self, img_batch, return_feat=False, return_anchor=True, enable_act=True, return_backbone=False):
         """ model forward transfer
             Args:
                 img_batch: tensor, shape = (batch_size, channel, height, width)
                 return_feat: bool, whether return feature, default = False
                 return_anchor: bool, whether return anchors, default = False
                 enable_act: bool, whether enable classification subnet output layer activate, default = True
+                return_backbone: bool, whether return the outputs of backbone for FPN, default = False
 
             Return: 
-                tuple, value=(classification, regression, feature, anchors)
+                tuple, value=(classification, regression, feature, anchors, backbone_features)
         """
-        x = self.conv1(img_batch)
-        x = self.bn1(x)
-        x = self.relu(x)
-        x = self.maxpool(x)
-
-        x1 = self.layer1(x)
-        x2 = self.layer2(x1)
-        x3 = self.layer3(x2)
-        x4 = self.layer4(x3)
-
-        features = self.fpn([x2, x3, x4])
-        regression = torch.cat([self.regressionModel(feature) for feature in features], dim=1)  #shape = (batch_size, W*H*A(Anchor_num), 4)
-        
-        classification = torch.cat([self.classificationModel(feature, enable_act) for feature in features], dim=1) #shape = (batch_size, W*H*A(Anchor_num), class_num)
+        backbone_features = self.forward_backbone(img_batch)
+        features = self.fpn(backbone_features)
+        classification, regression = self.forward_heads(features, enable_act)
 
         result = [classification, regression]
         if return_feat:
             result.append(features)
         if return_anchor:
             result.append(self.anchors(img_batch))
+        if return_backbone:
+            result.append(backbone_features)
         
         return tuple(result)
 
@@ -0,0 +1,113 @@
+import queue
+import threading
+import torch
+
+from retinanet.dataloader import prepare_img_batch
+
+class Batch_prefetcher(object):
+    """Wrap a DataLoader, and move the next batch to the device while the current step is running
+
+        On GPU, the next batch is copied with non-blocking copies on a side stream, and the uint8 batch is normalized there too.
+        The copies are only asynchronous from pinned memory, so create_dataloader() pins the batches if params['device_prefetch'].
+        On CPU, a thread prepares the next batch.
+        The yielded batches have 'img' as the normalized float batch on the device and 'annot' on the device,
+        so prepare_img_batch() and .cuda() in training steps don't do anything.
+    """
+    def __init__(self, dataloader, device=None):
+        """
+            Args:
+                dataloader: the DataLoader
+                device: the target device, default is cuda if it is available, otherwise cpu
+        """
+        self.dataloader = dataloader
+        if device == None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_stream()
+        return self._iter_thread()
+
+    def to_device(self, data:dict):
+        data = dict(data)
+        data['img'] = prepare_img_batch(data['img'], self.device, non_blocking=True)
+        data['annot'] = data['annot'].to(self.device, non_blocking=True)
+        return data
+
+    def _iter_stream(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.dataloader)
+        # the host batch is kept until its copy is finished, because Uint8_collater reuses the released buffers
+        pending = None
+
+        def preload():
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return None, None
+            with torch.cuda.stream(stream):
+                device_data = self.to_device(data)
+                event = torch.cuda.Event()
+                event.record(stream)
+            return device_data, (event, data)
+
+        next_data, next_pending = preload()
+        while next_data != None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            data = next_data
+            # the tensors allocated on the side stream are used by the current stream
+            data['img'].record_stream(current_stream)
+            data['annot'].record_stream(current_stream)
+
+            if pending != None:
+                pending[0].synchronize()
+            pending = next_pending
+            next_data, next_pending = preload()
+            yield data
+
+    def _iter_thread(self):
+        batches = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        end = object()
+
+        def produce():
+            try:
+                for data in self.dataloader:
+                    data = self.to_device(data)
+                    while not stop.is_set():
+                        try:
+                            batches.put(data, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+                batches.put(end)
+            except Exception as e:
+                batches.put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                data = batches.get()
+                if data is end:
+                    break
+                if isinstance(data, Exception):
+                    raise data
+                yield data
+        finally:
+            stop.set()
+            thread.join()
+
+def prefetch(params, dataloader):
+    """wrap the DataLoader by Batch_prefetcher if params['device_prefetch']
+    """
+    if params['device_prefetch']:
+        return Batch_prefetcher(dataloader)
+    return dataloader
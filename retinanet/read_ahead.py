@@ -0,0 +1,113 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_NUM_THREADS = 8
+
+class File_reader(object):
+    """Read the raw bytes of files in a directory
+    """
+    def __init__(self, root_dir:str, delay=0.0):
+        """
+            Args:
+                root_dir: the directory of files
+                delay: the artificial delay (seconds) for each read, for simulating slow storage
+        """
+        self.root_dir = root_dir
+        self.delay = delay
+
+    def read(self, file_name:str):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        with open(os.path.join(self.root_dir, file_name), 'rb') as f:
+            return f.read()
+
+class Read_ahead(object):
+    """Read the files in the order of the coming epoch by a thread pool, and keep at most max_buffer files in memory
+
+        There are two modes:
+            keep_data = True: the bytes are kept until get() is called, used when the dataset is read in the main process
+            keep_data = False: the bytes are dropped after reading, which only warms the page cache for DataLoader workers,
+                                the reading window is moved forward by advance()
+    """
+    def __init__(self, reader, max_buffer:int, num_threads=DEFAULT_NUM_THREADS):
+        """
+            Args:
+                reader: the reader which has read(file_name)
+                max_buffer: the maximum number of files read in advance
+                num_threads: the number of reading threads
+        """
+        self.reader = reader
+        self.max_buffer = max_buffer
+        self.num_threads = num_threads
+        self.keep_data = True
+        self._init_state()
+
+    def _init_state(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._names = []
+        self._futures = {}
+        self._next_submit = 0 # the index of the next file for reading
+        self._position = 0 # the number of files consumed
+
+    def __getstate__(self):
+        # threads can't be shared with DataLoader workers
+        return {'reader': self.reader, 'max_buffer': self.max_buffer, 'num_threads': self.num_threads, 'keep_data': self.keep_data}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def schedule(self, file_names:list):
+        """start reading the files of a new epoch in order, the files of previous schedule are dropped
+        """
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._names = list(file_names)
+            self._futures = {}
+            self._next_submit = 0
+            self._position = 0
+            self._fill()
+
+    def _fill(self):
+        if self._executor == None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        while self._next_submit < len(self._names) and self._next_submit < self._position + self.max_buffer:
+            name = self._names[self._next_submit]
+            if self.keep_data:
+                self._futures[name] = self._executor.submit(self.reader.read, name)
+            else:
+                self._executor.submit(self._warm, name)
+            self._next_submit += 1
+
+    def _warm(self, name:str):
+        try:
+            self.reader.read(name)
+        except OSError:
+            pass
+
+    def advance(self, num:int):
+        """move the reading window forward when the files are consumed by DataLoader workers
+        """
+        if self.keep_data:
+            return
+        with self._lock:
+            self._position += num
+            self._fill()
+
+    def get(self, file_name:str):
+        """get the bytes of file, if it isn't scheduled, then read it directly
+        """
+        with self._lock:
+            future = self._futures.pop(file_name, None)
+        if future == None:
+            return self.reader.read(file_name)
+
+        data = future.result()
+        with self._lock:
+            self._position += 1
+            self._fill()
+        return data
@@ -0,0 +1,315 @@
+import os
+import pickle
+import struct
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from preprocessing.debug import debug_print
+from retinanet.anchors import Anchors
+from retinanet.matcher import Anchor_assignment, create_matcher
+from retinanet.image_cache import SHARD_SIZE
+
+TARGET_CACHE_VERSION = 1 # increase it when the content of records is changed
+DEFAULT_MAX_MB = 256 # the default memory limit of the records
+META_FILE = "meta.pickle"
+HEADER = struct.Struct('<Q') # the size of each pickled record in shard files
+
+class Cached_assignment(Anchor_assignment):
+    """Anchor_assignment rebuilt from the records of Target_cache, the regression targets are read from the records
+    """
+    def __init__(self, labels, max_iou, positive, negative, num_gt, targets:list):
+        super(Cached_assignment, self).__init__(None, labels, max_iou, positive, negative, num_gt)
+        self.targets = targets
+
+    def regression_targets(self, image_index:int, anchors=None, annotations=None):
+        return self.targets[image_index]
+
+    def positive_regression_targets(self, anchors=None, annotations=None):
+        return torch.cat(self.targets)
+
+    def assigned_annotations(self, annotations):
+        raise ValueError("Cached assignment doesn't keep the index of annotations")
+
+def make_record(assignment:Anchor_assignment, image_index:int, anchors, annotations):
+    """compact the assignment of an image
+
+        Return:
+            a dict of numpy arrays,
+                'positive': the indices of positive anchors
+                'labels', 'iou', 'targets': the label, max IoU and regression targets of each positive anchor
+                'ignore': (num_ranges, 2) the [start, end) ranges of ignored anchors
+                'num_gt': the number of annotations
+    """
+    positive = assignment.positive[image_index]
+    ignore = assignment.ignore[image_index].cpu().numpy()
+
+    # run-length encoding of the ignored anchors
+    changes = np.flatnonzero(np.diff(np.concatenate(([0], ignore.astype(np.int8), [0]))))
+    return {'positive': positive.nonzero()[:, 0].cpu().numpy().astype(np.int32),
+            'labels': assignment.labels[image_index][positive].cpu().numpy().astype(np.int16),
+            'iou': assignment.max_iou[image_index][positive].cpu().numpy(),
+            'targets': assignment.regression_targets(image_index, anchors, annotations).cpu().numpy(),
+            'ignore': changes.reshape(-1, 2).astype(np.int32),
+            'num_gt': int(assignment.num_gt[image_index])}
+
+def record_bytes(record:dict):
+    return sum(value.nbytes for value in record.values() if isinstance(value, np.ndarray))
+
+def annotation_hash(annotation):
+    """the hash of the valid annotations (label != -1) of an image
+    """
+    annotation = annotation[annotation[:, 4] != -1].cpu().numpy().astype(np.float32)
+    return hashlib.sha1(annotation.tobytes()).hexdigest()
+
+class Target_cache(object):
+    """Cache the anchor assignments of images across epochs
+
+        An assignment depends on the annotations, the resize scale, the flip and the shape of input batch,
+        so the key is (state, is_replay, img_id, flip, scale, rows, cols). The records are compact,
+        and only positive anchors and the ranges of ignored anchors are stored.
+
+        The records are kept in memory up to max_mb, and the least recently used records are evicted.
+        If cache_dir is given, the records are also appended to shard files in it, so the evicted records are read back from disk,
+        and they are reused by the next runs. The shards are dropped if the matcher is changed, 
+        and a record from the disk is only used if the hash of its annotations is the same.
+    """
+    def __init__(self, cache_dir=None, max_mb=DEFAULT_MAX_MB, signature=None):
+        """
+            Args:
+                cache_dir: the directory for storing the records on disk, default = None which means only in memory
+                max_mb: the memory limit of the records in MB, default = 256
+                signature: the settings of matcher, the records on disk are dropped if it is changed, default = None
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.signature = signature
+        self.records = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (shard, offset, size, annotation hash) of the records on disk
+        self.index = {}
+        # the keys whose records are written or checked in this process
+        self.checked = set()
+        self._readers = {}
+        self._writer = None
+        self._shard_id = 0
+        if self.cache_dir != None:
+            self._open()
+
+    def __len__(self):
+        return len(self.records)
+
+    def clear(self):
+        self.records = OrderedDict()
+        self.num_bytes = 0
+
+    def _shard_path(self, shard_id:int):
+        return os.path.join(self.cache_dir, 'records_{:03d}.bin'.format(shard_id))
+
+    def _open(self):
+        """load the index of the shards, the shards are removed if the meta is different, 
+            and the truncated tail of a shard (e.g. interrupted writing) is cut off
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        meta = {'version': TARGET_CACHE_VERSION, 'signature': self.signature}
+        meta_path = os.path.join(self.cache_dir, META_FILE)
+        old_meta = None
+        if os.path.isfile(meta_path):
+            with open(meta_path, 'rb') as f:
+                old_meta = pickle.load(f)
+
+        shard_id = 0
+        while os.path.isfile(self._shard_path(shard_id)):
+            if old_meta != meta:
+                os.remove(self._shard_path(shard_id))
+            else:
+                self._load_shard(shard_id)
+            shard_id += 1
+
+        if old_meta != meta:
+            if old_meta != None:
+                debug_print('Target cache in {} is built by other settings, rebuild it'.format(self.cache_dir))
+            shard_id = 0
+            with open(meta_path + '.tmp', 'wb') as f:
+                pickle.dump(meta, f)
+            os.replace(meta_path + '.tmp', meta_path)
+        self._shard_id = max(shard_id - 1, 0)
+
+    def _load_shard(self, shard_id:int):
+        path = self._shard_path(shard_id)
+        with open(path, 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                size, = HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                try:
+                    key, annot_hash = pickle.loads(data)[:2]
+                except Exception:
+                    break
+                self.index[key] = (shard_id, offset + HEADER.size, size, annot_hash)
+                offset += HEADER.size + size
+        if offset != os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+
+    def _write(self, items:list):
+        """append the (key, annotation hash, record) to the current shard
+        """
+        if self._writer == None:
+            self._writer = open(self._shard_path(self._shard_id), 'ab')
+        for key, annot_hash, record in items:
+            data = pickle.dumps((key, annot_hash, record), protocol=pickle.HIGHEST_PROTOCOL)
+            # another cache of the same directory may have appended records
+            offset = self._writer.seek(0, os.SEEK_END)
+            if offset != 0 and offset + HEADER.size + len(data) > SHARD_SIZE:
+                self._writer.close()
+                self._shard_id += 1
+                self._writer = open(self._shard_path(self._shard_id), 'ab')
+                offset = 0
+            self._writer.write(HEADER.pack(len(data)))
+            self._writer.write(data)
+            self.index[key] = (self._shard_id, offset + HEADER.size, len(data), annot_hash)
+        # the records can be read back at once
+        self._writer.flush()
+
+    def _read(self, key):
+        shard_id, offset, size, _ = self.index[key]
+        if shard_id not in self._readers:
+            self._readers[shard_id] = open(self._shard_path(shard_id), 'rb')
+        f = self._readers[shard_id]
+        f.seek(offset)
+        return pickle.loads(f.read(size))[2]
+
+    def _put_memory(self, key, record):
+        if key in self.records:
+            self.num_bytes -= record_bytes(self.records.pop(key))
+        self.records[key] = record
+        self.num_bytes += record_bytes(record)
+        while self.num_bytes > self.max_bytes and len(self.records) != 0:
+            _, evicted = self.records.popitem(last=False)
+            self.num_bytes -= record_bytes(evicted)
+
+    def _get_record(self, key, annotation):
+        """
+            Args:
+                annotation: a function return the hash of annotations of the image, it is only called for the records from the disk
+            Return:
+                the record, None if it isn't cached or its annotations are different
+        """
+        if key in self.records:
+            self.records.move_to_end(key)
+            return self.records[key]
+        if key not in self.index:
+            return None
+        if key not in self.checked:
+            if self.index[key][3] != annotation():
+                return None
+            self.checked.add(key)
+        record = self._read(key)
+        self._put_memory(key, record)
+        return record
+
+    def get_assignment(self, keys:list, anchors, annotations, matcher):
+        """get the assignment of the batch, the missed images are matched by matcher and cached
+            Args:
+                keys: the key of each image in the batch
+                anchors: (1, num_anchors, 4)
+                annotations: (batch_size, num_boxes, 5) padded annotations
+                matcher: Anchor_matcher
+            Return:
+                Cached_assignment
+        """
+        anchor = anchors[0] if anchors.dim() == 3 else anchors
+        records = [self._get_record(key, lambda j=j: annotation_hash(annotations[j])) for j, key in enumerate(keys)]
+        misses = [j for j, record in enumerate(records) if record == None]
+        self.misses += len(misses)
+        self.hits += len(keys) - len(misses)
+        if len(misses) != 0:
+            miss_annotations = annotations[torch.tensor(misses, device=annotations.device)]
+            assignment = matcher(anchor, miss_annotations)
+            items = []
+            for i, j in enumerate(misses):
+                records[j] = make_record(assignment, i, anchor, miss_annotations)
+                self._put_memory(keys[j], records[j])
+                self.checked.add(keys[j])
+                if self.cache_dir != None:
+                    items.append((keys[j], annotation_hash(miss_annotations[i]), records[j]))
+            if len(items) != 0:
+                self._write(items)
+
+        return self.build_assignment(records, anchor.shape[0], anchor.device)
+
+    @staticmethod
+    def build_assignment(records:list, num_anchors:int, device):
+        """rebuild the assignment of the batch from the records, the records are concatenated on host, 
+            so each field is copied to the device once
+            Args:
+                records: the records from make_record()
+                num_anchors: the number of anchors
+                device: the device of the assignment
+            Return:
+                Cached_assignment
+        """
+        batch_size = len(records)
+        counts = [len(record['positive']) for record in records]
+        image_index = np.repeat(np.arange(batch_size), counts)
+        flat_index = torch.from_numpy(np.concatenate([record['positive'] for record in records]).astype(np.int64) + image_index * num_anchors)
+        flat_index = flat_index.to(device)
+
+        positive = torch.zeros((batch_size * num_anchors,), dtype=torch.bool, device=device)
+        labels = torch.full((batch_size * num_anchors,), -1, dtype=torch.long, device=device)
+        max_iou = torch.zeros((batch_size * num_anchors,), device=device)
+        positive[flat_index] = True
+        labels[flat_index] = torch.from_numpy(np.concatenate([record['labels'] for record in records])).to(device).long()
+        max_iou[flat_index] = torch.from_numpy(np.concatenate([record['iou'] for record in records])).to(device)
+        targets = torch.from_numpy(np.concatenate([record['targets'].reshape(-1, 4) for record in records])).to(device)
+        targets = list(torch.split(targets, counts))
+
+        # +1 at the start and -1 at the end of each ignored range, the cumsum > 0 is ignored
+        ignore_delta = torch.zeros((batch_size, num_anchors + 1), dtype=torch.int32)
+        for j, record in enumerate(records):
+            ranges = torch.from_numpy(record['ignore']).long()
+            if ranges.shape[0] != 0:
+                ignore_delta[j, ranges[:, 0]] += 1
+                ignore_delta[j, ranges[:, 1]] -= 1
+        ignore = (torch.cumsum(ignore_delta, dim=1)[:, :num_anchors] > 0).to(device)
+
+        positive = positive.view(batch_size, num_anchors)
+        negative = ~(positive | ignore)
+        num_gt = torch.tensor([record['num_gt'] for record in records], device=device)
+        return Cached_assignment(labels.view(batch_size, num_anchors), max_iou.view(batch_size, num_anchors), positive, negative, num_gt, targets)
+
+def get_target_keys(data:dict):
+    """get the keys of images in the batch for Target_cache, the state, replay flag and input shape are added by the loss
+    """
+    if data.get('img_id') == None or None in data['img_id']:
+        return None
+    return [(img_id, bool(flip), round(float(scale), 6)) for img_id, flip, scale in zip(data['img_id'], data['flip'], data['scale'])]
+
+class Target_collater(object):
+    """Wrap the collate function, and match the anchors of the padded batch in DataLoader workers
+
+        The batch gets 'targets', the records of make_record() for each image, so the loss only rebuilds the assignment.
+        The anchors are generated by Anchors() with the default settings, which are the same as the model.
+    """
+    def __init__(self, collate_fn, params):
+        self.collate_fn = collate_fn
+        self.anchor_generator = Anchors()
+        self.matcher = create_matcher(params, self.anchor_generator)
+
+    def __call__(self, data):
+        batch = self.collate_fn(data)
+        anchors = self.anchor_generator(batch['img'])[0]
+        annotations = batch['annot']
+        assignment = self.matcher(anchors, annotations)
+        batch['targets'] = [make_record(assignment, i, anchors, annotations) for i in range(annotations.shape[0])]
+        return batch
@@ -11,10 +11,8 @@ import cv2
 # torch
 import torch
 import torch.optim as optim
-from torchvision import transforms
-from torch.utils.data.dataloader import DataLoader
 # retinanet
-from retinanet.dataloader import AspectRatioBasedSampler, IL_dataset, Replay_dataset, Resizer, Augmenter, Normalizer, collater
+from retinanet.dataloader import IL_dataset, Replay_dataset, get_transform, get_resize_backend, create_dataloader, refresh_dataloader, get_batch_augmenter
 from retinanet.model import create_retinanet
 # traing util
 from preprocessing.params import Params
@@ -24,6 +22,7 @@ from IL_method.mas import MAS
 from IL_method.agem import A_GEM
 from IL_method.herd_sample import Herd_sampler
 from IL_method.weight_init import get_similarity
+from IL_method.teacher_precision import create_teacher
 
 
 WHITE_LIST_FOR_OPTIM = ['classificationModel.output']
@@ -60,6 +59,7 @@ class IL_Trainer(object):
             self.loss_hist = loss_hist
         self.dataloader_train = None
         self.update_dataloader()
+        self.batch_augmenter = get_batch_augmenter(params)
             
         self.cur_state = self.params['start_state']
         
@@ -121,10 +121,13 @@ class IL_Trainer(object):
         self.update_replay_dataloader()
             
     def update_dataloader(self):
+        # the dataset is the same, so only refresh the dataloader, which keeps the workers until the images are changed 
+        if self.dataloader_train != None and self.dataloader_train.dataset is self.dataset_train:
+            self.dataloader_train = refresh_dataloader(self.dataloader_train)
+            return
         if self.dataloader_train != None:
             del self.dataloader_train
-        sampler = AspectRatioBasedSampler(self.dataset_train, batch_size = self.params['batch_size'], drop_last=False)
-        self.dataloader_train = DataLoader(self.dataset_train, num_workers=2, collate_fn=collater, batch_sampler=sampler)
+        self.dataloader_train = create_dataloader(self.params, self.dataset_train, self.params['batch_size'], assign_targets=True)
 
     def update_prev_model(self):
         """update previous model, if distill = True
@@ -142,6 +145,20 @@ class IL_Trainer(object):
         self.prev_model.training = False
         self.prev_model.cuda()
 
+        # the teacher for distillation in reduced precision
+        precision = self.params['teacher_precision'] if self.params['teacher_precision'] != None else 'fp32'
+        if precision != 'fp32':
+            if self.params['mas']:
+                raise ValueError("MAS needs the float32 parameters of previous model, it can't be used with teacher_precision={}".format(precision))
+            num_batches = self.params['teacher_calibration_batches'] if self.params['teacher_calibration_batches'] != None else 0
+            # a small loader for the calibration batches, so the workers and the read-ahead of training loader aren't started
+            dataloader = None
+            if num_batches > 0:
+                dataloader = create_dataloader(self.params, self.dataset_train, self.params['batch_size'], 
+                                               shuffle=False, persistent=False, max_batches=num_batches)
+            self.prev_model = create_teacher(self.prev_model, precision, dataloader, num_batches)
+            del dataloader
+
     def init_prototyper(self):
         if self.params['prototype_loss'] or self.params['sample_method'] == 'prototype_herd':
             self.protoTyper = ProtoTyper(self)
@@ -163,7 +180,8 @@ class IL_Trainer(object):
             return
         
         self.dataset_replay = Replay_dataset(self.params,
-                                             transform=transforms.Compose([Normalizer(), Augmenter(), Resizer()]))
+                                             transform=get_transform(augment=not self.params['batch_augment'], uint8=self.params['uint8_collate'],
+                                                                     resize_backend=get_resize_backend(self.params)))
 
         if self.params['sample_method'] == 'herd':
             self.herd_sampler = Herd_sampler(self)
@@ -174,6 +192,7 @@ class IL_Trainer(object):
             per_num = self.params['sample_num']
             num_anchors = self.model.classificationModel.num_anchors
             sample_img_ids = []
+            sampled = set()
             examplar_dict = {}
             for state in range(self.cur_state):
                 # read examplar rank file
@@ -191,7 +210,7 @@ class IL_Trainer(object):
                 for i in range(1, len(coco.classes) + 1):
                     if i not in knowing_class_ids:
                         future_ids.append(i)
-                future_img_ids = coco.get_imgs_by_cats(future_ids)
+                future_img_ids = set(coco.get_imgs_by_cats(future_ids))
 
 
                 count = count.squeeze()
@@ -215,8 +234,9 @@ class IL_Trainer(object):
                         if cur_anchor_num_sample == 0:
                             continue
                         for img_id in sample_dict[coco_id][anchor_id]:
-                            if img_id not in sample_img_ids and img_id not in future_img_ids:
+                            if img_id not in sampled and img_id not in future_img_ids:
                                 sample_img_ids.append(img_id)
+                                sampled.add(img_id)
                                 examplar_dict[coco_id].append(img_id)
                                 cur_anchor_num_sample -= 1
                                 if cur_anchor_num_sample == 0:
@@ -259,10 +279,12 @@ class IL_Trainer(object):
     def update_replay_dataloader(self):
         if self.params['sample_num'] <= 0:
             return
+        if self.dataloader_replay != None and self.dataloader_replay.dataset is self.dataset_replay:
+            self.dataloader_replay = refresh_dataloader(self.dataloader_replay)
+            return
         if self.dataloader_replay != None:
             del self.dataloader_replay
-        sampler = AspectRatioBasedSampler(self.dataset_replay, batch_size = self.params['sample_batch_size'], drop_last=False)
-        self.dataloader_replay = DataLoader(self.dataset_replay, num_workers=2, collate_fn=collater, batch_sampler=sampler)
+        self.dataloader_replay = create_dataloader(self.params, self.dataset_replay, self.params['sample_batch_size'], assign_targets=True)
  
     def init_agem(self):
         if not self.params['agem']:
@@ -4,6 +4,10 @@ import time
 import numpy as np
 # retinanet
 from retinanet.losses import IL_Loss
+from retinanet.dataloader import prepare_img_batch
+from retinanet.prefetcher import prefetch
+from retinanet.target_cache import get_target_keys
+from IL_method.teacher_pipeline import teacher_pipeline
 from train.il_trainer import IL_Trainer
 # tool
 from recorder import Recorder
@@ -22,7 +26,13 @@ def training_iteration(il_trainer:IL_Trainer, il_loss:IL_Loss, data, is_replay=F
     warm_classifier = (il_trainer.cur_warm_stage != -1) and (il_trainer.params['warm_layers'][il_trainer.cur_warm_stage] == 'output')
 
     with torch.cuda.device(0):
-        losses = il_loss.forward(data['img'].float().cuda(), data['annot'].cuda(), is_replay=is_replay)
+        img_batch, annots = prepare_img_batch(data['img']), data['annot'].cuda()
+        if il_trainer.batch_augmenter != None and not data.get('augmented', False):
+            img_batch, annots = il_trainer.batch_augmenter(img_batch, annots, data['shape'])
+        losses = il_loss.forward(img_batch, annots, is_replay=is_replay,
+                                 target_keys=get_target_keys(data),
+                                 target_records=data.get('targets'),
+                                 teacher_outputs=data.get('teacher'))
 
         loss = torch.tensor(0).float().cuda()
         loss_info = {}
@@ -117,7 +127,10 @@ def cal_losses(il_trainer, il_loss, data, is_replay=False):
 
 def correction_new_class(il_trainer, il_loss, data):
     with torch.cuda.device(0):
-        losses = il_loss.forward(data['img'].float().cuda(), data['annot'].cuda(), is_replay=True)
+        img_batch, annots = prepare_img_batch(data['img']), data['annot'].cuda()
+        if il_trainer.batch_augmenter != None:
+            img_batch, annots = il_trainer.batch_augmenter(img_batch, annots, data['shape'])
+        losses = il_loss.forward(img_batch, annots, is_replay=True)
 
         loss = losses['enhance_loss']
         if bool(loss == 0):
@@ -193,6 +206,7 @@ def train_process(il_trainer : IL_Trainer):
             not_warm_classifier = not (il_trainer.cur_warm_stage != -1 and il_trainer.params['warm_layers'][il_trainer.cur_warm_stage] == 'output')
 
             num_training_iter = len(il_trainer.dataloader_train)
+            print('Padding waste: {:.1%}'.format(il_trainer.dataloader_train.batch_sampler.padding_waste()))
 
 
             # init mixdata
@@ -213,7 +227,7 @@ def train_process(il_trainer : IL_Trainer):
                         do_replay_num[i] += 1
                         remaining_num -= 1
 
-                replay_generator =  il_trainer.dataloader_replay.__iter__()
+                replay_generator = iter(prefetch(il_trainer.params, il_trainer.dataloader_replay))
                 replay_iter_num = 0
 
                 print('Num Replay images: {}'.format(len(il_trainer.dataset_replay)))
@@ -222,7 +236,7 @@ def train_process(il_trainer : IL_Trainer):
 
             do_mix_data = il_trainer.params['mix_data'] and (cur_epoch > il_trainer.params['mix_data_start'])
             # Training Dataset
-            for iter_num, data in enumerate(il_trainer.dataloader_train):
+            for iter_num, data in enumerate(teacher_pipeline(il_trainer, prefetch(il_trainer.params, il_trainer.dataloader_train), not not_warm_classifier)):
                 if iter_num == len(il_trainer.dataloader_train) - 1 and (not (replay_exist and not_warm_classifier and do_mix_data and iter_num in do_replay_ids)):
                     il_trainer.backward_next(is_tail=True)
                 else:
@@ -255,7 +269,7 @@ def train_process(il_trainer : IL_Trainer):
                         else:
                             il_trainer.backward_next(is_tail=False)
 
-                        data = replay_generator.next()
+                        data = next(replay_generator)
                         start = time.time()
                         losses = cal_losses(il_trainer, il_loss, data, is_replay=True)
                         if losses == None:
@@ -278,7 +292,7 @@ def train_process(il_trainer : IL_Trainer):
                 print('Iteration_num: ',len(il_trainer.dataloader_replay))
 
                 change_beta(il_trainer, is_replay=True)
-                for iter_num, data in enumerate(il_trainer.dataloader_replay):
+                for iter_num, data in enumerate(prefetch(il_trainer.params, il_trainer.dataloader_replay)):
                     if iter_num == len(il_trainer.dataloader_replay) - 1:
                         il_trainer.backward_next(is_tail=True)
                     else:
@@ -325,7 +339,7 @@ def train_process(il_trainer : IL_Trainer):
             flag = True
             while flag:
                 flag = False
-                for iter_num, data in enumerate(il_trainer.dataloader_replay):
+                for iter_num, data in enumerate(prefetch(il_trainer.params, il_trainer.dataloader_replay)):
                     if not correction_new_class(il_trainer, il_loss, data):
                         flag = True
             il_trainer.save_ckp(None, epoch=end_epoch)
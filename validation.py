@@ -38,6 +38,11 @@ def get_val_parser(args=None):
 
     parser.add_argument('--new_folder',help='whether create new folder in val_result, default = True',type=str2bool, default=True)
     parser.add_argument('--specific_folder', default="None")
+    parser.add_argument('--image_cache', help='whether read the resized images from the on-disk image cache, default = False', type=str2bool, default=False)
+    parser.add_argument('--image_pack', help='whether read the image files from the image pack built by pack_images.py, default = False', type=str2bool, default=False)
+    parser.add_argument('--resize_buckets', help='the canonical shapes "HxW" for resizing, e.g. "640x1024 1024x640 640x640", default = [] which means no bucket', nargs='*', default=[])
+    parser.add_argument('--bucket_min_scale', help='the image fitted in a bucket must be larger than bucket_min_scale * its normal resized size, default = 0.8', type=float, default=0.8)
+    parser.add_argument('--image_decoder', help='the backend for decoding images, must be "skimage", "opencv" or "pil", default = "skimage"', default="skimage")
 
 
     # always fixed